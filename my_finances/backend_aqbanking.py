@@ -3,6 +3,9 @@ import subprocess
 import csv
 from schwifty import IBAN
 
+from . import money
+from .transaction import Transaction
+
 
 #===================================================================================================
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -39,6 +42,12 @@ def aqbanking_fetch_transactions(account, from_date, to_date, temp_dir, config,
         "-o", csv_filename
     ])
 
+    # The export does not contain any balances
+    return aqbanking_parse_csv(csv_filename, account), []
+
+
+# Parses the CSV file created by `aqbanking-cli export`
+def aqbanking_parse_csv(csv_filename, account):
     transactions = []
     with open(csv_filename, newline='') as csvfile:
         for t in csv.DictReader(csvfile, delimiter=";"):
@@ -95,37 +104,28 @@ def entry_from_csv_row(csv, local_account):
     elif csv["remoteBankCode"]:
         remote_account = "?:" + csv["remoteBankCode"] + ";"
 
-    return {
-        "local_account": local_account,
-        "remote_account": remote_account,
-        "remote_name": csv["remoteName"],
-        "entry_date": csv["date"].replace("/", "-"),
-        "valuta_date": csv["valutaDate"].replace("/", "-"),
-        "value": to_fixedpoint(csv["value_value"]),
-        "currency": csv["value_currency"],
-        "purpose": extract_purpose(csv),
-        "ultimate_debtor": csv["ultimateDebtor"],
-        "ultimate_creditor": csv["ultimateCreditor"],
-        "primanota": csv["primanota"],
-
-        "transaction_key": csv["transactionKey"],
-        "transaction_code": csv["transactionCode"],
-        "transaction_text": csv["transactionText"],
+    return Transaction(
+        local_account=local_account,
+        remote_account=remote_account,
+        remote_name=csv["remoteName"],
+        entry_date=csv["date"].replace("/", "-"),
+        valuta_date=csv["valutaDate"].replace("/", "-"),
+        value=money.parse_fraction_cents(csv["value_value"]),
+        currency=csv["value_currency"],
+        purpose=extract_purpose(csv),
+        ultimate_debtor=csv["ultimateDebtor"],
+        ultimate_creditor=csv["ultimateCreditor"],
+        primanota=csv["primanota"],
+
+        transaction_key=csv["transactionKey"],
+        transaction_code=csv["transactionCode"],
+        transaction_text=csv["transactionText"],
 
         # SEPA
-        "creditor_scheme_id": csv["creditorSchemeId"],
-        "mandate_id": csv["mandateId"],
-        "end_to_end_ref": csv["endToEndReference"],
-    }
-
-
-def to_fixedpoint(v):
-    # `v` should be of the form "x/100"
-    [dec, frac] = v.split("/")
-    if frac != "100":
-        raise RuntimeError("Expected fraction to be 100")
-
-    return int(dec)
+        creditor_scheme_id=csv["creditorSchemeId"],
+        mandate_id=csv["mandateId"],
+        end_to_end_ref=csv["endToEndReference"],
+    )
 
 
 def extract_purpose(csv_row):
@@ -1,22 +1,39 @@
 import csv
 from datetime import datetime
 from pprint import pprint
-from decimal import Decimal
 import shutil
 
 from schwifty import IBAN
 
+from . import money
+from .transaction import Transaction
+
 
 #===================================================================================================
+# Returns the transactions and the balances at the end of each day if the file has a balance column
+# (see logic.insert_balance_checkpoints())
 def csv_fetch_transactions(account, from_date, to_date, temp_dir, config, options):
-    transactions = []
+    rows = csv_read_file(options["csv_filename"], account, from_date, to_date, config)
+    shutil.copy2(options["csv_filename"], temp_dir)
+
+    return [entry for entry, _ in rows], csv_daily_balances(rows)
+
+
+def csv_parse_file(filename, account, from_date, to_date, config):
+    return [entry for entry, _ in csv_read_file(filename, account, from_date, to_date, config)]
+
+
+# Returns a list of (transaction, balance) pairs in ascending order, where balance is the balance
+# after the transaction, or None if the file does not have a balance column
+def csv_read_file(filename, account, from_date, to_date, config):
+    rows = []
 
     # TODO Must make sure that there are no pending transactions in the CSV, or that these
     # transactions can be identified somehow
     #
     # Some banks (e.g. Fyrst) add a UTF-8 BOM at the beginning of the file. Using utf-8-sig ensures
     # that the BOM is not treated as text.
-    with open(options["csv_filename"], newline='', encoding="utf-8-sig") as csvfile:
+    with open(filename, newline='', encoding="utf-8-sig") as csvfile:
         if config["has_header"]:
             csv_reader = csv.DictReader(csvfile, delimiter=config["delimiter"])
         else:
@@ -28,9 +45,7 @@ def csv_fetch_transactions(account, from_date, to_date, temp_dir, config, option
                 print("Warning: Ignoring entry that is outside the specified date range.")
                 pprint(entry)
             else:
-                transactions.append(entry)
-
-    shutil.copy2(options["csv_filename"], temp_dir)
+                rows.append((entry, balance_from_csv_row(t, config)))
 
     # If the transactions are not sorted by entry_date in ascending order, reverse the list.
     # Why not simply do a sort? Because we (currently) need to preserve the order of transactions
@@ -38,10 +53,20 @@ def csv_fetch_transactions(account, from_date, to_date, temp_dir, config, option
     # already existing transactions, we simple compare them in order, and if they don't match, we
     # throw an error. (I should improve the validation procedure so that it does not have this
     # resitriction.)
-    if not is_ascending(transactions):
-        transactions.reverse()
+    if not is_ascending([entry for entry, _ in rows]):
+        rows.reverse()
+
+    return rows
+
+
+# Returns the balance after the last transaction of each day
+def csv_daily_balances(rows):
+    balances = {}
+    for entry, balance in rows:
+        if balance != None:
+            balances[entry["entry_date"]] = balance
 
-    return transactions
+    return [{"date": date, "balance": balance} for date, balance in balances.items()]
 
 
 # Utils
@@ -49,31 +74,32 @@ def csv_fetch_transactions(account, from_date, to_date, temp_dir, config, option
 def entry_from_csv_row(csv, local_account, config):
     fields = config["fields"]
 
-    entry = {
-        "local_account": local_account,
-        "ultimate_debtor": "",
-        "ultimate_creditor": "",
-        "primanota": "",
-        "transaction_key": "",
-        "transaction_code": "",
-        "transaction_text": "",
-        "creditor_scheme_id": "",
-        "mandate_id": "",
-        "end_to_end_ref": "",
-    }
+    entry = Transaction(
+        local_account=local_account,
+        ultimate_debtor="",
+        ultimate_creditor="",
+        primanota="",
+        transaction_key="",
+        transaction_code="",
+        transaction_text="",
+        creditor_scheme_id="",
+        mandate_id="",
+        end_to_end_ref="",
+    )
     for column, info in fields.items():
+        if column == "balance":
+            continue
+
         csv_value = csv[info["column"]]
         if column == "remote_account":
             try:
                 entry["remote_account"] = "iban:" + IBAN(csv_value).compact
             except ValueError:
                 entry["remote_account"] = "?:" + ";" + csv_value
-        elif column == "value":
-            if config["thousands_separator"]:
-                csv_value = csv_value.replace(config["thousands_separator"], "")
-            if config["decimal_separator"]:
-                csv_value = csv_value.replace(config["decimal_separator"], ".")
-            entry[column] = int(str(Decimal(csv_value)*100).split(".")[0])
+        elif column in ["value", "original_value"]:
+            entry[column] = money.parse_cents(csv_value, config["decimal_separator"], config["thousands_separator"])
+        elif column == "exchange_rate":
+            entry[column] = money.parse_rate(csv_value, config["decimal_separator"])
         elif column in ["entry_date", "valuta_date"]:
             if "format" in info:
                 entry[column] = str(datetime.strptime(csv_value, info["format"]).date())
@@ -85,6 +111,14 @@ def entry_from_csv_row(csv, local_account, config):
     return entry
 
 
+def balance_from_csv_row(csv, config):
+    info = config["fields"].get("balance")
+    if info == None:
+        return None
+
+    return money.parse_cents(csv[info["column"]], config["decimal_separator"], config["thousands_separator"])
+
+
 def is_ascending(ts):
     if not ts:
         return True
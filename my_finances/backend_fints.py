@@ -11,6 +11,9 @@ from schwifty import IBAN
 import mt940.models
 import decimal
 
+from . import money
+from .transaction import Transaction
+
 
 # Main functions
 #===================================================================================================
@@ -23,23 +26,22 @@ FINTS_ENDPOINTS = {
 }
 
 
+# Returns the transactions and the balances reported by the bank (see logic.insert_balance_checkpoints())
 def fints_fetch_transactions(account, from_date, to_date, temp_dir, config, options):
     # This probably belongs somewhere else
     logging.basicConfig(level=logging.WARNING)
 
-    client = FinTS3PinTanClient(
-        account["bank_code"],
-        account["login_name"],
-        getpass.getpass('PIN:'),
-        FINTS_ENDPOINTS[account["bank_code"]],
-        product_id='32F8A67FE34B57AB8D7E4FE70' # I think the ID is stolen from aqbanking
-    )
-
-    if prev_state := config.get("state"):
-        client.set_data(bytes.fromhex(prev_state))
+    client = get_client(account, config, options)
+    try:
+        return fetch_transactions(client, account, from_date, to_date, temp_dir, config)
+    except Exception:
+        # The client may be unusable now (e.g., after a failed dialog or TAN), so the next import
+        # starts over with a new one
+        drop_client(account, options)
+        raise
 
-    minimal_interactive_cli_bootstrap(client)
 
+def fetch_transactions(client, account, from_date, to_date, temp_dir, config):
     with client:
         # Since PSD2, a TAN might be needed for dialog initialization. Let's check if there is one required
         if client.init_tan_response:
@@ -56,6 +58,54 @@ def fints_fetch_transactions(account, from_date, to_date, temp_dir, config, opti
             raise RuntimeError("fints: unsupported account type: " + account_type)
 
 
+# If options contains a "fints_clients" dict (which is the case in serve mode), clients are cached
+# there so that the PIN only needs to be entered once and the bootstrapping is only done once per
+# bank login. A client is dropped from the cache when fetching fails (see fints_fetch_transactions()).
+def get_client(account, config, options):
+    clients = options.get("fints_clients")
+    key = (account["bank_code"], account["login_name"])
+    if clients != None and key in clients:
+        return clients[key]
+
+    client = FinTS3PinTanClient(
+        account["bank_code"],
+        account["login_name"],
+        getpass.getpass('PIN:'),
+        FINTS_ENDPOINTS[account["bank_code"]],
+        product_id='32F8A67FE34B57AB8D7E4FE70' # I think the ID is stolen from aqbanking
+    )
+
+    if prev_state := config.get("state"):
+        client.set_data(bytes.fromhex(prev_state))
+
+    minimal_interactive_cli_bootstrap(client)
+
+    if clients != None:
+        clients[key] = client
+
+    return client
+
+
+def drop_client(account, options):
+    clients = options.get("fints_clients")
+    if clients != None:
+        clients.pop((account["bank_code"], account["login_name"]), None)
+
+
+# Parses the transactions.json file written by fints_fetch_transactions()
+def fints_parse_json(json_filename, account):
+    with open(json_filename) as file:
+        data = json.load(file)
+
+    account_type, account_number = account["account_number"].split(":")
+    if account_type == "iban":
+        return [entry_from_account_transaction(t, account["account_number"]) for t in data]
+    elif account_type == "cc":
+        return entries_from_card_data(data["_additional_data"], account_number)
+    else:
+        raise RuntimeError("fints: unsupported account type: " + account_type)
+
+
 # Fetching account transactions
 #===================================================================================================
 def fetch_account_transactions(client, account, from_date, to_date, temp_dir, config):
@@ -85,7 +135,15 @@ def fetch_account_transactions(client, account, from_date, to_date, temp_dir, co
         data_to_save = [t.data for t in fints_transactions]
         json.dump(data_to_save, file, indent=4, default=default_json_encoder)
 
-    return [entry_from_account_transaction(t.data, account["account_number"]) for t in fints_transactions]
+    transactions = [entry_from_account_transaction(t.data, account["account_number"]) for t in fints_transactions]
+
+    # The booked balance, which includes all transactions returned above
+    balances = []
+    balance = client.get_balance(bank_account)
+    if balance != None:
+        balances.append({"date": str(balance.date), "balance": money.parse_cents(str(balance.amount.amount))})
+
+    return transactions, balances
 
 
 def entry_from_account_transaction(t, local_account):
@@ -95,29 +153,37 @@ def entry_from_account_transaction(t, local_account):
     elif t["applicant_bin"]: # it seems this can be either BLZ or BIC
         remote_account = "?:" + t["applicant_bin"] + ";"
 
-    return {
-        "local_account": local_account,
-        "remote_account": remote_account,
-        "remote_name": t.get("applicant_name") or "",
-        "entry_date": str(t["entry_date"]),
-        "valuta_date": str(t["date"]),
-        "value": int(str(t["amount"].amount * 100).split(".")[0]),
-        "currency": t["currency"],
-        "purpose": extract_purpose(t),
+    return Transaction(
+        local_account=local_account,
+        remote_account=remote_account,
+        remote_name=t.get("applicant_name") or "",
+        entry_date=str(t["entry_date"]),
+        valuta_date=str(t["date"]),
+        value=money.parse_cents(extract_amount(t)),
+        currency=t["currency"],
+        purpose=extract_purpose(t),
 
-        "ultimate_debtor": t.get("deviate_applicant") or "",
-        "ultimate_creditor": t.get("deviate_recipient") or "",
-        "primanota": t.get("prima_nota") or "",
+        ultimate_debtor=t.get("deviate_applicant") or "",
+        ultimate_creditor=t.get("deviate_recipient") or "",
+        primanota=t.get("prima_nota") or "",
 
-        "transaction_key": extract_transaction_key(t),
-        "transaction_code": (t.get("transaction_code") or "").lstrip("0"), # lstripping 0 to make it the same as aqbanking
-        "transaction_text": t.get("posting_text") or "",
+        transaction_key=extract_transaction_key(t),
+        transaction_code=(t.get("transaction_code") or "").lstrip("0"), # lstripping 0 to make it the same as aqbanking
+        transaction_text=t.get("posting_text") or "",
 
         # SEPA
-        "creditor_scheme_id": t.get("applicant_creditor_id") or "",
-        "mandate_id": t.get("additional_position_reference") or "",
-        "end_to_end_ref": t.get("end_to_end_reference") or "",
-    }
+        creditor_scheme_id=t.get("applicant_creditor_id") or "",
+        mandate_id=t.get("additional_position_reference") or "",
+        end_to_end_ref=t.get("end_to_end_reference") or "",
+    )
+
+
+def extract_amount(t):
+    # When read back from transactions.json the amount is a dict created by default_json_encoder()
+    if isinstance(t["amount"], dict):
+        return t["amount"]["amount"]
+
+    return str(t["amount"].amount)
 
 
 def extract_purpose(t):
@@ -160,7 +226,10 @@ def fetch_card_transactions(client, account, from_date, to_date, temp_dir, confi
     with open(os.path.join(temp_dir, "transactions.json"), "w") as file:
         json.dump(result, file, indent=4, default=default_json_encoder)
 
-    data = result._additional_data
+    return entries_from_card_data(result._additional_data, card_number), []
+
+
+def entries_from_card_data(data, card_number):
     if data[0] != card_number:
         raise RuntimeError("fints: Unexpected credit card number")
 
@@ -172,46 +241,46 @@ def fetch_card_transactions(client, account, from_date, to_date, temp_dir, confi
 
 
 def entry_from_card_transaction(t, card_number):
-    return {
-        "local_account": "cc:" + card_number,
-        "remote_account": "",
-        "remote_name": "",
-        "entry_date": cc_compact_date_to_iso(t[2]),
-        "valuta_date": cc_compact_date_to_iso(t[1]),
-        "value": cc_parse_amount(t[8], t[10]),
-        "currency": t[9],
-        "purpose": cc_extract_purpose(t),
-
-        "original_value": cc_parse_amount(t[4], t[6]),
-        "original_currency": t[5],
-        "exchange_rate": str(decimal.Decimal(t[7].replace(",", "."))),
-
-        "cc_entry_ref": t[21], # Is this actually a unique ID?
-        "cc_billing_ref": t[23],
-
-        "ultimate_debtor": "",
-        "ultimate_creditor": "",
-        "primanota": "",
-        "transaction_key": "",
-        "transaction_code": "",
-        "transaction_text": "",
-        "creditor_scheme_id": "",
-        "mandate_id": "",
-        "end_to_end_ref": "",
-    }
+    return Transaction(
+        local_account="cc:" + card_number,
+        remote_account="",
+        remote_name="",
+        entry_date=cc_compact_date_to_iso(t[2]),
+        valuta_date=cc_compact_date_to_iso(t[1]),
+        value=cc_parse_amount(t[8], t[10]),
+        currency=t[9],
+        purpose=cc_extract_purpose(t),
+
+        original_value=cc_parse_amount(t[4], t[6]),
+        original_currency=t[5],
+        exchange_rate=money.parse_rate(t[7], decimal_separator=","),
+
+        cc_entry_ref=t[21], # Is this actually a unique ID?
+        cc_billing_ref=t[23],
+
+        ultimate_debtor="",
+        ultimate_creditor="",
+        primanota="",
+        transaction_key="",
+        transaction_code="",
+        transaction_text="",
+        creditor_scheme_id="",
+        mandate_id="",
+        end_to_end_ref="",
+    )
 
 
 def cc_compact_date_to_iso(date):
     return date[0:4] +"-"+ date[4:6] +"-"+ date[6:8]
 
 def cc_parse_amount(amount, debit_or_credit):
-    d = decimal.Decimal(amount.replace(",", "."))
+    cents = money.parse_cents(amount, decimal_separator=",")
     if debit_or_credit == "D":
-        d *= -1
+        cents *= -1
     elif debit_or_credit != "C":
         raise RuntimeError("fints: debit or credit: expected either 'D' or 'C'")
 
-    return int(str(d*100).split(".")[0])
+    return cents
 
 def cc_extract_purpose(t):
     purpose = t[11] or ""
@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+import sqlite3
+import datetime
+
+
+# Pre-import backups
+#===================================================================================================
+# Before each import the database is copied into <db_file>.backups/ so that a bad import can be
+# undone with restore_backup(). The copy is made with SQLite's online backup API, which copies
+# BACKUP_PAGES_PER_STEP pages at a time and sleeps in between, so other connections (e.g., the GUI)
+# are never blocked for long.
+#
+# Most scheduled imports do not find any new transactions. A backup is therefore only created if the
+# database has changed since the most recent backup, which is detected by comparing watermarks (see
+# compute_watermark()) instead of the files, so checking an unchanged database costs a few small
+# queries. Only the KEEP_BACKUPS most recent backups are kept.
+#
+# Each backup consists of <name>.db and <name>.json, which contains the watermark. Archives (see
+# partitions.py) are not part of the backups since they do not change after they have been created.
+
+
+# Globals
+#===================================================================================================
+KEEP_BACKUPS = 5
+
+BACKUP_PAGES_PER_STEP = 1024
+BACKUP_SLEEP_SECONDS = 0.001
+
+# Tables that are included in the watermark by content. Changes to all other tables either go
+# through transaction_records (and are journaled in transaction_changes) or are derived from it.
+WATERMARK_TABLES = [
+    "accounts",
+    "intervals",
+    "tag_rules",
+    "archives",
+]
+
+
+# Creating backups
+#===================================================================================================
+def default_backup_dir(conn):
+    db_file = conn.execute("select file from pragma_database_list where name = 'main'").fetchone()[0]
+    if not db_file:
+        return None
+
+    return db_file + ".backups"
+
+
+# Returns a value that changes whenever the database is changed
+def compute_watermark(conn):
+    row = conn.execute(
+        """select
+            (select coalesce(max(id), 0) from main.transaction_records),
+            (select coalesce(max(seq), 0) from main.sqlite_sequence where name = 'transaction_changes')"""
+    ).fetchone()
+
+    digest = hashlib.sha1()
+    for table in WATERMARK_TABLES:
+        for r in sorted(repr(tuple(r)) for r in conn.execute(f"select * from main.{table}")):
+            digest.update(r.encode())
+
+    return {"max_id": row[0], "max_change_seq": row[1], "tables": digest.hexdigest()}
+
+
+# Creates a backup of the database unless it has not changed since the most recent backup. Returns
+# the name of the new backup, or None. If `keep` is None, no backups are deleted.
+def create_backup(conn, backup_dir = None, keep = KEEP_BACKUPS, label = ""):
+    if backup_dir == None:
+        backup_dir = default_backup_dir(conn)
+    if backup_dir == None or keep == 0:
+        return None
+
+    watermark = compute_watermark(conn)
+    backups = list_backups(backup_dir)
+    if backups and backups[-1]["watermark"] == watermark:
+        return None
+
+    os.makedirs(backup_dir, exist_ok=True)
+    name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    filename = os.path.join(backup_dir, name + ".db")
+    if os.path.exists(filename + ".tmp"):
+        os.remove(filename + ".tmp")
+
+    dest = sqlite3.connect(filename + ".tmp")
+    try:
+        conn.backup(dest, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_SLEEP_SECONDS)
+    finally:
+        dest.close()
+    os.replace(filename + ".tmp", filename)
+
+    meta_filename = os.path.join(backup_dir, name + ".json")
+    with open(meta_filename + ".tmp", "w") as f:
+        json.dump({
+            "name": name,
+            "created_at": datetime.datetime.now().isoformat(" ", "seconds"),
+            "label": label,
+            "watermark": watermark,
+        }, f)
+    os.replace(meta_filename + ".tmp", meta_filename)
+
+    if keep != None:
+        prune_backups(backup_dir, keep)
+
+    return name
+
+
+# Returns the metadata of all backups, oldest first
+def list_backups(backup_dir):
+    if not os.path.isdir(backup_dir):
+        return []
+
+    backups = []
+    for filename in sorted(os.listdir(backup_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext != ".json" or not os.path.exists(os.path.join(backup_dir, name + ".db")):
+            continue
+
+        with open(os.path.join(backup_dir, filename)) as f:
+            backups.append(json.load(f))
+
+    return backups
+
+
+def prune_backups(backup_dir, keep):
+    backups = list_backups(backup_dir)
+    for b in backups[:max(len(backups) - keep, 0)]:
+        os.remove(os.path.join(backup_dir, b["name"] + ".db"))
+        os.remove(os.path.join(backup_dir, b["name"] + ".json"))
+
+
+# Restoring backups
+#===================================================================================================
+# Replaces the contents of the database with the backup `name` (or the most recent one). The current
+# state is backed up first, so restoring can be undone as well. Must not be called within a
+# transaction.
+def restore_backup(conn, name = None, backup_dir = None):
+    if conn.in_transaction:
+        raise RuntimeError("Cannot restore a backup within a transaction")
+    if backup_dir == None:
+        backup_dir = default_backup_dir(conn)
+
+    backups = list_backups(backup_dir) if backup_dir != None else []
+    if name != None:
+        backups = [b for b in backups if b["name"] == name]
+    if not backups:
+        raise RuntimeError("Backup not found: " + (name or "no backups exist"))
+    backup = backups[-1]
+
+    # Not pruned so that the backup that is about to be restored is not deleted
+    create_backup(conn, backup_dir, keep=None, label="before restoring " + backup["name"])
+
+    src = sqlite3.connect(os.path.join(backup_dir, backup["name"] + ".db"))
+    try:
+        src.backup(conn, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_SLEEP_SECONDS)
+    finally:
+        src.close()
+
+    return backup
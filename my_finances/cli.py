@@ -3,13 +3,12 @@ import os
 import tempfile
 import sqlite3
 import datetime
-import shutil
 import ntplib
 from zoneinfo import ZoneInfo
 import json
 from pprint import pprint
 
-from . import logic
+from . import logic, raw_archive, rebuild, export, tags, recurring, money, partitions, backups, planner, server
 from .backend_aqbanking import aqbanking_fetch_transactions
 from .backend_fints import fints_fetch_transactions
 from .backend_csv import csv_fetch_transactions
@@ -17,8 +16,6 @@ from .backend_csv import csv_fetch_transactions
 
 # Globals
 #===================================================================================================
-OVERLAP_DAYS = 4
-
 BACKENDS = [
     "aqbanking",
     "fints",
@@ -48,6 +45,22 @@ def get_date_via_ntp():
     return str(d.date())
 
 
+# Returns the local date after making sure that it matches the date from the NTP server. The check
+# is only done once per day and process (see "checked_date" in parse_import_arguments()).
+def check_local_date(options):
+    today = str(datetime.date.today())
+    if options["checked_date"] == today:
+        return today
+
+    server_date = get_date_via_ntp()
+    if today != server_date:
+        # This shouldn't be a hard error. Let the user decide whether they want to continue.
+        raise RuntimeError(f"Local date {today} does not match date from server {server_date}")
+
+    options["checked_date"] = today
+    return today
+
+
 def backend_for_account(account, options):
     if account["preferred_backend"]:
         return account["preferred_backend"]
@@ -63,18 +76,23 @@ def backend_fetch_transactions(cursor, account, from_date, to_date, temp_dir, op
         backend_config[backend] = {}
 
     if backend == "aqbanking":
-        transactions = aqbanking_fetch_transactions(account, from_date, to_date, temp_dir, backend_config[backend], options)
+        transactions, balances = aqbanking_fetch_transactions(account, from_date, to_date, temp_dir, backend_config[backend], options)
     elif backend == "fints":
-        transactions = fints_fetch_transactions(account, from_date, to_date, temp_dir, backend_config[backend], options)
+        transactions, balances = fints_fetch_transactions(account, from_date, to_date, temp_dir, backend_config[backend], options)
     elif backend == "csv":
-        transactions = csv_fetch_transactions(account, from_date, to_date, temp_dir, backend_config[backend], options)
+        transactions, balances = csv_fetch_transactions(account, from_date, to_date, temp_dir, backend_config[backend], options)
+
+    # Archived together with the raw data of the backend
+    if balances:
+        with open(os.path.join(temp_dir, raw_archive.BALANCES_FILENAME), "w") as f:
+            json.dump(balances, f)
 
     cursor.execute(
         "update accounts set backend_config = :config where account_number = :account",
         {"account": account["account_number"], "config": json.dumps(backend_config)}
     ).fetchall()
 
-    return transactions, backend
+    return transactions, balances, backend
 
 
 def validate_import_start_date(cursor, account, start_date):
@@ -89,7 +107,7 @@ def validate_import_start_date(cursor, account, start_date):
     start_date_obj = datetime.date.fromisoformat(start_date)
     for i in intervals:
         delta = datetime.date.fromisoformat(i["end_date"]) - start_date_obj
-        if delta.days < OVERLAP_DAYS:
+        if delta.days < planner.OVERLAP_DAYS:
             raise RuntimeError("start date does not satisfy overlap window")
 
 
@@ -105,53 +123,47 @@ def validate_import_end_date(cursor, account, end_date):
     end_date_obj = datetime.date.fromisoformat(end_date)
     for i in intervals:
         delta = end_date_obj - datetime.date.fromisoformat(i["start_date"])
-        if delta.days < OVERLAP_DAYS:
+        if delta.days < planner.OVERLAP_DAYS:
             raise RuntimeError("end date does not satisfy overlap window")
 
 
 # Commands
 #===================================================================================================
 def import_transactions(conn, account, options):
+    backups.create_backup(conn, options["backup_dir"], options["keep_backups"], "import " + account["account_number"])
+
     cursor = conn.cursor()
-    check_consistency(cursor)
+    logic.check_consistency(cursor)
 
+    print("== Account " + account["account_number"])
     if options["derive_dates"]:
-        fetch_start_date = None
-        fetch_end_date = None
+        ranges = [(None, None)]
     else:
-        fetch_start_date = options["start_date"]
-        if fetch_start_date:
-            validate_import_start_date(cursor, account, fetch_start_date)
+        today = check_local_date(options)
+
+        if options["start_date"]:
+            validate_import_start_date(cursor, account, options["start_date"])
+            ranges = [(options["start_date"], today)]
         else:
-            fetch_start_date = cursor.execute(
-                "select max(end_date) as max_date from intervals where account_number = :account",
-                {"account": account["account_number"]}
-            ).fetchone()["max_date"]
-
-            # Fetch transactions starting from OVERLAP_DAYS days before the most recent known transaction.
-            # Why not just use most_recent_date directly?
-            # - Beacuse I've read that sometimes, transactions may be inserted
-            #   after the fact, and I want to detect that.
-            # - Also, this ensures that we can detect when a bank refuses to
-            #   return transactions that are too old. For example:
-            #   - Postbank does not return transactions older than 3 months, but also does not throw
-            #     and error if you try to do that. So if you requests transactions for the last 4
-            #     months, Postbank will silently skip any transactions that are too old.
-            #   - Since we require the list of new transactions to overlap with the existing
-            #     transactions, we can detect this case.
-            #   - The only thing we can do in this case is to create two disjoint `intervals` with a
-            #     whole inbetween. TODO I'm not doing this yet
-            if fetch_start_date != None:
-                fetch_start_date = str(datetime.date.fromisoformat(fetch_start_date) - datetime.timedelta(days=OVERLAP_DAYS))
-
-        fetch_end_date = str(datetime.date.today())
-        server_date = get_date_via_ntp()
-        if fetch_end_date != server_date:
-            # This shouldn't be a hard error. Let the user decide whether they want to continue.
-            raise RuntimeError(f"Local date {fetch_end_date} does not match date from server {server_date}")
+            # Fetch everything that is missing since the last import, plus all holes between intervals
+            # that the bank still provides (see planner.py)
+            plan = plan_account_import(cursor, account, today, options)
+            for start_date, end_date in plan["unreachable"]:
+                print(f"Warning: transactions between {start_date} and {end_date} are no longer provided by the bank")
+            ranges = [(r["start_date"], r["end_date"]) for r in plan["requests"]]
+
+    num_new_trans = 0
+    for fetch_start_date, fetch_end_date in ranges:
+        num_new_trans += import_date_range(cursor, account, fetch_start_date, fetch_end_date, options)
+
+    logic.check_consistency(cursor)
+    cursor.close()
+    conn.commit()
 
+    return num_new_trans
 
-    print("== Account " + account["account_number"])
+
+def import_date_range(cursor, account, fetch_start_date, fetch_end_date, options):
     if fetch_start_date and fetch_end_date:
         print(f"Importing transactions between {fetch_start_date} and {fetch_end_date}") 
     elif fetch_end_date:
@@ -162,8 +174,9 @@ def import_transactions(conn, account, options):
         print(f"Importing all available transactions until {fetch_end_date}")
 
 
+    num_new_trans = 0
     with tempfile.TemporaryDirectory() as temp_dir:
-        transactions, backend = backend_fetch_transactions(cursor, account, fetch_start_date, fetch_end_date, temp_dir, options)
+        transactions, balances, backend = backend_fetch_transactions(cursor, account, fetch_start_date, fetch_end_date, temp_dir, options)
 
         # In order to insert the transactions we need a concrete start date. If fetch_start_date is
         # None, then the start date depends on how the bank handles the case when no start date is
@@ -180,46 +193,66 @@ def import_transactions(conn, account, options):
 
         # TODO If fetch_start_date != None and there do not exist any transactions in the DB then we
         #      have no way of knowing if the list of transactions returned from the bank has been
-        #      truncated (see comment above on why we use OVERLAP_DAYS). In this case, the only safe
-        #      thing seems to be to set fetch_start_date = transactions[0]["entry_date"]
+        #      truncated (see comment in planner.py on why we use OVERLAP_DAYS). In this case, the only
+        #      safe thing seems to be to set fetch_start_date = transactions[0]["entry_date"]
 
         # If fetch_start_date is still None it means that there are no transactions in the database
         # and no new transactions have been fetched. Since we don't have a start date in this case
         # we simply to nothing.
         if fetch_start_date != None:
             fetched = datetime.datetime.utcnow().isoformat(" ")
-            num_new_trans = insert_transactions(
+            num_new_trans = logic.insert_transactions(
                 cursor, account, transactions, fetch_start_date, fetch_end_date, backend, fetched,
-                options["lenient_validation"]
+                options["lenient_validation"], balances=balances
             )
             print(f"Fetched {num_new_trans} new transactions")
-
-            # In we have inserted at least one transaction, copy the raw transaction data to
-            # options["raw_import_dir"]
+            for c in logic.checkpoint_differences(cursor, account["account_number"]):
+                print(
+                    f"Warning: the bank reports a balance of {money.fmt_money(c['reported_balance'])} at the end of " +
+                    f"{c['date']}, but the transactions add up to {money.fmt_money(c['computed_balance'])}"
+                )
+
+            # If we have inserted at least one transaction, store the raw transaction data in the
+            # archive at options["raw_import_dir"]
             if num_new_trans > 0:
-                with open(os.path.join(temp_dir, "info.ini"), "w") as info_file:
-                    info_file.write(f"imported = {fetched}\n")
-                    info_file.write(f"backend = {backend}\n")
-                    info_file.write(f"start_date = {fetch_start_date}\n")
-                    info_file.write(f"end_date = {fetch_end_date}\n") # End date is assumed to be incomplete
+                raw_archive.archive_import(
+                    options["raw_import_dir"], temp_dir, account["account_number"],
+                    backend, fetched, fetch_start_date, fetch_end_date # End date is assumed to be incomplete
+                )
+
+    return num_new_trans
 
-                dest_dir = os.path.join(options["raw_import_dir"],
-                                        account["account_number"] + "__" + fetched)
-                shutil.copytree(temp_dir, dest_dir)
 
-    check_consistency(cursor)
+def plan_account_import(cursor, account, today, options):
+    backend = backend_for_account(account, options)
+    return planner.plan_account(
+        cursor, account["account_number"], today,
+        planner.history_days(account, backend), options["backfill_from"]
+    )
+
+
+def show_import_plan(conn, accounts, options):
+    cursor = conn.cursor()
+    today = str(datetime.date.today())
+    for account in accounts:
+        plan = plan_account_import(cursor, account, today, options)
+        print("== Account " + account["account_number"])
+        for r in plan["requests"]:
+            gaps = ", ".join(f"{start_date or '...'} - {end_date}" for start_date, end_date in r["gaps"])
+            print(f"fetch {r['start_date'] or '(all available)'} - {r['end_date']}  fills {gaps}")
+        for start_date, end_date in plan["unreachable"]:
+            print(f"unreachable {start_date} - {end_date}")
     cursor.close()
-    conn.commit()
 
 
 def validate_transactions(conn, account, options):
     cursor = conn.cursor()
-    check_consistency(cursor)
+    logic.check_consistency(cursor)
 
     fetch_start_date = options["start_date"]
     fetch_end_date = options["end_date"]
     with tempfile.TemporaryDirectory() as temp_dir:
-        transactions, _ = backend_fetch_transactions(cursor, account, fetch_start_date, fetch_end_date, temp_dir, options)
+        transactions, _, _ = backend_fetch_transactions(cursor, account, fetch_start_date, fetch_end_date, temp_dir, options)
 
     if not fetch_start_date and transactions:
         fetch_start_date = transactions[0]["entry_date"]
@@ -228,7 +261,7 @@ def validate_transactions(conn, account, options):
 
     if fetch_start_date:
         print(f"Validating transactions from {fetch_start_date} to {fetch_end_date} using backend {options['backend']}")
-        validate_new_transactions(cursor, account, transactions, fetch_start_date, fetch_end_date, options["lenient_validation"])
+        logic.validate_new_transactions(cursor, account, transactions, fetch_start_date, fetch_end_date, options["lenient_validation"])
     else:
         print("Error: Could not determine start date and/or end date")
 
@@ -238,17 +271,21 @@ def validate_transactions(conn, account, options):
 
 def fetch_transactions(conn, account, options):
     cursor = conn.cursor()
-    check_consistency(cursor)
+    logic.check_consistency(cursor)
 
     fetch_start_date = options.get("start_date")
     fetch_end_date = options["end_date"]
 
     with tempfile.TemporaryDirectory() as temp_dir:
-        transactions, _ = backend_fetch_transactions(
+        transactions, _, _ = backend_fetch_transactions(
             cursor, account, options.get("start_date"), options.get("end_date"), temp_dir, options
         )
 
-    pprint(transactions)
+    if options["format"] == "jsonl":
+        for t in transactions:
+            print(json.dumps(t.to_dict(), ensure_ascii=False))
+    else:
+        pprint([t.to_dict() for t in transactions])
 
     cursor.close()
     conn.commit()
@@ -256,12 +293,192 @@ def fetch_transactions(conn, account, options):
 
 def process_transactions(conn, account, options):
     cursor = conn.cursor()
-    check_consistency(cursor)
-    match_transactions(cursor)
+    logic.check_consistency(cursor)
+    logic.match_transactions(cursor)
     cursor.close()
     conn.commit()
 
 
+def rebuild_database(conn, options):
+    num_imports, num_trans = rebuild.rebuild_database(
+        conn, options["output"], options["raw_import_dir"],
+        options["lenient_validation"], options["processes"]
+    )
+    print(f"Rebuilt {options['output']} from {num_imports} imports with {num_trans} transactions")
+
+
+def export_transactions(conn, options):
+    filename = options["output"]
+    if options["format"] == "parquet":
+        if filename == None:
+            fatal("Error: exporting to parquet requires --output")
+        out = open(filename, "wb")
+    elif filename == None:
+        out = sys.stdout
+    else:
+        out = open(filename, "w", newline="", encoding="utf-8")
+
+    partitions.attach_archives(conn)
+    try:
+        count = export.export_transactions(
+            conn, out, options["format"],
+            options["accounts"], options["start_date"], options["end_date"],
+            options["with_matches"], options["with_accounts"]
+        )
+    finally:
+        if out != sys.stdout:
+            out.close()
+        partitions.detach_archives(conn)
+
+    print(f"Exported {count} transactions", file=sys.stderr)
+
+
+def tag_transactions(conn, options):
+    # The tags of the archived transactions are updated as well
+    partitions.attach_archives(conn)
+    cursor = conn.cursor()
+    try:
+        for rule_id in options["delete_rules"]:
+            tags.delete_rule(cursor, rule_id)
+        for rule in options["add_rules"]:
+            tags.add_rule(cursor, **rule)
+
+        if options["delete_rules"] or options["add_rules"] or options["retag"]:
+            logic.retag_transactions(cursor)
+        conn.commit()
+
+        for r in tags.rule_stats(cursor):
+            print(f"{r['id']:>5}  {r['tag']:<20} {r['field']:<18} {r['kind']:<5} prio={r['priority']:<4} hits={r['hits']:<6} {r['pattern']}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        partitions.detach_archives(conn)
+
+
+def show_recurring_payments(conn, options):
+    cursor = conn.cursor()
+    if options["rebuild"]:
+        # The series may reach back into archived years
+        partitions.attach_archives(conn)
+        try:
+            recurring.rebuild_series(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            partitions.detach_archives(conn)
+
+    today = str(datetime.date.today())
+    if options["missing"]:
+        series = recurring.missing_payments(cursor, today)
+    else:
+        series = cursor.execute("select * from recurring_series order by account_number, typical_value").fetchall()
+
+    for s in series:
+        print("{:<30} {:<30} {:<12} {:>12} last={} next={}{}".format(
+            s["account_number"], s["remote_name"][:30], s["period"], money.fmt_money(s["typical_value"]),
+            s["last_date"], s["next_expected_date"],
+            "  MISSING" if s["overdue_date"] < today else ""
+        ))
+    cursor.close()
+
+
+def show_foreign_currencies(conn, options):
+    partitions.attach_archives(conn)
+    cursor = conn.cursor()
+    totals = logic.foreign_currency_totals(cursor, options["account"], options["start_date"], options["end_date"])
+    for t in totals:
+        print("{:<5} {:>6} transactions {:>16} {:>14}  rate={} now={}".format(
+            t["original_currency"], t["num_transactions"],
+            money.fmt_money(t["original_total"], " " + t["original_currency"]), money.fmt_money(t["booked_total"]),
+            "-" if t["effective_rate"] == None else money.fmt_rate(t["effective_rate"]),
+            "-" if t["converted_total"] == None else money.fmt_money(t["converted_total"])
+        ))
+    cursor.close()
+    partitions.detach_archives(conn)
+
+
+def archive_transactions(conn, options):
+    if options["until_year"] != None:
+        years = partitions.archive_years(conn, options["until_year"])
+        print(f"Archived {len(years)} years", file=sys.stderr)
+
+    if options["check"]:
+        partitions.attach_archives(conn)
+        cursor = conn.cursor()
+        logic.check_consistency(cursor)
+        partitions.check_partition_consistency(cursor)
+        cursor.close()
+        partitions.detach_archives(conn)
+
+    for a in conn.execute("select * from archives order by year").fetchall():
+        print(f"{a['year']}  {a['num_transactions']:>8} transactions  {a['filename']}  (archived at {a['archived_at']})")
+
+
+def restore_backup(conn, options):
+    if options["list"]:
+        backup_dir = backups.default_backup_dir(conn)
+        for b in backups.list_backups(backup_dir):
+            print(f"{b['name']}  {b['created_at']}  {b['label']}")
+        return
+
+    backup = backups.restore_backup(conn, options["name"])
+    print(f"Restored backup {backup['name']} ({backup['label']})", file=sys.stderr)
+
+
+def check_checkpoints(conn, options):
+    cursor = conn.cursor()
+    num_checkpoints = cursor.execute(
+        "select count(*) from balance_checkpoints where :account is null or account_number = :account",
+        {"account": options["account"]}
+    ).fetchone()[0]
+    differences = logic.checkpoint_differences(cursor, options["account"])
+    for c in differences:
+        print("{}  {}  bank={:>14}  transactions={:>14}  difference={:>14}".format(
+            c["account_number"], c["date"], money.fmt_money(c["reported_balance"]),
+            money.fmt_money(c["computed_balance"]), money.fmt_money(c["reported_balance"] - c["computed_balance"])
+        ))
+    cursor.close()
+
+    if differences:
+        fatal(f"{len(differences)} of {num_checkpoints} balance checkpoints do not match the transactions")
+    print(f"All {num_checkpoints} balance checkpoints match the transactions", file=sys.stderr)
+
+
+def undo_import(conn, options):
+    cursor = conn.cursor()
+    if options["list"]:
+        for b in cursor.execute("select * from import_batches order by id").fetchall():
+            print(
+                f"{b['id']:>6}  {b['account_number']}  {b['backend']}  {b['start_date']} - {b['end_date']}  " +
+                f"{b['num_transactions']:>5} transactions  (fetched at {b['fetched_at']})"
+            )
+        cursor.close()
+        return
+
+    backups.create_backup(conn, options["backup_dir"], options["keep_backups"], f"undo {options['batch_id']}")
+    try:
+        batches = logic.undo_import_batch(cursor, options["batch_id"])
+        logic.check_consistency(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    # The raw data of the undone imports must not be replayed when rebuilding the database
+    for batch in batches:
+        raw_archive.remove_import(options["raw_import_dir"], batch["account_number"], batch["fetched_at"])
+    batch = batches[0]
+    print(f"Removed {batch['num_transactions']} transactions of import {batch['id']} ({batch['account_number']})", file=sys.stderr)
+    if len(batches) > 1:
+        print(f"Also removed the following imports without new transactions: {', '.join(str(b['id']) for b in batches[1:])}", file=sys.stderr)
+
+
 # Parsing command-line arguments
 #===================================================================================================
 def parse_arguments():
@@ -277,6 +494,30 @@ def parse_arguments():
         return parse_validate_fetch_arguments("fetch")
     elif command == "process":
         return parse_process_arguments()
+    elif command == "rebuild":
+        return parse_rebuild_arguments()
+    elif command == "export":
+        return parse_export_arguments()
+    elif command == "tag":
+        return parse_tag_arguments()
+    elif command == "recurring":
+        return parse_recurring_arguments()
+    elif command == "currencies":
+        return parse_currencies_arguments()
+    elif command == "archive":
+        return parse_archive_arguments()
+    elif command == "restore":
+        return parse_restore_arguments()
+    elif command == "undo":
+        return parse_undo_arguments()
+    elif command == "plan":
+        return parse_plan_arguments()
+    elif command == "checkpoints":
+        return parse_checkpoints_arguments()
+    elif command == "serve":
+        return parse_serve_arguments()
+    elif command == "ctl":
+        return parse_ctl_arguments()
     else:
         fatal("Invalid command: " + command)
 
@@ -292,6 +533,8 @@ def parse_import_arguments():
         # Whether to derive start_date and end_date from the retrieved transactions. By default,
         # start_date is 4 days before the last import date, and end_date is today.
         "derive_dates": False,
+        # Also fetch the transactions from this date until the first known transaction (see planner.py)
+        "backfill_from": None,
         "lenient_validation": False,
         # Where to store the raw transaction data that is fetched from the bank. The directory is relative
         # to the directory this script is executed in.
@@ -300,6 +543,11 @@ def parse_import_arguments():
         # needs). If I later decide I need these additional fields, then the original data still
         # available.
         "raw_import_dir": "./raw_import_data",
+        # The database is backed up before each import (see backups.py). None means <db_file>.backups.
+        "backup_dir": None,
+        "keep_backups": backups.KEEP_BACKUPS,
+        # The last date that has been checked against the NTP server (see check_local_date())
+        "checked_date": None,
     }
 
     idx = 2
@@ -320,6 +568,9 @@ def parse_import_arguments():
             idx += 1
         elif arg == "--derive-dates":
             options["derive_dates"] = True
+        elif arg == "--backfill-from":
+            options["backfill_from"] = str(datetime.date.fromisoformat(sys.argv[idx]))
+            idx += 1
         elif arg == "--csv":
             options["csv_filename"] = sys.argv[idx]
             options["backend"] = "csv"
@@ -327,6 +578,9 @@ def parse_import_arguments():
             idx += 1
         elif arg == "--lenient-validation":
             options["lenient_validation"] = True
+        elif arg == "--keep-backups":
+            options["keep_backups"] = int(sys.argv[idx])
+            idx += 1
         else:
             if options["db_file"] != None:
                 raise RuntimeError("Error: invalid option: " + arg)
@@ -348,6 +602,8 @@ def parse_validate_fetch_arguments(command):
         "end_date": None,
         "csv_filename": None,
         "lenient_validation": False,
+        # Only used by fetch. Either "pprint" or "jsonl"
+        "format": "pprint",
     }
 
     idx = 2
@@ -375,6 +631,12 @@ def parse_validate_fetch_arguments(command):
             idx += 1
         elif arg == "--lenient-validation":
             options["lenient_validation"] = True
+        elif arg == "--format" and command == "fetch":
+            fmt = sys.argv[idx]
+            if fmt not in ["pprint", "jsonl"]:
+                fatal("Invalid format: " + fmt)
+            options["format"] = fmt
+            idx += 1
         else:
             if options["db_file"] != None:
                 raise RuntimeError("Error: invalid option: " + arg)
@@ -406,19 +668,488 @@ def parse_process_arguments():
     return options
 
 
+def parse_rebuild_arguments():
+    options = {
+        "command": "rebuild",
+        "db_file": None,
+        # The new database. Accounts are copied from db_file, transactions are taken from
+        # raw_import_dir
+        "output": None,
+        "raw_import_dir": "./raw_import_data",
+        "lenient_validation": False,
+        # Number of worker processes used for parsing. None means one per CPU
+        "processes": None,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--output":
+            options["output"] = sys.argv[idx]
+            idx += 1
+        elif arg == "--raw-import-dir":
+            options["raw_import_dir"] = sys.argv[idx]
+            idx += 1
+        elif arg == "--processes":
+            options["processes"] = int(sys.argv[idx])
+            idx += 1
+        elif arg == "--lenient-validation":
+            options["lenient_validation"] = True
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+    if options["output"] == None:
+        fatal("Error: --output is not set")
+
+    return options
+
+
+def parse_export_arguments():
+    options = {
+        "command": "export",
+        "db_file": None,
+        "format": "csv",
+        # If not set, the export is written to stdout (not supported for parquet)
+        "output": None,
+        "accounts": set(), # Empty means all accounts
+        "start_date": None,
+        "end_date": None,
+        # Add columns describing the matching transaction
+        "with_matches": False,
+        # Add columns from the accounts table
+        "with_accounts": False,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--format":
+            fmt = sys.argv[idx]
+            if fmt not in export.EXPORT_FORMATS:
+                fatal("Invalid format: " + fmt)
+            options["format"] = fmt
+            idx += 1
+        elif arg == "--output":
+            options["output"] = sys.argv[idx]
+            idx += 1
+        elif arg == "--account":
+            options["accounts"].add(sys.argv[idx])
+            idx += 1
+        elif arg == "--start-date":
+            options["start_date"] = str(datetime.date.fromisoformat(sys.argv[idx]))
+            idx += 1
+        elif arg == "--end-date":
+            options["end_date"] = str(datetime.date.fromisoformat(sys.argv[idx]))
+            idx += 1
+        elif arg == "--with-matches":
+            options["with_matches"] = True
+        elif arg == "--with-accounts":
+            options["with_accounts"] = True
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+# Manages the tag rules and prints them together with the number of transactions they have tagged.
+# Usage: tag DB_FILE [--add TAG FIELD KIND PATTERN] [--priority N] [--delete RULE_ID] [--retag]
+def parse_tag_arguments():
+    options = {
+        "command": "tag",
+        "db_file": None,
+        "add_rules": [],
+        "delete_rules": [],
+        # Retag all transactions even if no rule has been changed
+        "retag": False,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--add":
+            tag, field, kind, pattern = sys.argv[idx:idx + 4]
+            if field not in tags.TAG_FIELDS:
+                fatal("Invalid field: " + field)
+            if kind not in tags.RULE_KINDS:
+                fatal("Invalid kind: " + kind)
+            options["add_rules"].append({"tag": tag, "field": field, "kind": kind, "pattern": pattern, "priority": 0})
+            idx += 4
+        elif arg == "--priority":
+            # Applies to the preceding --add
+            if not options["add_rules"]:
+                fatal("Error: --priority must follow --add")
+            options["add_rules"][-1]["priority"] = int(sys.argv[idx])
+            idx += 1
+        elif arg == "--delete":
+            options["delete_rules"].append(int(sys.argv[idx]))
+            idx += 1
+        elif arg == "--retag":
+            options["retag"] = True
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+# Lists the detected recurring payments. Usage: recurring DB_FILE [--missing] [--rebuild]
+def parse_recurring_arguments():
+    options = {
+        "command": "recurring",
+        "db_file": None,
+        # Only show series whose next payment is overdue
+        "missing": False,
+        # Redetect all series (e.g., after changing the parameters in recurring.py)
+        "rebuild": False,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--missing":
+            options["missing"] = True
+        elif arg == "--rebuild":
+            options["rebuild"] = True
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+# Sums up the transactions in foreign currencies.
+# Usage: currencies DB_FILE [--account ACCOUNT] [--start-date DATE] [--end-date DATE]
+def parse_currencies_arguments():
+    options = {
+        "command": "currencies",
+        "db_file": None,
+        "account": None,
+        "start_date": None,
+        "end_date": None,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--account":
+            options["account"] = sys.argv[idx]
+            idx += 1
+        elif arg == "--start-date":
+            options["start_date"] = str(datetime.date.fromisoformat(sys.argv[idx]))
+            idx += 1
+        elif arg == "--end-date":
+            options["end_date"] = str(datetime.date.fromisoformat(sys.argv[idx]))
+            idx += 1
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+# Moves the transactions of closed years into separate files (see partitions.py) and lists the
+# archives. Usage: archive DB_FILE [--until YEAR] [--check]
+def parse_archive_arguments():
+    options = {
+        "command": "archive",
+        "db_file": None,
+        # Archive all years up to and including this one
+        "until_year": None,
+        # Check the consistency of all partitions
+        "check": False,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--until":
+            options["until_year"] = int(sys.argv[idx])
+            idx += 1
+        elif arg == "--check":
+            options["check"] = True
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+# Restores a backup that has been made before an import (by default the most recent one), or lists
+# the backups. Usage: restore DB_FILE [--list] [BACKUP_NAME]
+def parse_restore_arguments():
+    options = {
+        "command": "restore",
+        "db_file": None,
+        "name": None,
+        "list": False,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--list":
+            options["list"] = True
+        elif options["db_file"] == None:
+            options["db_file"] = arg
+        elif options["name"] == None:
+            options["name"] = arg
+        else:
+            raise RuntimeError("Error: invalid option: " + arg)
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+# Undoes an import (only the most recent one of each account), or lists the imports.
+# Usage: undo DB_FILE [--list] [--raw-import-dir DIR] [--keep-backups N] [BATCH_ID]
+def parse_undo_arguments():
+    options = {
+        "command": "undo",
+        "db_file": None,
+        "batch_id": None,
+        "list": False,
+        "raw_import_dir": "./raw_import_data",
+        "backup_dir": None,
+        "keep_backups": backups.KEEP_BACKUPS,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--list":
+            options["list"] = True
+        elif arg == "--raw-import-dir":
+            options["raw_import_dir"] = sys.argv[idx]
+            idx += 1
+        elif arg == "--keep-backups":
+            options["keep_backups"] = int(sys.argv[idx])
+            idx += 1
+        elif options["db_file"] == None:
+            options["db_file"] = arg
+        elif options["batch_id"] == None:
+            options["batch_id"] = int(arg)
+        else:
+            raise RuntimeError("Error: invalid option: " + arg)
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+    if options["batch_id"] == None and not options["list"]:
+        fatal("Error: batch_id is not set")
+
+    return options
+
+
+# Shows which date ranges the next import would fetch (see planner.py).
+# Usage: plan DB_FILE [--account ACCOUNT] [--backend BACKEND] [--backfill-from DATE]
+def parse_plan_arguments():
+    options = {
+        "command": "plan",
+        "db_file": None,
+        "backend": "aqbanking",
+        "accounts": set(), # Empty means all accounts
+        "backfill_from": None,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--backend":
+            backend = sys.argv[idx]
+            if backend not in BACKENDS:
+                fatal("Invalid backend: " + backend)
+            options["backend"] = backend
+            idx += 1
+        elif arg == "--account":
+            options["accounts"].add(sys.argv[idx])
+            idx += 1
+        elif arg == "--backfill-from":
+            options["backfill_from"] = str(datetime.date.fromisoformat(sys.argv[idx]))
+            idx += 1
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+# Compares the balances reported by the banks with the transactions (see
+# logic.checkpoint_differences()). Usage: checkpoints DB_FILE [--account ACCOUNT]
+def parse_checkpoints_arguments():
+    options = {
+        "command": "checkpoints",
+        "db_file": None,
+        "account": None,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--account":
+            options["account"] = sys.argv[idx]
+            idx += 1
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+def parse_serve_arguments():
+    options = {
+        "command": "serve",
+        "db_file": None,
+        "socket": "./my_finances.sock",
+        "backend": "aqbanking",
+        "accounts": set(), # Empty means all accounts
+        # How often to import the transactions of each account. Can be overriden per account via
+        # "schedule". An interval of 0 means that imports are only done on request.
+        "interval_hours": 24,
+        "schedule": {},
+        # The following are used for each import (see parse_import_arguments())
+        "start_date": None,
+        "derive_dates": False,
+        "backfill_from": None,
+        "lenient_validation": False,
+        "raw_import_dir": "./raw_import_data",
+        "backup_dir": None,
+        "keep_backups": backups.KEEP_BACKUPS,
+        "checked_date": None,
+        # Backend clients that are kept alive between imports
+        "fints_clients": {},
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--socket":
+            options["socket"] = sys.argv[idx]
+            idx += 1
+        elif arg == "--backend":
+            backend = sys.argv[idx]
+            if backend not in BACKENDS or backend == "csv":
+                fatal("Invalid backend: " + backend)
+            options["backend"] = backend
+            idx += 1
+        elif arg == "--account":
+            options["accounts"].add(sys.argv[idx])
+            idx += 1
+        elif arg == "--interval":
+            options["interval_hours"] = float(sys.argv[idx])
+            idx += 1
+        elif arg == "--schedule":
+            # Format: ACCOUNT=HOURS
+            acc, hours = sys.argv[idx].rsplit("=", 1)
+            options["schedule"][acc] = float(hours)
+            idx += 1
+        elif arg == "--lenient-validation":
+            options["lenient_validation"] = True
+        elif arg == "--keep-backups":
+            options["keep_backups"] = int(sys.argv[idx])
+            idx += 1
+        else:
+            if options["db_file"] != None:
+                raise RuntimeError("Error: invalid option: " + arg)
+            options["db_file"] = arg
+
+    if options["db_file"] == None:
+        fatal("Error: db_file is not set")
+
+    return options
+
+
+# Sends a command to a running server. Usage: ctl [--socket PATH] import [ACCOUNT] | status | timings | stop
+def parse_ctl_arguments():
+    options = {
+        "command": "ctl",
+        "socket": "./my_finances.sock",
+        "request": None,
+    }
+
+    idx = 2
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        idx += 1
+        if arg == "--socket":
+            options["socket"] = sys.argv[idx]
+            idx += 1
+        elif options["request"] == None:
+            options["request"] = {"command": arg}
+        elif options["request"]["command"] == "import" and "account" not in options["request"]:
+            options["request"]["account"] = arg
+        else:
+            raise RuntimeError("Error: invalid option: " + arg)
+
+    if options["request"] == None:
+        fatal("Error: no server command given")
+
+    return options
+
+
 # MAIN
 #===================================================================================================
 options = parse_arguments()
 
-conn = sqlite3.connect(options["db_file"])
+if options["command"] == "ctl":
+    response = server.send_server_command(options["socket"], options["request"])
+    print(json.dumps(response, indent=4))
+    sys.exit(0 if response["status"] == "ok" else 1)
+
+conn = sqlite3.connect(options["db_file"], cached_statements=256)
 conn.row_factory = sqlite3.Row
 conn.execute("PRAGMA foreign_keys = ON")
+# In WAL mode, readers (e.g., the GUI) are not blocked while we are writing
+conn.execute("PRAGMA journal_mode = WAL")
 
 cursor = conn.cursor()
-cursor.execute(db.DB_TAGS_TABLE)
-cursor.execute(db.DB_TRANSACTIONS_TABLE)
-cursor.execute(db.DB_ACCOUNTS_TABLE)
-cursor.execute(db.DB_INTERVALS_TABLE)
+logic.init_database(cursor)
+logic.prune_transaction_changes(cursor)
+conn.commit()
 
 
 accounts_res = cursor.execute(
@@ -431,6 +1162,46 @@ def process_account_row(row):
 accounts = [process_account_row(acc) for acc in accounts_res]
 
 
+if options["command"] == "rebuild":
+    rebuild_database(conn, options)
+    sys.exit(0)
+elif options["command"] == "export":
+    export_transactions(conn, options)
+    sys.exit(0)
+elif options["command"] == "tag":
+    tag_transactions(conn, options)
+    sys.exit(0)
+elif options["command"] == "recurring":
+    show_recurring_payments(conn, options)
+    sys.exit(0)
+elif options["command"] == "currencies":
+    show_foreign_currencies(conn, options)
+    sys.exit(0)
+elif options["command"] == "archive":
+    archive_transactions(conn, options)
+    sys.exit(0)
+elif options["command"] == "restore":
+    restore_backup(conn, options)
+    sys.exit(0)
+elif options["command"] == "undo":
+    undo_import(conn, options)
+    sys.exit(0)
+elif options["command"] == "checkpoints":
+    check_checkpoints(conn, options)
+    sys.exit(0)
+elif options["command"] == "plan":
+    show_import_plan(conn, [
+        acc for acc in accounts
+        if not options["accounts"] or acc["account_number"] in options["accounts"]
+    ], options)
+    sys.exit(0)
+elif options["command"] == "serve":
+    server.serve(conn, [
+        acc for acc in accounts
+        if not options["accounts"] or acc["account_number"] in options["accounts"]
+    ], options, import_transactions)
+    sys.exit(0)
+
 for acc in accounts:
     if options.get("accounts") and not acc["account_number"] in options["accounts"]:
         continue
@@ -1,3 +1,8 @@
+import re
+
+from . import money
+
+
 # Table: Accounts
 #===================================================================================================
 DB_ACCOUNTS_TABLE = """
@@ -40,14 +45,37 @@ DB_TRANSACTION_DATA_COLUMNS = [
     "cc_billing_ref",
 ]
 
+# Columns of a transaction that describe the other party. They are stored in `counterparties` so that
+# they are not repeated in every transaction.
+DB_COUNTERPARTY_COLUMNS = [
+    "remote_account",
+    "remote_name",
+    "creditor_scheme_id",
+]
+
+DB_COUNTERPARTIES_TABLE = """
+create table if not exists counterparties(
+    id integer,
+    remote_account text not null,
+    remote_name text not null,
+    creditor_scheme_id text not null,
+
+    constraint PK_counterparties__id primary key(id),
+    constraint UK_counterparties unique(remote_account, remote_name, creditor_scheme_id)
+)"""
+
+# The transactions are stored in `transaction_records`, which references the counterparty instead of
+# containing DB_COUNTERPARTY_COLUMNS. The view `transactions` (see below) joins both and has the same
+# columns that the transactions table had before, so all queries use the view. Code that writes
+# transactions should use transaction_records directly (e.g., because lastrowid does not work for
+# inserts into the view).
 DB_TRANSACTIONS_TABLE = """
-create table if not exists transactions(
+create table if not exists transaction_records(
     id integer,
 
     -- Data that comes from the bank
     local_account text not null,
-    remote_account text not null,
-    remote_name text not null,
+    counterparty_id integer,
     entry_date date not null,
     valuta_date date not null,
     value integer not null,
@@ -59,14 +87,13 @@ create table if not exists transactions(
 
     original_value integer,
     original_currency text,
-    exchange_rate text, -- TODO Should be fixed-point
+    exchange_rate integer, -- Fixed-point, scaled by money.RATE_SCALE
 
     transaction_key text not null,
     transaction_code text not null,
     transaction_text text not null,
 
     -- SEPA Lastschrift
-    creditor_scheme_id text not null,
     mandate_id text not null,
     end_to_end_ref text not null,
 
@@ -83,12 +110,286 @@ create table if not exists transactions(
     inserted_at datetime not null,
     inserted_by text not null,
 
+    -- Precomputed values used for displaying the transaction (see logic.display_columns()). They
+    -- are derived from the columns above when the transaction is inserted.
+    display_remote_name text,
+    display_account text,
+    display_value text,
+
+    -- The purpose with all whitespace removed (see logic.normalize_purpose()) and a 64-bit hash of
+    -- it, so that purposes can be compared without normalizing them again (see logic.compare_rows())
+    purpose_norm text,
+    purpose_hash integer,
+
+    -- Transactions with the same series key are candidates for a recurring payment (see
+    -- recurring.series_key())
+    series_key text,
+
+    -- Identifies the transaction by its content (see logic.assign_fingerprints()). Used to detect
+    -- transactions that already exist in the database.
+    fingerprint text,
+
+    -- The import that inserted the transaction (see import_batches)
+    batch_id integer,
+
     constraint PK_transactions__id primary key(id),
     constraint UK_transactions__total_order unique(local_account, total_order),
-    constraint FK_transactions__matching_txn foreign key(matching_txn) references transactions(id),
-    constraint FK_transactions__local_account foreign key(local_account) references accounts(account_number)
+    constraint FK_transactions__matching_txn foreign key(matching_txn) references transaction_records(id),
+    constraint FK_transactions__local_account foreign key(local_account) references accounts(account_number),
+    constraint FK_transactions__counterparty_id foreign key(counterparty_id) references counterparties(id),
+    constraint FK_transactions__batch_id foreign key(batch_id) references import_batches(id)
+)"""
+
+# Columns of transaction_records, used by the triggers of the `transactions` view
+DB_TRANSACTION_RECORD_COLUMNS = [
+    "id",
+    "local_account",
+    "counterparty_id",
+    "entry_date",
+    "valuta_date",
+    "value",
+    "currency",
+    "purpose",
+    "ultimate_debtor",
+    "ultimate_creditor",
+    "primanota",
+    "original_value",
+    "original_currency",
+    "exchange_rate",
+    "transaction_key",
+    "transaction_code",
+    "transaction_text",
+    "mandate_id",
+    "end_to_end_ref",
+    "cc_entry_ref",
+    "cc_billing_ref",
+    "matching_txn",
+    "total_order",
+    "inserted_at",
+    "inserted_by",
+    "display_remote_name",
+    "display_account",
+    "display_value",
+    "purpose_norm",
+    "purpose_hash",
+    "series_key",
+    "fingerprint",
+    "batch_id",
+]
+
+DB_TRANSACTIONS_VIEW = """
+create view if not exists transactions as
+select
+    t.id,
+    t.local_account,
+    c.remote_account,
+    c.remote_name,
+    t.entry_date,
+    t.valuta_date,
+    t.value,
+    t.currency,
+    t.purpose,
+    t.ultimate_debtor,
+    t.ultimate_creditor,
+    t.primanota,
+    t.original_value,
+    t.original_currency,
+    t.exchange_rate,
+    t.transaction_key,
+    t.transaction_code,
+    t.transaction_text,
+    c.creditor_scheme_id,
+    t.mandate_id,
+    t.end_to_end_ref,
+    t.cc_entry_ref,
+    t.cc_billing_ref,
+    t.matching_txn,
+    t.total_order,
+    t.inserted_at,
+    t.inserted_by,
+    t.display_remote_name,
+    t.display_account,
+    t.display_value,
+    t.purpose_norm,
+    t.purpose_hash,
+    t.series_key,
+    t.fingerprint,
+    t.counterparty_id,
+    t.batch_id
+from transaction_records t left join counterparties c on c.id = t.counterparty_id"""
+
+# Looks up the counterparty of new.* in the triggers below, creating it if necessary
+COUNTERPARTY_ID_OF_NEW = """(
+        select id from counterparties
+        where remote_account = new.remote_account and remote_name = new.remote_name and creditor_scheme_id = new.creditor_scheme_id
+    )"""
+
+DB_TRANSACTIONS_VIEW_INSERT_TRIGGER = """
+create trigger if not exists TR_transactions__view_insert instead of insert on transactions begin
+    insert or ignore into counterparties(remote_account, remote_name, creditor_scheme_id)
+    values(new.remote_account, new.remote_name, new.creditor_scheme_id);
+    insert into transaction_records({columns})
+    values({values});
+end""".format(
+    columns=", ".join(DB_TRANSACTION_RECORD_COLUMNS),
+    values=", ".join(COUNTERPARTY_ID_OF_NEW if c == "counterparty_id" else "new." + c for c in DB_TRANSACTION_RECORD_COLUMNS)
+)
+
+DB_TRANSACTIONS_VIEW_UPDATE_TRIGGER = """
+create trigger if not exists TR_transactions__view_update instead of update on transactions begin
+    insert or ignore into counterparties(remote_account, remote_name, creditor_scheme_id)
+    values(new.remote_account, new.remote_name, new.creditor_scheme_id);
+    update transaction_records set {assignments}
+    where id = old.id;
+end""".format(
+    assignments=", ".join(
+        c + " = " + (COUNTERPARTY_ID_OF_NEW if c == "counterparty_id" else "new." + c)
+        for c in DB_TRANSACTION_RECORD_COLUMNS
+    )
+)
+
+DB_TRANSACTIONS_VIEW_DELETE_TRIGGER = """
+create trigger if not exists TR_transactions__view_delete instead of delete on transactions begin
+    delete from transaction_records where id = old.id;
+end"""
+
+
+DB_TRANSACTIONS_ENTRY_DATE_INDEX = """
+create index if not exists IX_transactions__local_account_entry_date on transaction_records(local_account, entry_date)
+"""
+
+# Used by the GUI, which lists the transactions of all accounts ordered by date (see
+# gui.TransactionModel)
+DB_TRANSACTIONS_ORDER_INDEX = """
+create index if not exists IX_transactions__entry_date_total_order on transaction_records(entry_date, total_order)
+"""
+
+DB_TRANSACTIONS_SERIES_KEY_INDEX = """
+create index if not exists IX_transactions__series_key on transaction_records(local_account, series_key, entry_date)
+"""
+
+DB_TRANSACTIONS_FINGERPRINT_INDEX = """
+create unique index if not exists UK_transactions__fingerprint on transaction_records(fingerprint)
+"""
+
+DB_TRANSACTIONS_BATCH_ID_INDEX = """
+create index if not exists IX_transactions__batch_id on transaction_records(batch_id)
+"""
+
+# Used by the GUI for sorting
+DB_TRANSACTIONS_DISPLAY_REMOTE_NAME_INDEX = """
+create index if not exists IX_transactions__display_remote_name on transaction_records(display_remote_name)
+"""
+
+DB_TRANSACTIONS_VALUE_INDEX = """
+create index if not exists IX_transactions__value on transaction_records(value)
+"""
+
+
+# Table: Full-text search on transactions
+#===================================================================================================
+# An external content FTS5 index, i.e., the indexed text is only stored in `transactions` (i.e., in
+# transaction_records and counterparties). The triggers below keep it in sync.
+DB_TRANSACTIONS_FTS_TABLE = """
+create virtual table if not exists transactions_fts using fts5(
+    purpose,
+    remote_name,
+    remote_account,
+    content = 'transactions',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2',
+    -- Speeds up prefix queries, which are used for search-as-you-type
+    prefix = '2 3'
+)"""
+
+DB_TRANSACTIONS_FTS_INSERT_TRIGGER = """
+create trigger if not exists TR_transactions__fts_insert after insert on transaction_records begin
+    insert into transactions_fts(rowid, purpose, remote_name, remote_account)
+    select new.id, new.purpose, c.remote_name, c.remote_account
+    from counterparties c where c.id = new.counterparty_id;
+end"""
+
+DB_TRANSACTIONS_FTS_DELETE_TRIGGER = """
+create trigger if not exists TR_transactions__fts_delete after delete on transaction_records begin
+    insert into transactions_fts(transactions_fts, rowid, purpose, remote_name, remote_account)
+    select 'delete', old.id, old.purpose, c.remote_name, c.remote_account
+    from counterparties c where c.id = old.counterparty_id;
+end"""
+
+DB_TRANSACTIONS_FTS_UPDATE_TRIGGER = """
+create trigger if not exists TR_transactions__fts_update after update of id, purpose, counterparty_id on transaction_records begin
+    insert into transactions_fts(transactions_fts, rowid, purpose, remote_name, remote_account)
+    select 'delete', old.id, old.purpose, c.remote_name, c.remote_account
+    from counterparties c where c.id = old.counterparty_id;
+    insert into transactions_fts(rowid, purpose, remote_name, remote_account)
+    select new.id, new.purpose, c.remote_name, c.remote_account
+    from counterparties c where c.id = new.counterparty_id;
+end"""
+
+
+# Table: Import batches
+#===================================================================================================
+DB_IMPORT_BATCHES_TABLE = """
+-- One row per call of logic.insert_transactions(). The transactions that have been inserted reference
+-- their batch, and the state of the account before the import is stored so that the most recent
+-- import of an account can be undone (see logic.undo_import_batch()).
+create table if not exists import_batches(
+    id integer,
+    account_number text not null,
+    backend text not null,
+    -- The date range of the import (see `intervals`)
+    start_date date not null,
+    end_date date not null,
+    fetched_at datetime not null,
+    started_at datetime not null,
+    finished_at datetime,
+    num_transactions integer not null default 0,
+
+    -- State of the account before the import
+    previous_intervals text not null, -- JSON list of [start_date, end_date]
+    previous_initial_balance integer not null,
+
+    constraint PK_import_batches__id primary key(id),
+    constraint FK_import_batches__account_number foreign key(account_number) references accounts(account_number)
 )"""
 
+DB_IMPORT_BATCHES_ACCOUNT_INDEX = """
+create index if not exists IX_import_batches__account_number on import_batches(account_number, id)
+"""
+
+
+# Table: Transaction changes
+#===================================================================================================
+DB_TRANSACTION_CHANGES_TABLE = """
+-- A journal of all changes made to `transactions`, filled by the triggers below. It allows other
+-- processes (e.g., the GUI) to find out which transactions have changed since they last looked,
+-- by remembering the largest seq they have seen. Old entries are removed by
+-- logic.prune_transaction_changes(), so if the smallest seq in the table is larger than the last seq
+-- that has been seen, the reader has missed some changes.
+create table if not exists transaction_changes(
+    seq integer,
+    transaction_id integer not null,
+    kind text not null, -- insert, update or delete
+    changed_at datetime not null default current_timestamp,
+
+    constraint PK_transaction_changes__seq primary key(seq autoincrement)
+)"""
+
+DB_TRANSACTION_CHANGES_INSERT_TRIGGER = """
+create trigger if not exists TR_transactions__changes_insert after insert on transaction_records begin
+    insert into transaction_changes(transaction_id, kind) values(new.id, 'insert');
+end"""
+
+DB_TRANSACTION_CHANGES_UPDATE_TRIGGER = """
+create trigger if not exists TR_transactions__changes_update after update on transaction_records begin
+    insert into transaction_changes(transaction_id, kind) values(new.id, 'update');
+end"""
+
+DB_TRANSACTION_CHANGES_DELETE_TRIGGER = """
+create trigger if not exists TR_transactions__changes_delete after delete on transaction_records begin
+    insert into transaction_changes(transaction_id, kind) values(old.id, 'delete');
+end"""
+
 
 # Table: Intervals
 #===================================================================================================
@@ -123,6 +424,9 @@ create table if not exists intervals(
 # Table: Abstract transactions
 #===================================================================================================
 DB_ABSTRACT_TRANSACTIONS_TABLE = """
+-- Transfers between own accounts, independent of the two transactions they consist of. The rows that
+-- have been derived from transactions (i.e., origin_tx_id is not null) are kept up to date by
+-- logic.update_abstract_transactions().
 create table if not exists abstract_transactions (
     from_account text not null,
     to_account text not null,
@@ -146,5 +450,392 @@ create table if not exists abstract_transactions (
     inserted_at datetime not null,
     inserted_by text not null,
 
-    constraint FK_abstract_transactions__origin_tx_id foreign key(origin_tx_id) references transactions(id)
+    constraint FK_abstract_transactions__origin_tx_id foreign key(origin_tx_id) references transaction_records(id)
+)"""
+
+DB_ABSTRACT_TRANSACTIONS_ORIGIN_INDEX = """
+create unique index if not exists UK_abstract_transactions__origin_tx_id on abstract_transactions(origin_tx_id)
+"""
+
+
+# Table: Daily balances
+#===================================================================================================
+DB_DAILY_BALANCES_TABLE = """
+-- The balance of an account at the end of each day on which at least one transaction occured (using
+-- entry_date). This is redundant since it can be computed from accounts.initial_balance and the
+-- transactions, but it allows to look up the balance for any date without summing up all the
+-- transactions before it. It is kept up to date by logic.update_daily_balances().
+create table if not exists daily_balances(
+    account_number text not null,
+    date date not null,
+    balance integer not null,
+
+    constraint PK_daily_balances primary key(account_number, date),
+    constraint FK_daily_balances__account_number foreign key(account_number) references accounts(account_number)
+) without rowid"""
+
+
+# Table: Balance checkpoints
+#===================================================================================================
+DB_BALANCE_CHECKPOINTS_TABLE = """
+-- The balance of an account at the end of a day as reported by the bank (e.g., via FinTS or the
+-- balance column of a CSV export). Unlike daily_balances this is not derived from the transactions,
+-- so comparing both detects missing or duplicated transactions without fetching them again (see
+-- logic.check_checkpoint_consistency()). Checkpoints are never overwritten, and are deleted together
+-- with the import that reported them.
+create table if not exists balance_checkpoints(
+    account_number text not null,
+    date date not null,
+    balance integer not null,
+    batch_id integer not null,
+
+    constraint PK_balance_checkpoints primary key(account_number, date),
+    constraint FK_balance_checkpoints__account_number foreign key(account_number) references accounts(account_number),
+    constraint FK_balance_checkpoints__batch_id foreign key(batch_id) references import_batches(id)
+) without rowid"""
+
+
+# Table: Monthly rollups
+#===================================================================================================
+DB_MONTHLY_ROLLUPS_TABLE = """
+-- Income and expenses per account, month and category. Like daily_balances this is redundant, but
+-- it allows reports to be computed without scanning all transactions. It is kept up to date by
+-- logic.update_monthly_rollups().
+--
+-- The category is the tag of the transactions (see transaction_tags), or '' for untagged ones.
+-- Internal transfers (i.e., transactions with a matching_txn) are neither counted as income nor as
+-- expense but summed up separately in `transfers`.
+create table if not exists monthly_rollups(
+    account_number text not null,
+    month text not null, -- YYYY-MM
+    category text not null default '',
+    income integer not null, -- Sum of all positive values
+    expense integer not null, -- Sum of all negative values
+    net integer not null, -- income + expense
+    transfers integer not null,
+    num_transactions integer not null,
+
+    constraint PK_monthly_rollups primary key(account_number, month, category),
+    constraint FK_monthly_rollups__account_number foreign key(account_number) references accounts(account_number)
+) without rowid"""
+
+DB_MONTHLY_ROLLUPS_MONTH_INDEX = """
+create index if not exists IX_monthly_rollups__month on monthly_rollups(month)
+"""
+
+
+# Table: Recurring series
+#===================================================================================================
+DB_RECURRING_SERIES_TABLE = """
+-- Recurring payments (standing orders, direct debits, subscriptions, salaries, ...) that have been
+-- detected by recurring.py. Each series consists of the transactions of an account with the same
+-- series_key. The table is derived from the transactions and updated whenever new transactions with
+-- the same key are inserted.
+create table if not exists recurring_series(
+    account_number text not null,
+    series_key text not null,
+    remote_name text not null,
+    period text not null, -- weekly, monthly, quarterly, ... (see recurring.PERIODS)
+    -- Median number of days between two transactions of the series
+    interval_days integer not null,
+    -- Median value of the transactions of the series
+    typical_value integer not null,
+    num_transactions integer not null,
+    first_date date not null,
+    last_date date not null,
+    next_expected_date date not null,
+    -- If there is no new transaction of the series by this date, the payment is considered missing
+    overdue_date date not null,
+
+    constraint PK_recurring_series primary key(account_number, series_key),
+    constraint FK_recurring_series__account_number foreign key(account_number) references accounts(account_number)
+) without rowid"""
+
+DB_RECURRING_SERIES_OVERDUE_DATE_INDEX = """
+create index if not exists IX_recurring_series__overdue_date on recurring_series(overdue_date)
+"""
+
+
+# Table: Archives
+#===================================================================================================
+DB_ARCHIVES_TABLE = """
+-- Years whose transactions have been moved to separate database files by partitions.archive_years().
+-- All years up to max(year) are archived. The daily balances and monthly rollups of archived years
+-- stay in the main database.
+create table if not exists archives(
+    year integer not null,
+    filename text not null, -- Relative to the directory of the main database
+    num_transactions integer not null,
+    archived_at datetime not null,
+
+    constraint PK_archives primary key(year)
+) without rowid"""
+
+
+# Tables: Tags
+#===================================================================================================
+DB_TAG_RULES_TABLE = """
+-- Rules for categorizing transactions (see tags.py). Each rule matches one field of a transaction
+-- (purpose, remote_name, remote_account, creditor_scheme_id or mandate_id), either by comparing it
+-- with `pattern` (kind = 'exact') or by searching for the regular expression `pattern` (kind =
+-- 'regex'). Both are case-insensitive. If multiple rules match, the one with the lowest priority
+-- (and then the lowest id) wins.
+create table if not exists tag_rules(
+    id integer,
+    tag text not null,
+    field text not null,
+    kind text not null,
+    pattern text not null,
+    priority integer not null default 0,
+    created_at datetime not null default current_timestamp,
+
+    constraint PK_tag_rules__id primary key(id)
 )"""
+
+DB_TRANSACTION_TAGS_TABLE = """
+-- The tag of each transaction that is matched by a rule. Derived from tag_rules and the transactions;
+-- it is updated when new transactions are inserted and recomputed when the rules change.
+create table if not exists transaction_tags(
+    transaction_id integer not null,
+    tag text not null,
+    rule_id integer not null,
+
+    constraint PK_transaction_tags__transaction_id primary key(transaction_id),
+    constraint FK_transaction_tags__transaction_id foreign key(transaction_id) references transaction_records(id),
+    constraint FK_transaction_tags__rule_id foreign key(rule_id) references tag_rules(id)
+)"""
+
+DB_TRANSACTION_TAGS_RULE_ID_INDEX = """
+create index if not exists IX_transaction_tags__rule_id on transaction_tags(rule_id)
+"""
+
+DB_TRANSACTION_TAGS_TAG_INDEX = """
+create index if not exists IX_transaction_tags__tag on transaction_tags(tag)
+"""
+
+
+# Creating the schema
+#===================================================================================================
+DB_TABLES = [
+    DB_ACCOUNTS_TABLE,
+    DB_COUNTERPARTIES_TABLE,
+    DB_TRANSACTIONS_TABLE,
+    DB_TRANSACTIONS_FTS_TABLE,
+    DB_TRANSACTION_CHANGES_TABLE,
+    DB_INTERVALS_TABLE,
+    DB_DAILY_BALANCES_TABLE,
+    DB_MONTHLY_ROLLUPS_TABLE,
+    DB_TAG_RULES_TABLE,
+    DB_TRANSACTION_TAGS_TABLE,
+    DB_RECURRING_SERIES_TABLE,
+    DB_ARCHIVES_TABLE,
+    DB_IMPORT_BATCHES_TABLE,
+    DB_BALANCE_CHECKPOINTS_TABLE,
+    DB_ABSTRACT_TRANSACTIONS_TABLE,
+]
+
+# Columns that have been added after the table has been created for the first time. They are added
+# to existing databases by create_schema(). New databases get them from DB_TABLES.
+DB_ADDED_COLUMNS = [
+    ("transaction_records", "display_remote_name", "text"),
+    ("transaction_records", "display_account", "text"),
+    ("transaction_records", "display_value", "text"),
+    ("transaction_records", "series_key", "text"),
+    ("transaction_records", "fingerprint", "text"),
+    ("transaction_records", "purpose_norm", "text"),
+    ("transaction_records", "purpose_hash", "integer"),
+    ("transaction_records", "batch_id", "integer constraint FK_transactions__batch_id references import_batches(id)"),
+]
+
+DB_INDEXES_AND_TRIGGERS = [
+    DB_TRANSACTIONS_VIEW,
+    DB_TRANSACTIONS_VIEW_INSERT_TRIGGER,
+    DB_TRANSACTIONS_VIEW_UPDATE_TRIGGER,
+    DB_TRANSACTIONS_VIEW_DELETE_TRIGGER,
+    DB_TRANSACTIONS_ENTRY_DATE_INDEX,
+    DB_TRANSACTIONS_ORDER_INDEX,
+    DB_TRANSACTIONS_DISPLAY_REMOTE_NAME_INDEX,
+    DB_TRANSACTIONS_VALUE_INDEX,
+    DB_TRANSACTIONS_SERIES_KEY_INDEX,
+    DB_TRANSACTIONS_FINGERPRINT_INDEX,
+    DB_TRANSACTIONS_BATCH_ID_INDEX,
+    DB_TRANSACTIONS_FTS_INSERT_TRIGGER,
+    DB_TRANSACTIONS_FTS_DELETE_TRIGGER,
+    DB_TRANSACTIONS_FTS_UPDATE_TRIGGER,
+    DB_TRANSACTION_CHANGES_INSERT_TRIGGER,
+    DB_TRANSACTION_CHANGES_UPDATE_TRIGGER,
+    DB_TRANSACTION_CHANGES_DELETE_TRIGGER,
+    DB_MONTHLY_ROLLUPS_MONTH_INDEX,
+    DB_TRANSACTION_TAGS_RULE_ID_INDEX,
+    DB_TRANSACTION_TAGS_TAG_INDEX,
+    DB_RECURRING_SERIES_OVERDUE_DATE_INDEX,
+    DB_IMPORT_BATCHES_ACCOUNT_INDEX,
+    DB_ABSTRACT_TRANSACTIONS_ORIGIN_INDEX,
+]
+
+# Objects that have been replaced by something else
+DB_OBSOLETE = [
+    "drop index if exists IX_transactions__remote_name",
+]
+
+
+# Creates all tables, indexes and triggers that don't exist yet. Returns the list of columns (as
+# (table, column) tuples) that have been added to existing tables, which may need to be filled by the
+# caller (see logic.init_database()).
+def create_schema(cursor):
+    fts_exists = table_exists(cursor, "transactions_fts")
+
+    if object_type(cursor, "transactions") == "table":
+        move_counterparties(cursor)
+
+    for statement in DB_TABLES:
+        cursor.execute(statement)
+
+    added_columns = []
+    for table, column, definition in DB_ADDED_COLUMNS:
+        existing = [c[0] for c in cursor.execute(f"select name from pragma_table_info('{table}')").fetchall()]
+        if column not in existing:
+            cursor.execute(f"alter table {table} add column {column} {definition}")
+            added_columns.append((table, column))
+
+    if column_type(cursor, "transaction_records", "exchange_rate") == "text":
+        convert_exchange_rates(cursor)
+
+    # The view (and its triggers) need to be recreated if columns have been added
+    if added_columns:
+        cursor.execute("drop view if exists transactions")
+
+    for statement in DB_INDEXES_AND_TRIGGERS + DB_OBSOLETE:
+        cursor.execute(statement)
+
+    # Index the transactions of databases that have been created before transactions_fts existed
+    if not fts_exists:
+        cursor.execute("insert into transactions_fts(transactions_fts) values('rebuild')")
+
+    return added_columns
+
+
+# Returns whether create_schema() would change the database (e.g., because it has been created by an
+# older version). Only reads from the database.
+def schema_outdated(cursor):
+    if object_type(cursor, "transactions") == "table":
+        return True
+
+    for statement in DB_TABLES:
+        name = re.search(r"create (?:virtual )?table if not exists (\w+)", statement).group(1)
+        if not table_exists(cursor, name):
+            return True
+
+    for table, column, _ in DB_ADDED_COLUMNS:
+        if column_type(cursor, table, column) == None:
+            return True
+
+    return column_type(cursor, "transaction_records", "exchange_rate") == "text"
+
+
+def table_exists(cursor, name):
+    return object_type(cursor, name) != None
+
+
+# Returns the last day of the archived years (see DB_ARCHIVES_TABLE), or None if nothing has been
+# archived
+def archived_until(cursor):
+    year = cursor.execute("select max(year) from main.archives").fetchone()[0]
+    return None if year == None else f"{year}-12-31"
+
+
+# Like archived_until(), but returns None if the archives are attached (see partitions.attach_archives()),
+# i.e., if the archived transactions are visible through `transactions`
+def detached_until(cursor):
+    attached = cursor.execute("select count(*) from sqlite_temp_master where name = 'transactions'").fetchone()[0] > 0
+    return None if attached else archived_until(cursor)
+
+
+# Returns the schemas that contain transaction_records and transaction_tags: main, and the archives if
+# they are attached (see partitions.attach_archives())
+def transaction_schemas(cursor):
+    return [r[0] for r in cursor.execute("select name from pragma_database_list where name != 'temp' order by seq")]
+
+
+# Returns "table", "view", "index" or "trigger", or None if there is no object called `name`
+def object_type(cursor, name):
+    row = cursor.execute("select type from sqlite_master where name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def column_type(cursor, table, column):
+    row = cursor.execute(f"select type from pragma_table_info('{table}') where name = ?", (column,)).fetchone()
+    return row[0].lower() if row else None
+
+
+# Migrates databases in which the transactions (including DB_COUNTERPARTY_COLUMNS) were stored in the
+# table `transactions`: the table is renamed to transaction_records (which also updates all foreign
+# keys that reference it), and the counterparty columns are replaced by counterparty_id. The
+# `transactions` view and the triggers are then recreated by create_schema().
+def move_counterparties(cursor):
+    # Triggers and indexes that use the columns that are dropped below
+    triggers = cursor.execute(
+        "select name from sqlite_master where type = 'trigger' and tbl_name = 'transactions'"
+    ).fetchall()
+    for (name,) in triggers:
+        cursor.execute(f"drop trigger {name}")
+    for statement in DB_OBSOLETE:
+        cursor.execute(statement)
+
+    cursor.execute(DB_COUNTERPARTIES_TABLE)
+    cursor.execute("alter table transactions rename to transaction_records")
+    cursor.execute(
+        """alter table transaction_records add column counterparty_id integer
+        constraint FK_transactions__counterparty_id references counterparties(id)"""
+    )
+    cursor.execute(
+        """insert or ignore into counterparties(remote_account, remote_name, creditor_scheme_id)
+        select distinct remote_account, remote_name, creditor_scheme_id from transaction_records"""
+    )
+    cursor.execute(
+        """update transaction_records set counterparty_id = (
+            select c.id from counterparties c
+            where
+                c.remote_account = transaction_records.remote_account and
+                c.remote_name = transaction_records.remote_name and
+                c.creditor_scheme_id = transaction_records.creditor_scheme_id
+        )"""
+    )
+    for column in DB_COUNTERPARTY_COLUMNS:
+        cursor.execute(f"alter table transaction_records drop column {column}")
+
+
+# Returns an exchange rate stored by an older version as a string that money.parse_rate() accepts.
+# Depending on the backend, rates were stored as numbers or as strings with a decimal comma (e.g.,
+# "1,0856" from CSV files).
+def legacy_rate_text(rate):
+    if isinstance(rate, (int, float)):
+        return format(rate, f".{money.RATE_DIGITS + 3}f")
+
+    text = rate.strip()
+    if "," in text and "." in text:
+        # The last separator is the decimal separator
+        thousands_separator = "." if text.rindex(",") > text.rindex(".") else ","
+        text = text.replace(thousands_separator, "")
+
+    return text.replace(",", ".")
+
+
+# Migrates databases in which exchange_rate was stored as a decimal string. SQLite cannot change the
+# type of a column, so the values are copied to a new column, which then replaces the old one. The
+# `transactions` view uses exchange_rate and needs to be dropped first; it is recreated by
+# create_schema().
+def convert_exchange_rates(cursor):
+    cursor.execute("drop view if exists transactions")
+    cursor.execute("alter table transaction_records add column exchange_rate_scaled integer")
+    # Parsed like the backends do, so that the converted rates compare equal to the rates of
+    # transactions that are imported again
+    rows = cursor.execute(
+        "select id, exchange_rate from transaction_records where exchange_rate is not null and exchange_rate != ''"
+    ).fetchall()
+    cursor.executemany(
+        "update transaction_records set exchange_rate_scaled = ? where id = ?",
+        [(money.parse_rate(legacy_rate_text(rate)), id) for id, rate in rows]
+    )
+    cursor.execute("alter table transaction_records drop column exchange_rate")
+    cursor.execute("alter table transaction_records rename column exchange_rate_scaled to exchange_rate")
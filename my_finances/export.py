@@ -0,0 +1,143 @@
+import csv
+import json
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Globals
+#===================================================================================================
+EXPORT_FORMATS = [
+    "csv",
+    "jsonl",
+    "parquet",
+]
+
+# Number of rows that are read from the database (and written to parquet files) at once
+CHUNK_SIZE = 5000
+
+# Columns of the export that contain integers. All other columns are exported as strings.
+INTEGER_COLUMNS = {
+    "id",
+    "value",
+    "original_value",
+    "exchange_rate",
+    "matching_txn",
+    "total_order",
+    "matching_value",
+}
+
+
+# Exporting transactions
+#===================================================================================================
+# Writes all transactions that match the given filters to `out`, which must be a text file for csv
+# and jsonl and a binary file for parquet. Rows are streamed from the database in chunks so memory
+# usage does not depend on the number of transactions.
+def export_transactions(
+    conn, out, fmt,
+    accounts = None, start_date = None, end_date = None,
+    with_matches = False, with_accounts = False
+):
+    cursor = conn.cursor()
+    cursor.execute(*build_query(accounts, start_date, end_date, with_matches, with_accounts))
+    columns = [d[0] for d in cursor.description]
+
+    if fmt == "csv":
+        count = write_csv(cursor, columns, out)
+    elif fmt == "jsonl":
+        count = write_jsonl(cursor, columns, out)
+    elif fmt == "parquet":
+        count = write_parquet(cursor, columns, out)
+    else:
+        raise RuntimeError("Unsupported export format: " + fmt)
+
+    cursor.close()
+    return count
+
+
+def build_query(accounts, start_date, end_date, with_matches, with_accounts):
+    columns = ["t.*"]
+    joins = []
+    if with_matches:
+        columns += [
+            "m.local_account as matching_account",
+            "m.entry_date as matching_entry_date",
+            "m.value as matching_value",
+        ]
+        joins.append("left join transactions m on m.id = t.matching_txn")
+    if with_accounts:
+        columns += [
+            "a.bank_code as bank_code",
+            "a.preferred_backend as preferred_backend",
+        ]
+        joins.append("join accounts a on a.account_number = t.local_account")
+
+    conditions = []
+    params = {}
+    if accounts:
+        placeholders = []
+        for n, acc in enumerate(sorted(accounts)):
+            placeholders.append(f":account{n}")
+            params[f"account{n}"] = acc
+        conditions.append("t.local_account in ({})".format(", ".join(placeholders)))
+    if start_date:
+        conditions.append("t.entry_date >= :start_date")
+        params["start_date"] = start_date
+    if end_date:
+        conditions.append("t.entry_date <= :end_date")
+        params["end_date"] = end_date
+
+    query = "select {} from transactions t {}".format(", ".join(columns), " ".join(joins))
+    if conditions:
+        query += " where " + " and ".join(conditions)
+    query += " order by t.local_account, t.total_order"
+
+    return query, params
+
+
+def write_csv(cursor, columns, out):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+
+    count = 0
+    while rows := cursor.fetchmany(CHUNK_SIZE):
+        writer.writerows(rows)
+        count += len(rows)
+
+    return count
+
+
+def write_jsonl(cursor, columns, out):
+    count = 0
+    while rows := cursor.fetchmany(CHUNK_SIZE):
+        for row in rows:
+            out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+            out.write("\n")
+        count += len(rows)
+
+    return count
+
+
+def write_parquet(cursor, columns, out):
+    if pyarrow == None:
+        raise RuntimeError("Exporting to parquet requires pyarrow")
+
+    schema = pyarrow.schema([
+        (c, pyarrow.int64() if c in INTEGER_COLUMNS else pyarrow.string())
+        for c in columns
+    ])
+
+    count = 0
+    with pyarrow.parquet.ParquetWriter(out, schema) as writer:
+        while rows := cursor.fetchmany(CHUNK_SIZE):
+            # Each chunk becomes a row group
+            writer.write_table(pyarrow.Table.from_pylist(
+                [dict(zip(columns, row)) for row in rows],
+                schema=schema
+            ))
+            count += len(rows)
+
+    return count
@@ -2,13 +2,13 @@ import sys
 import os
 import datetime
 import sqlite3
-from decimal import Decimal
+import pathlib
+import threading
 
 from PyQt6.QtWidgets import (QApplication,
                              QMainWindow,
                              QWidget,
-                             QTableWidget,
-                             QTableWidgetItem,
+                             QTableView,
                              QHeaderView,
                              QAbstractItemView,
                              QDialog,
@@ -17,44 +17,210 @@ from PyQt6.QtWidgets import (QApplication,
                              QFormLayout,
                              QGroupBox,
                              QPushButton,
+                             QProgressBar,
+                             QLineEdit,
+                             QComboBox,
+                             QDateEdit,
+                             QTabWidget,
+                             QTableWidget,
+                             QTableWidgetItem,
+                             QToolTip,
+                             QHBoxLayout,
                              QVBoxLayout)
-from PyQt6.QtCore import Qt
-from PyQt6.QtGui import QBrush, QColor
+from PyQt6.QtCore import (Qt,
+                          QAbstractTableModel,
+                          QModelIndex,
+                          QObject,
+                          QRunnable,
+                          QThreadPool,
+                          QTimer,
+                          QDate,
+                          QPoint,
+                          QPointF,
+                          QRectF,
+                          QPersistentModelIndex,
+                          pyqtSignal)
+from PyQt6.QtGui import QBrush, QColor, QPainter, QPen
 
 import schwifty
 
+from . import db, money
+
 
 # Utils
 #===================================================================================================
-def fmt_money(v):
-    return "{:.2f}€".format(Decimal(v) / 100)
-
-
-def build_remote_name(tx):
-    remote_name_parts = []
-    if tx["ultimate_debtor"]:
-        remote_name_parts.append(tx["ultimate_debtor"])
-    elif tx["remote_name"]:
-        remote_name_parts.append(tx["remote_name"])
+# Turns the text entered into the search field into an FTS5 query that matches all transactions
+# containing all words (where the last word may be incomplete)
+def build_fts_query(text):
+    terms = []
+    for word in text.split():
+        terms.append('"' + word.replace('"', '""') + '"')
+    if terms:
+        terms[-1] += "*"
 
-    if tx["remote_account"]:
-        remote_name_parts.append(tx["remote_account"].split(":")[-1])
+    return " ".join(terms)
 
-    if not remote_name_parts:
-        # Credit card transactions don't have a remote account. Thus, we use the first line of
-        # the puspose field, which usually contains the information we want
-        remote_name_parts.append(tx["purpose"].split("\n")[0])
 
-    return "\n".join(remote_name_parts)
+# Background queries
+#===================================================================================================
+# All queries of the GUI are run on a thread pool so that the UI never blocks on SQLite (e.g., while
+# the CLI is importing transactions). Each thread uses its own read-only connection.
+#
+# Queries are submitted on a named channel. Submitting a new query on a channel cancels the query
+# that is still running on it (if any), and only the result of the most recent query is delivered.
+class QuerySignals(QObject):
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+    progress = pyqtSignal(int)
+
+
+class QueryTask(QRunnable):
+    # Number of SQLite VM instructions between two calls of the progress handler
+    PROGRESS_INTERVAL = 10000
+
+    def __init__(self, runner, request_id, sql, params):
+        QRunnable.__init__(self)
+
+        self.request_id = request_id
+        self.signals = QuerySignals()
+        self._runner = runner
+        self._sql = sql
+        self._params = params
+        self._cancelled = False
+        self._conn = None
+
+    # May be called from any thread
+    def cancel(self):
+        self._cancelled = True
+        if conn := self._conn:
+            conn.interrupt()
+
+    def run(self):
+        if self._cancelled:
+            return
+
+        conn = self._runner.connection()
+        self._conn = conn
+
+        steps = 0
+        def on_progress():
+            nonlocal steps
+            steps += 1
+            self.signals.progress.emit(steps)
+            # A non-zero return value aborts the query
+            return 1 if self._cancelled else 0
+
+        conn.set_progress_handler(on_progress, self.PROGRESS_INTERVAL)
+        try:
+            rows = conn.execute(self._sql, self._params).fetchall()
+        except sqlite3.Error as e:
+            if not self._cancelled:
+                self.signals.failed.emit(self.request_id, str(e))
+            return
+        finally:
+            conn.set_progress_handler(None, 0)
+            self._conn = None
+
+        if not self._cancelled:
+            self.signals.finished.emit(self.request_id, rows)
+
+
+class QueryRunner(QObject):
+    # Emitted whenever the first query starts or the last query finishes
+    busy_changed = pyqtSignal(bool)
+    # Number of progress steps made by the running queries so far
+    progress = pyqtSignal(int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, db_file, *args):
+        QObject.__init__(self, *args)
+
+        self._uri = pathlib.Path(db_file).resolve().as_uri() + "?mode=ro"
+        self._local = threading.local()
+        self._pool = QThreadPool(self)
+        # Keep the threads (and thus their connections) alive
+        self._pool.setExpiryTimeout(-1)
+
+        self._next_id = 0
+        self._running = {} # channel -> QueryTask
+        self._callbacks = {} # request_id -> (channel, callback)
+        self._steps = 0
+
+    # Called from the worker threads
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn == None:
+            # The timeout makes reads wait (in the background) if the CLI holds an exclusive lock
+            conn = sqlite3.connect(self._uri, uri=True, timeout=60)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+
+        return conn
+
+    # Runs the query in the background and calls `callback` with the resulting rows on the GUI
+    # thread
+    def submit(self, channel, sql, params, callback):
+        was_busy = self.is_busy()
+        if prev := self._running.get(channel):
+            prev.cancel()
+            del self._callbacks[prev.request_id]
+
+        request_id = self._next_id
+        self._next_id += 1
+
+        task = QueryTask(self, request_id, sql, params)
+        task.signals.finished.connect(self._on_finished)
+        task.signals.failed.connect(self._on_failed)
+        task.signals.progress.connect(self._on_progress)
+
+        self._running[channel] = task
+        self._callbacks[request_id] = (channel, callback)
+        if not was_busy:
+            self._steps = 0
+            self.busy_changed.emit(True)
+
+        self._pool.start(task)
+        return request_id
+
+    def is_busy(self):
+        return bool(self._running)
+
+    def _on_finished(self, request_id, rows):
+        if request_id not in self._callbacks:
+            return # Superseded
+
+        _, callback = self._callbacks[request_id]
+        self._remove(request_id)
+        callback(rows)
+
+    def _on_failed(self, request_id, msg):
+        if request_id not in self._callbacks:
+            return # Superseded
+
+        self._remove(request_id)
+        self.failed.emit(msg)
+
+    def _on_progress(self, _task_steps):
+        self._steps += 1
+        self.progress.emit(self._steps)
+
+    def _remove(self, request_id):
+        channel, _ = self._callbacks.pop(request_id)
+        del self._running[channel]
+        if not self._running:
+            self.busy_changed.emit(False)
 
 
 # GUI classes
 #===================================================================================================
 class TransactionDetails(QDialog):
-    def __init__(self, tx, conn, parent):
+    def __init__(self, tx, runner, parent):
         QDialog.__init__(self, parent)
         self.setModal(False)
 
+        self._tx = tx
+        self._runner = runner
+
         self.setWindowTitle("Transaktion | " + tx["entry_date"])
 
         tx_form = QFormLayout()
@@ -62,88 +228,790 @@ class TransactionDetails(QDialog):
         tx_form.addRow("Zweck:", QLabel(tx["purpose"], wordWrap=True, textInteractionFlags=Qt.TextInteractionFlag.TextSelectableByMouse))
 
         buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Close)
+        buttons.rejected.connect(self.close)
         layout = QVBoxLayout()
         layout.addLayout(tx_form)
 
         if tx["matching_txn"] != None:
-            layout.addWidget(QPushButton("Gegenstück"))
+            self._matching_button = QPushButton("Gegenstück")
+            self._matching_button.clicked.connect(self._on_click_matching_details)
+            layout.addWidget(self._matching_button)
 
         layout.addWidget(buttons)
         self.setLayout(layout)
 
     def _on_click_matching_details(self):
-        matching_txn = conn.execute("select * from transactions where id = ?", (tx["matching_txn"],)).fetchone()
+        self._matching_button.setEnabled(False)
+        self._runner.submit(
+            "matching_details",
+            "select * from transactions where id = ?", (self._tx["matching_txn"],),
+            self._on_matching_loaded
+        )
+
+    def _on_matching_loaded(self, rows):
+        self._matching_button.setEnabled(True)
+        if rows:
+            TransactionDetails(rows[0], self._runner, self.parent()).show()
+
+
+# Lists the transactions of all accounts. Rows are loaded page by page when the view scrolls to the
+# end (see canFetchMore() and fetchMore()).
+#
+# Filtering and sorting is done by the database. Pages are selected via keyset pagination on the
+# sort key of the current sort column (see SORT_KEYS). Each sort key is covered by an index (the id
+# is implicitly part of every index since it is the rowid), so loading a page takes the same time no
+# matter how large the DB or how far down we have scrolled.
+class TransactionModel(QAbstractTableModel):
+    PAGE_SIZE = 200
+    COLUMNS = ["Datum", "Konto", "Zielkonto", "Zweck", "Betrag"]
+
+    # Columns that are not listed here cannot be sorted
+    SORT_KEYS = {
+        0: ["entry_date", "total_order", "id"], # IX_transactions__entry_date_total_order
+        1: ["local_account", "total_order"], # UK_transactions__total_order
+        2: ["display_remote_name", "id"], # IX_transactions__display_remote_name
+        4: ["value", "id"], # IX_transactions__value
+    }
+
+    def __init__(self, runner, *args):
+        QAbstractTableModel.__init__(self, *args)
+
+        self._runner = runner
+        self._transactions = []
+        self._has_more = True
+        # Whether a page is currently being loaded in the background
+        self._loading = False
+
+        self._sort_column = 0
+        self._sort_order = Qt.SortOrder.DescendingOrder
+        # See TransactionFilterBar
+        self._filter = {}
+        # IDs of changed transactions that are currently being reloaded (see apply_changes())
+        self._pending_changes = set()
+
+    def transaction(self, row):
+        return self._transactions[row]
+
+    def set_filter(self, filter):
+        self._filter = filter
+        self._reload()
+
+    def sort(self, column, order = Qt.SortOrder.AscendingOrder):
+        if column not in self.SORT_KEYS:
+            return
+
+        self._sort_column = column
+        self._sort_order = order
+        self._reload()
+
+    def _reload(self):
+        self.beginResetModel()
+        self._transactions = []
+        self._has_more = True
+        self._loading = False
+        self._pending_changes = set()
+        self.endResetModel()
+
+        # This cancels the page that is currently being loaded, if any
+        self.fetchMore()
+
+    def rowCount(self, parent = QModelIndex()):
+        if parent.isValid():
+            return 0
+
+        return len(self._transactions)
+
+    def columnCount(self, parent = QModelIndex()):
+        if parent.isValid():
+            return 0
+
+        return len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role = Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.COLUMNS[section]
+
+        return None
+
+    def data(self, index, role = Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+
+        tx = self._transactions[index.row()]
+        col = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            # The display_* columns are precomputed when the transactions are inserted
+            if col == 0:
+                return tx["entry_date"]
+            elif col == 1:
+                return tx["display_account"]
+            elif col == 2:
+                return tx["display_remote_name"]
+            elif col == 3:
+                return tx["purpose"]
+            elif col == 4:
+                return tx["display_value"]
+        elif role == Qt.ItemDataRole.TextAlignmentRole and col == 4:
+            return Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+        elif role == Qt.ItemDataRole.ForegroundRole and col == 4 and tx["value"] < 0:
+            return QBrush(QColor("darkred"))
+
+        return None
+
+    def canFetchMore(self, parent = QModelIndex()):
+        if parent.isValid():
+            return False
+
+        return self._has_more and not self._loading
+
+    def fetchMore(self, parent = QModelIndex()):
+        if parent.isValid() or self._loading:
+            return
+
+        sql, params = self._build_page_query()
+        self._loading = True
+        self._runner.submit("transactions", sql, params, self._on_page_loaded)
+
+    def _build_page_query(self):
+        conditions, params = self._filter_conditions()
+        params["limit"] = self.PAGE_SIZE
+
+        key = self._sort_key()
+        descending = self._sort_order == Qt.SortOrder.DescendingOrder
+        if self._transactions:
+            last = self._transactions[-1]
+            conditions.append("({}) {} ({})".format(
+                ", ".join(key),
+                "<" if descending else ">",
+                ", ".join(":key_" + k for k in key)
+            ))
+            for k in key:
+                params["key_" + k] = last[k]
+
+        sql = "select * from transactions"
+        if conditions:
+            sql += " where " + " and ".join(conditions)
+        sql += " order by " + ", ".join(k + (" desc" if descending else "") for k in key)
+        sql += " limit :limit"
+
+        return sql, params
+
+    def _filter_conditions(self):
+        conditions = []
+        params = {}
+
+        if self._filter.get("search"):
+            conditions.append("id in (select rowid from transactions_fts where transactions_fts match :search)")
+            params["search"] = build_fts_query(self._filter["search"])
+        if self._filter.get("account"):
+            conditions.append("local_account = :account")
+            params["account"] = self._filter["account"]
+        if self._filter.get("start_date"):
+            conditions.append("entry_date >= :start_date")
+            params["start_date"] = self._filter["start_date"]
+        if self._filter.get("end_date"):
+            conditions.append("entry_date <= :end_date")
+            params["end_date"] = self._filter["end_date"]
+
+        return conditions, params
+
+    def _sort_key(self):
+        if self._sort_column == 0 and self._filter.get("account"):
+            # Within an account, total_order is consistent with entry_date, so we can use
+            # UK_transactions__total_order instead
+            return ["total_order"]
+
+        return self.SORT_KEYS[self._sort_column]
+
+    def _on_page_loaded(self, page):
+        self._loading = False
+        if len(page) < self.PAGE_SIZE:
+            self._has_more = False
+        if not page:
+            return
+
+        self.beginInsertRows(QModelIndex(), len(self._transactions), len(self._transactions) + len(page) - 1)
+        self._transactions += page
+        self.endInsertRows()
+
+    # Updates the given transactions (which have been inserted, updated or deleted in the DB) without
+    # reloading the model. New transactions are only inserted if they would appear within the rows
+    # that have been loaded so far; the others are loaded by fetchMore() later.
+    def apply_changes(self, ids):
+        self._pending_changes.update(ids)
+
+        conditions, params = self._filter_conditions()
+        placeholders = []
+        for n, id in enumerate(sorted(self._pending_changes)):
+            placeholders.append(f":id{n}")
+            params[f"id{n}"] = id
+        conditions.append("id in ({})".format(", ".join(placeholders)))
+
+        # This cancels the previous call of apply_changes() if it is still running, which is why we
+        # need to collect the IDs in self._pending_changes
+        self._runner.submit(
+            "transaction_changes",
+            "select * from transactions where " + " and ".join(conditions), params,
+            self._on_changes_loaded
+        )
+
+    def _on_changes_loaded(self, rows):
+        ids = self._pending_changes
+        self._pending_changes = set()
+
+        # Rows that still exist and match the current filter
+        changed = {r["id"]: r for r in rows}
+        for id in ids:
+            row = self._row_of(id)
+            tx = changed.get(id)
+            if tx == None:
+                if row != None:
+                    self.beginRemoveRows(QModelIndex(), row, row)
+                    del self._transactions[row]
+                    self.endRemoveRows()
+                continue
+
+            if row != None:
+                # If the sort key did not change we can update the row in place
+                if self._sort_key_of(tx) == self._sort_key_of(self._transactions[row]):
+                    self._transactions[row] = tx
+                    self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.COLUMNS) - 1))
+                    continue
+
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self._transactions[row]
+                self.endRemoveRows()
+
+            new_row = self._insert_position(tx)
+            if new_row < len(self._transactions) or not self._has_more:
+                self.beginInsertRows(QModelIndex(), new_row, new_row)
+                self._transactions.insert(new_row, tx)
+                self.endInsertRows()
+
+    def _row_of(self, id):
+        for n, tx in enumerate(self._transactions):
+            if tx["id"] == id:
+                return n
+
+        return None
+
+    def _sort_key_of(self, tx):
+        # SQLite sorts null before everything else
+        return tuple((tx[k] != None, tx[k]) for k in self._sort_key())
+
+    # Binary search for the position at which `tx` needs to be inserted to keep the rows sorted
+    def _insert_position(self, tx):
+        key = self._sort_key_of(tx)
+        descending = self._sort_order == Qt.SortOrder.DescendingOrder
+
+        lo = 0
+        hi = len(self._transactions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self._sort_key_of(self._transactions[mid])
+            if (mid_key > key) if descending else (mid_key < key):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+
+# Notices when transactions are changed by another process (e.g., an import via the CLI). Polling
+# `PRAGMA data_version` is cheap, and only if it changed the transaction_changes journal is queried
+# for the IDs of the transactions that have changed since the last poll.
+class ChangeWatcher(QObject):
+    POLL_INTERVAL_MS = 1000
+
+    transactions_changed = pyqtSignal(list)
+    # Emitted if changes have been missed (because they have already been removed from the journal)
+    reset_required = pyqtSignal()
+
+    def __init__(self, db_file, runner, *args):
+        QObject.__init__(self, *args)
+
+        self._runner = runner
+        # data_version is only meaningful when always using the same connection. Don't wait for
+        # locks since this connection is used on the GUI thread.
+        self._conn = sqlite3.connect(pathlib.Path(db_file).resolve().as_uri() + "?mode=ro", uri=True, timeout=0)
+        self._data_version = None
+        self._last_seq = None
+        try:
+            self._last_seq = self._conn.execute("select coalesce(max(seq), 0) from transaction_changes").fetchone()[0]
+        except sqlite3.OperationalError:
+            pass
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(self.POLL_INTERVAL_MS)
+        self._timer.timeout.connect(self._poll)
+        self._timer.start()
+
+    def _poll(self):
+        try:
+            if self._last_seq == None:
+                self._last_seq = self._conn.execute("select coalesce(max(seq), 0) from transaction_changes").fetchone()[0]
+                # We don't know what happened before
+                self.reset_required.emit()
+
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        except sqlite3.OperationalError:
+            return # Try again later
+
+        if data_version == self._data_version:
+            return
+
+        self._data_version = data_version
+        self._runner.submit(
+            "change_watcher",
+            """select seq, transaction_id, (select min(seq) from transaction_changes) as min_seq
+            from transaction_changes
+            where seq > :seq
+            order by seq""",
+            {"seq": self._last_seq},
+            self._on_changes_loaded
+        )
+
+    def _on_changes_loaded(self, rows):
+        if not rows:
+            return
+
+        if rows[0]["min_seq"] > self._last_seq + 1:
+            self.reset_required.emit()
+        else:
+            self.transactions_changed.emit(sorted({r["transaction_id"] for r in rows}))
+
+        self._last_seq = rows[-1]["seq"]
+
+
+# Search field and filters for the transaction list. Changes are debounced, i.e., filter_changed is
+# only emitted once the user stopped typing for DEBOUNCE_MS.
+class TransactionFilterBar(QWidget):
+    DEBOUNCE_MS = 250
+
+    # Dict with the keys "search", "account", "start_date" and "end_date". Unset filters are None.
+    filter_changed = pyqtSignal(dict)
+
+    def __init__(self, runner, *args):
+        QWidget.__init__(self, *args)
+
+        self._search = QLineEdit(placeholderText="Suche (Zweck, Name, Konto)", clearButtonEnabled=True)
+        self._account = QComboBox()
+        self._account.addItem("Alle Konten", None)
+        self._start_date = self._create_date_edit()
+        self._end_date = self._create_date_edit()
+
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self._search, stretch=1)
+        layout.addWidget(self._account)
+        layout.addWidget(QLabel("Von:"))
+        layout.addWidget(self._start_date)
+        layout.addWidget(QLabel("Bis:"))
+        layout.addWidget(self._end_date)
+        self.setLayout(layout)
 
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(self.DEBOUNCE_MS)
+        self._timer.timeout.connect(self._emit_filter)
+
+        self._search.textChanged.connect(self._restart_debounce)
+        self._account.currentIndexChanged.connect(self._restart_debounce)
+        self._start_date.dateChanged.connect(self._restart_debounce)
+        self._end_date.dateChanged.connect(self._restart_debounce)
+
+        runner.submit(
+            "accounts",
+            "select account_number from accounts order by account_number", {},
+            self._on_accounts_loaded
+        )
+
+    def _create_date_edit(self):
+        # The minimum date is displayed as an empty field and means "no filter"
+        edit = QDateEdit(calendarPopup=True, displayFormat="yyyy-MM-dd")
+        edit.setMinimumDate(QDate(1900, 1, 1))
+        edit.setSpecialValueText(" ")
+        edit.setDate(edit.minimumDate())
+        return edit
+
+    def _date_filter(self, edit):
+        if edit.date() == edit.minimumDate():
+            return None
+
+        return edit.date().toString("yyyy-MM-dd")
+
+    def _on_accounts_loaded(self, rows):
+        for r in rows:
+            self._account.addItem(r["account_number"], r["account_number"])
+
+    # Connecting the signals directly to QTimer.start would pick the overload start(int msec), which
+    # uses the argument of the signal (e.g., the index of the account) as the interval
+    def _restart_debounce(self, *args):
+        self._timer.start()
+
+    def _emit_filter(self):
+        self.filter_changed.emit({
+            "search": self._search.text().strip() or None,
+            "account": self._account.currentData(),
+            "start_date": self._date_filter(self._start_date),
+            "end_date": self._date_filter(self._end_date),
+        })
+
+
+class TransactionTable(QTableView):
+    def __init__(self, runner, *args):
+        QTableView.__init__(self, *args)
+
+        self._runner = runner
+        self._model = TransactionModel(runner, self)
+        self.setModel(self._model)
+
+        # Sorting is done by the model
+        self.horizontalHeader().setSortIndicator(0, Qt.SortOrder.DescendingOrder)
+        self.setSortingEnabled(True)
+
+        # Make the purpose column stretch to fill all available space. All other columns can be
+        # resized by the user
+        self.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
+        self.horizontalHeader().setSectionResizeMode(3, QHeaderView.ResizeMode.Stretch)
+
+        # Keep the rows that are currently visible in place when rows are inserted or removed above
+        # them
+        self._scroll_anchor = None
+        self._model.rowsAboutToBeInserted.connect(self._save_scroll_anchor)
+        self._model.rowsAboutToBeRemoved.connect(self._save_scroll_anchor)
+        self._model.rowsInserted.connect(self._restore_scroll_anchor)
+        self._model.rowsRemoved.connect(self._restore_scroll_anchor)
+
+        # Size the columns to their contents once the first page has been loaded
+        self._model.rowsInserted.connect(self._on_first_rows_inserted)
+        if self._model.canFetchMore():
+            self._model.fetchMore()
 
-class TransactionTable(QTableWidget):
-    def __init__(self, transactions, conn, *args):
-        QTableWidget.__init__(self, *args)
+        # Users should only be able to select entire rows, not individual cells
+        self.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
 
-        self._db = conn
-        self._transactions = transactions
-        self.setColumnCount(3)
-        self.setRowCount(len(transactions))
+        # By default, scrolling moves by entire rows/columns. Use smooth scrolling instead
+        self.setHorizontalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
 
-        self.setHorizontalHeaderLabels(["Konto", "Zielkonto", "Zweck"])
+        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
 
-        for n, tx in enumerate(transactions):
-            self.setItem(n, 0, QTableWidgetItem(tx["local_account"].split(":")[1]))
-            self.setItem(n, 1, QTableWidgetItem(build_remote_name(tx)))
-            self.setItem(n, 2, QTableWidgetItem(tx["purpose"]))
+        self.doubleClicked.connect(self._double_clicked)
 
 
-        # Make columns stretch to fill all available space...
-        self.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
-        # ...except for the first two rows
-        self.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Interactive)
-        self.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.Interactive)
+    def _on_first_rows_inserted(self):
+        self._model.rowsInserted.disconnect(self._on_first_rows_inserted)
         self.resizeColumnsToContents()
 
-        # Users should only be able to select entire rows, not individual cells
-        self.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
 
-        # By default, scrolling moves by entire rows/columns. Use smooth scrolling instead
-        self.setHorizontalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
-        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+    def set_filter(self, filter):
+        self._model.set_filter(filter)
+
+
+    def apply_changes(self, ids):
+        self._model.apply_changes(ids)
+
+
+    def reload(self):
+        self._model.set_filter(self._model._filter)
+
+
+    def _save_scroll_anchor(self, parent, first, last):
+        top = self.indexAt(QPoint(0, 0))
+        if top.isValid():
+            self._scroll_anchor = (QPersistentModelIndex(top), self.visualRect(top).top())
+        else:
+            self._scroll_anchor = None
 
-        self.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
 
-        self.cellDoubleClicked.connect(self._cell_double_clicked)
+    def _restore_scroll_anchor(self, parent, first, last):
+        if self._scroll_anchor == None:
+            return
 
+        anchor, offset = self._scroll_anchor
+        self._scroll_anchor = None
+        if anchor.isValid():
+            delta = self.visualRect(self._model.index(anchor.row(), 0)).top() - offset
+            if delta != 0:
+                scroll_bar = self.verticalScrollBar()
+                scroll_bar.setValue(scroll_bar.value() + delta)
 
-    def _cell_double_clicked(self, row, col):
-        # TODO Careful! This only works as long as the table cannot be filtered.
-        tx = self._transactions[row]
-        TransactionDetails(tx, self._db, self).show()
+
+    def _double_clicked(self, index):
+        tx = self._model.transaction(index.row())
+        TransactionDetails(tx, self._runner, self).show()
+
+
+# Bar chart of the monthly income and expenses with a line for the net total
+class MonthlyChart(QWidget):
+    MARGIN = 40
+
+    INCOME_COLOR = QColor(76, 160, 90)
+    EXPENSE_COLOR = QColor(200, 80, 70)
+    NET_COLOR = QColor(40, 40, 40)
+
+    def __init__(self, *args):
+        QWidget.__init__(self, *args)
+
+        # List of dicts with the keys "month", "income", "expense" and "net"
+        self._months = []
+        self.setMinimumHeight(250)
+        self.setMouseTracking(True)
+
+    def set_months(self, months):
+        self._months = months
+        self.update()
+
+    def _plot_rect(self):
+        return QRectF(self.rect()).adjusted(self.MARGIN, self.MARGIN / 2, -self.MARGIN / 2, -self.MARGIN)
+
+    def _month_at(self, x):
+        rect = self._plot_rect()
+        if not self._months or x < rect.left() or x >= rect.right():
+            return None
+
+        return self._months[int((x - rect.left()) / rect.width() * len(self._months))]
+
+    def paintEvent(self, event):
+        if not self._months:
+            return
+
+        painter = QPainter(self)
+        rect = self._plot_rect()
+
+        max_value = max(max(m["income"] for m in self._months), 1)
+        min_value = min(min(m["expense"] for m in self._months), -1)
+        scale = rect.height() / (max_value - min_value)
+        zero_y = rect.top() + max_value * scale
+        bar_width = rect.width() / len(self._months)
+
+        # Bars
+        painter.setPen(Qt.PenStyle.NoPen)
+        for n, m in enumerate(self._months):
+            x = rect.left() + n * bar_width
+            w = max(bar_width - 1, 1)
+            painter.fillRect(QRectF(x, zero_y - m["income"] * scale, w, m["income"] * scale), self.INCOME_COLOR)
+            painter.fillRect(QRectF(x, zero_y, w, -m["expense"] * scale), self.EXPENSE_COLOR)
+
+        # Net line
+        painter.setPen(QPen(self.NET_COLOR, 2))
+        points = [
+            QPointF(rect.left() + (n + 0.5) * bar_width, zero_y - m["net"] * scale)
+            for n, m in enumerate(self._months)
+        ]
+        painter.drawPolyline(points)
+
+        # Axes and labels. Label the first month of every year (or every month if there are only a few)
+        painter.setPen(QPen(self.palette().text().color()))
+        painter.drawLine(QPointF(rect.left(), zero_y), QPointF(rect.right(), zero_y))
+        painter.drawText(QPointF(2, rect.top() + 10), money.fmt_money(max_value))
+        painter.drawText(QPointF(2, rect.bottom()), money.fmt_money(min_value))
+        for n, m in enumerate(self._months):
+            if len(self._months) <= 24 or m["month"].endswith("-01"):
+                painter.drawText(QPointF(rect.left() + n * bar_width, rect.bottom() + 15), m["month"])
+
+        painter.end()
+
+    def mouseMoveEvent(self, event):
+        m = self._month_at(event.position().x())
+        if m == None:
+            QToolTip.hideText()
+            return
+
+        QToolTip.showText(event.globalPosition().toPoint(), "{}\nEinnahmen: {}\nAusgaben: {}\nSaldo: {}".format(
+            m["month"], money.fmt_money(m["income"]), money.fmt_money(m["expense"]), money.fmt_money(m["net"])
+        ), self)
+
+
+# Overview of income and expenses. Everything shown here is read from monthly_rollups, so it does not
+# matter how many transactions the DB contains.
+class Dashboard(QWidget):
+    CATEGORY_COLUMNS = ["Kategorie", "Einnahmen", "Ausgaben", "Saldo"]
+
+    def __init__(self, runner, *args):
+        QWidget.__init__(self, *args)
+
+        self._runner = runner
+
+        self._account = QComboBox()
+        self._account.addItem("Alle Konten", None)
+        self._year = QComboBox()
+        self._year.addItem("Alle Jahre", None)
+        self._totals = QLabel()
+        self._chart = MonthlyChart()
+        self._categories = QTableWidget(0, len(self.CATEGORY_COLUMNS))
+        self._categories.setHorizontalHeaderLabels(self.CATEGORY_COLUMNS)
+        self._categories.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self._categories.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+
+        filters = QHBoxLayout()
+        filters.addWidget(self._account)
+        filters.addWidget(self._year)
+        filters.addWidget(self._totals, stretch=1)
+
+        layout = QVBoxLayout()
+        layout.addLayout(filters)
+        layout.addWidget(self._chart, stretch=2)
+        layout.addWidget(self._categories, stretch=1)
+        self.setLayout(layout)
+
+        self._account.currentIndexChanged.connect(self.reload)
+        self._year.currentIndexChanged.connect(self.reload)
+
+        runner.submit(
+            "dashboard_accounts",
+            "select account_number from accounts order by account_number", {},
+            self._on_accounts_loaded
+        )
+        runner.submit(
+            "dashboard_years",
+            "select distinct substr(month, 1, 4) as year from monthly_rollups order by year", {},
+            self._on_years_loaded
+        )
+        self.reload()
+
+    def _on_accounts_loaded(self, rows):
+        for r in rows:
+            self._account.addItem(r["account_number"], r["account_number"])
+
+    # Connecting the signals directly to QTimer.start would pick the overload start(int msec), which
+    # uses the argument of the signal (e.g., the index of the account) as the interval
+    def _restart_debounce(self, *args):
+        self._timer.start()
+
+    def _on_years_loaded(self, rows):
+        for r in rows:
+            self._year.addItem(r["year"], r["year"])
+
+    def reload(self):
+        conditions = ["true"]
+        params = {}
+        if self._account.currentData():
+            conditions.append("account_number = :account")
+            params["account"] = self._account.currentData()
+        if self._year.currentData():
+            conditions.append("month between :year || '-01' and :year || '-12'")
+            params["year"] = self._year.currentData()
+        where = " and ".join(conditions)
+
+        self._runner.submit(
+            "dashboard_months",
+            f"""select month, sum(income) as income, sum(expense) as expense, sum(net) as net
+            from monthly_rollups
+            where {where}
+            group by month
+            order by month""",
+            params,
+            self._on_months_loaded
+        )
+        self._runner.submit(
+            "dashboard_categories",
+            f"""select category, sum(income) as income, sum(expense) as expense, sum(net) as net
+            from monthly_rollups
+            where {where}
+            group by category
+            order by expense""",
+            params,
+            self._on_categories_loaded
+        )
+
+    def _on_months_loaded(self, rows):
+        self._chart.set_months(rows)
+        self._totals.setText("Einnahmen: {}   Ausgaben: {}   Saldo: {}".format(
+            money.fmt_money(sum(r["income"] for r in rows)),
+            money.fmt_money(sum(r["expense"] for r in rows)),
+            money.fmt_money(sum(r["net"] for r in rows)),
+        ))
+
+    def _on_categories_loaded(self, rows):
+        self._categories.setRowCount(len(rows))
+        for n, r in enumerate(rows):
+            self._categories.setItem(n, 0, QTableWidgetItem(r["category"] or "(Ohne Kategorie)"))
+            for col, key in enumerate(["income", "expense", "net"], 1):
+                item = QTableWidgetItem(money.fmt_money(r[key]))
+                item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                self._categories.setItem(n, col, item)
 
 
 class MainWindow(QMainWindow):
-    def __init__(self, conn, *args, **kwargs):
+    def __init__(self, runner, change_watcher, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.setWindowTitle('Finanzen')
 
-        transactions = conn.execute("select * from transactions").fetchall()
-        self.tx_table = TransactionTable(transactions, conn, self)
+        self.filter_bar = TransactionFilterBar(runner)
+        self.tx_table = TransactionTable(runner)
+        self.filter_bar.filter_changed.connect(self.tx_table.set_filter)
+        change_watcher.transactions_changed.connect(self.tx_table.apply_changes)
+        change_watcher.reset_required.connect(self.tx_table.reload)
+
+        self.dashboard = Dashboard(runner)
+        change_watcher.transactions_changed.connect(self.dashboard.reload)
+        change_watcher.reset_required.connect(self.dashboard.reload)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.filter_bar)
+        layout.addWidget(self.tx_table)
+        transactions = QWidget()
+        transactions.setLayout(layout)
+
+        tabs = QTabWidget(self)
+        tabs.addTab(transactions, "Buchungen")
+        tabs.addTab(self.dashboard, "Übersicht")
+        self.setCentralWidget(tabs)
+
+        # Show a busy indicator while queries are running in the background
+        self._progress = QProgressBar()
+        self._progress.setRange(0, 0)
+        self._progress.setMaximumWidth(150)
+        self._progress.setVisible(False)
+        self.statusBar().addPermanentWidget(self._progress)
+
+        runner.busy_changed.connect(self._on_busy_changed)
+        runner.progress.connect(self._on_progress)
+        runner.failed.connect(self._on_query_failed)
 
-        self.setCentralWidget(self.tx_table)
         self.show()
 
+    def _on_busy_changed(self, busy):
+        self._progress.setVisible(busy)
+        if busy:
+            self.statusBar().showMessage("Lade Daten...")
+        else:
+            self.statusBar().clearMessage()
 
-# MAIN
-#===================================================================================================
-if len(sys.argv) != 2:
-    print("Usage: gui <TRANSACTIONS_FILE>")
-    sys.exit(1)
+    def _on_progress(self, steps):
+        self.statusBar().showMessage(f"Lade Daten... ({steps})")
 
-db_file = sys.argv[1]
+    def _on_query_failed(self, msg):
+        self.statusBar().showMessage("Fehler: " + msg)
 
-# Init DB
-conn = sqlite3.connect(db_file)
-conn.row_factory = sqlite3.Row
-conn.execute("PRAGMA foreign_keys = ON")
 
-# Init GUI
-app = QApplication([])
-window = MainWindow(conn)
-sys.exit(app.exec())
+# MAIN
+#===================================================================================================
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: gui <TRANSACTIONS_FILE>")
+        sys.exit(1)
+
+    db_file = sys.argv[1]
+
+    # The GUI only reads from the database. Migrating it (which may take a while, see
+    # logic.init_database()) is left to the CLI, which does it whenever it is run.
+    if not os.path.exists(db_file):
+        print(f"Error: {db_file} not found")
+        sys.exit(1)
+    conn = sqlite3.connect(pathlib.Path(db_file).resolve().as_uri() + "?mode=ro", uri=True, timeout=60)
+    outdated = db.schema_outdated(conn)
+    conn.close()
+    if outdated:
+        print("Error: the database has been created by an older version. Run the CLI (e.g., its plan command) to update it first.")
+        sys.exit(1)
+
+    # Init GUI
+    app = QApplication([])
+    runner = QueryRunner(db_file)
+    change_watcher = ChangeWatcher(db_file, runner)
+    window = MainWindow(runner, change_watcher)
+    sys.exit(app.exec())
@@ -5,10 +5,11 @@ import datetime
 import pathlib
 import shutil
 import json
+import hashlib
 from pprint import pprint
-from decimal import Decimal
 
-from . import db
+from . import db, tags, recurring, money
+from .transaction import Transaction
 
 
 # GLOBALS
@@ -24,6 +25,81 @@ LENIENT_VALIDATION_FIELDS = [
     "purpose",
 ]
 
+# Matching transactions may be booked up to this many days apart (see find_matching_transaction())
+MATCHING_DAYS = 20
+
+
+# Computes the rows of monthly_rollups from the transactions matching the condition `{}`
+MONTHLY_ROLLUPS_QUERY = """
+select
+    local_account as account_number,
+    substr(entry_date, 1, 7) as month,
+    coalesce(tag, '') as category,
+    coalesce(sum(value) filter (where matching_txn is null and value > 0), 0) as income,
+    coalesce(sum(value) filter (where matching_txn is null and value < 0), 0) as expense,
+    coalesce(sum(value) filter (where matching_txn is null), 0) as net,
+    coalesce(sum(value) filter (where matching_txn is not null), 0) as transfers,
+    count(*) as num_transactions
+from transactions left join transaction_tags on transaction_id = id
+where {}
+group by local_account, month, category"""
+
+# Computes the rows of abstract_transactions that are derived from the transactions matching the
+# condition `{}`. A matched pair results in a single row whose origin is the transaction with the
+# smaller id. A transfer between own accounts whose counterpart has not been imported yet results in a
+# row where the date of the missing side is null.
+ABSTRACT_TRANSACTIONS_QUERY = """
+select
+    case when t.value < 0 then t.local_account else t.remote_account end as from_account,
+    case when t.value < 0 then t.remote_account else t.local_account end as to_account,
+    abs(t.value) as amount,
+    case when t.value < 0 then t.entry_date else m.entry_date end as from_entry_date,
+    case when t.value < 0 then m.entry_date else t.entry_date end as to_entry_date,
+    t.id as origin_tx_id
+from main.transactions t left join main.transactions m on m.id = t.matching_txn
+where
+    t.value != 0 and
+    (
+        (t.matching_txn is not null and t.id < t.matching_txn) or
+        (
+            t.matching_txn is null and
+            t.local_account in (select account_number from accounts) and
+            t.remote_account in (select account_number from accounts)
+        )
+    ) and
+    ({})"""
+
+ABSTRACT_TRANSACTIONS_INSERTED_BY = "transfers"
+
+
+# Initializing the database
+#===================================================================================================
+# Creates missing tables and brings databases that have been created by older versions up to date
+def init_database(cursor):
+    added_columns = db.create_schema(cursor)
+
+    if ("transaction_records", "display_value") in added_columns:
+        update_display_columns(cursor)
+    if ("transaction_records", "purpose_hash") in added_columns:
+        update_purpose_columns(cursor)
+    if ("transaction_records", "fingerprint") in added_columns:
+        update_fingerprints(cursor)
+    if ("transaction_records", "series_key") in added_columns:
+        recurring.update_series_keys(cursor)
+        recurring.rebuild_series(cursor)
+
+    init_daily_balances(cursor)
+    init_monthly_rollups(cursor)
+    init_abstract_transactions(cursor)
+
+
+# Removes entries from the transaction_changes journal that are older than `max_age_days`
+def prune_transaction_changes(cursor, max_age_days = 30):
+    cursor.execute(
+        "delete from transaction_changes where changed_at < datetime('now', :age)",
+        {"age": f"-{max_age_days} days"}
+    )
+
 
 # Validating new transactions
 #===================================================================================================
@@ -37,6 +113,10 @@ def validate_new_transactions(
     lenient = False
 ):
     # Some basic sanity checks
+    archived_until = db.archived_until(cursor)
+    if archived_until != None and new_start_date <= archived_until:
+        raise RuntimeError(f"Transactions up to {archived_until} have been archived and cannot be changed")
+
     prev_date = new_start_date
     for t in new_transactions:
         if t["local_account"] != account["account_number"]:
@@ -48,6 +128,7 @@ def validate_new_transactions(
             raise RuntimeError("Date of new transaction too large")
 
         prev_date = t["entry_date"]
+        t.update(purpose_columns(t["purpose"]))
 
 
     # Check that new_transactions does not contradict existing information. For this we need to
@@ -131,16 +212,16 @@ def compare_rows(db_row, csv_row, lenient = False):
             return False
 
         if key == "purpose":
-            db_val = db_val.replace("\n", "").replace(" ", "")
-            csv_val = csv_val.replace("\n", "").replace(" ", "")
-
-            if lenient:
-                if db_val and csv_val:
-                    if db_val.find(csv_val) == -1 and csv_val.find(db_val) == -1:
-                        return False
-                elif db_val != csv_val:
-                    return False
-            elif db_val != csv_val:
+            # Both rows contain the precomputed purpose_* columns (see purpose_columns())
+            if db_row["purpose_hash"] == csv_row["purpose_hash"]:
+                continue
+
+            # The normalized purposes differ, but in lenient mode one may still contain the other
+            db_val = db_row["purpose_norm"]
+            csv_val = csv_row["purpose_norm"]
+            if not lenient or not db_val or not csv_val:
+                return False
+            if csv_val not in db_val and db_val not in csv_val:
                 return False
 
         elif db_val != csv_val:
@@ -149,6 +230,26 @@ def compare_rows(db_row, csv_row, lenient = False):
     return True
 
 
+def normalize_purpose(purpose):
+    return purpose.replace("\n", "").replace(" ", "")
+
+
+def purpose_columns(purpose):
+    purpose_norm = normalize_purpose(purpose)
+    return {
+        "purpose_norm": purpose_norm,
+        "purpose_hash": int.from_bytes(hashlib.blake2b(purpose_norm.encode(), digest_size=8).digest(), "big", signed=True),
+    }
+
+
+def update_purpose_columns(cursor):
+    rows = cursor.execute("select id, purpose from transactions").fetchall()
+    cursor.executemany(
+        "update transaction_records set purpose_norm = :purpose_norm, purpose_hash = :purpose_hash where id = :id",
+        [{"id": tx["id"], **purpose_columns(tx["purpose"])} for tx in rows]
+    )
+
+
 def print_diff(db_row, csv_row):
     print("\n=== EXISTING ===")
     for key in csv_row.keys():
@@ -193,14 +294,20 @@ def min_safe(a, b):
 
 # Inserting new transactions into the database
 #===================================================================================================
-# Note that `new_transactions` is modified
+# `new_transactions` is a list of Transactions. Note that they are modified.
+# If `match` is False, matching transactions are not searched for. This is useful when inserting many
+# batches at once, in which case match_transactions() only needs to be called after the last one.
+# `balances` are the balances reported by the bank together with the transactions (see
+# insert_balance_checkpoints()).
 def insert_transactions(
     cursor, account,
     new_transactions, new_start_date, new_end_date,
     fetched_by, fetched,
-    lenient = False
+    lenient = False, match = True, balances = None
 ):
     idx_ranges = validate_new_transactions(cursor, account, new_transactions, new_start_date, new_end_date, lenient)
+    assign_fingerprints(new_transactions)
+    batch_id = begin_import_batch(cursor, account["account_number"], fetched_by, fetched, new_start_date, new_end_date)
 
     min_start_date = cursor.execute(
         "select min(start_date) from intervals where account_number = ?",
@@ -219,31 +326,45 @@ def insert_transactions(
 
     # Insert new transactions into the database
     initial_balance_delta = 0
+    earliest_date = None
+    months = set()
+    inserted = []
+    series_keys = set()
+    counterparty_ids = {}
     counter = 0
     for idx_range in idx_ranges:
         for i in idx_range:
             entry = new_transactions[i]
+            # Transactions outside of known intervals are not validated, so they may already exist
+            # (e.g., when importing an overlapping CSV file)
+            if transaction_exists(cursor, entry["fingerprint"]):
+                continue
+
             entry["total_order"] = total_order_start
             entry["inserted_by"] = fetched_by
             entry["inserted_at"] = fetched
+            entry.update(display_columns(entry))
+            entry["series_key"] = recurring.series_key(entry)
+            entry["counterparty_id"] = get_counterparty_id(cursor, entry, counterparty_ids)
+            entry["batch_id"] = batch_id
             total_order_start += 1
 
-            columns = entry.keys()
-            placeholders = [":" + c for c in columns]
-            cursor.execute(
-                "insert into transactions({}) values({})".format(
-                    ', '.join(columns),
-                    ', '.join(placeholders)
-                ),
-                entry
-            )
+            entry["id"] = cursor.execute(Transaction.INSERT_SQL, entry.to_insert_tuple()).lastrowid
+            inserted.append(entry)
+            if entry["series_key"] != None:
+                series_keys.add(entry["series_key"])
             counter += 1
+            earliest_date = min_safe(earliest_date, entry["entry_date"])
+            months.add(month_of(entry["entry_date"]))
 
-            if entry["entry_date"] < min_start_date:
+            if min_start_date != None and entry["entry_date"] < min_start_date:
                 initial_balance_delta += int(entry["value"])
 
 
-    match_transactions(cursor)
+    tags.tag_transactions(cursor, inserted)
+    if match:
+        match_transactions(cursor)
+    update_abstract_transactions(cursor, [entry["id"] for entry in inserted])
     update_known_intervals(cursor, account, new_start_date, new_end_date)
 
     if initial_balance_delta != 0:
@@ -253,9 +374,164 @@ def insert_transactions(
             {"account": account["account_number"], "delta": initial_balance_delta}
         )
 
+    if earliest_date != None:
+        update_daily_balances(cursor, account["account_number"], earliest_date)
+    update_monthly_rollups(cursor, account["account_number"], months)
+    recurring.update_series(cursor, account["account_number"], series_keys)
+    if balances:
+        insert_balance_checkpoints(cursor, account["account_number"], balances, new_transactions, new_end_date, batch_id)
+
+    cursor.execute(
+        "update import_batches set finished_at = :now, num_transactions = :count where id = :id",
+        {"id": batch_id, "now": datetime.datetime.utcnow().isoformat(" "), "count": counter}
+    )
+
     return counter
 
 
+# Import batches
+#===================================================================================================
+# Records a new import and the state of the account before it. Returns the id of the batch.
+def begin_import_batch(cursor, account_number, backend, fetched, start_date, end_date):
+    intervals = cursor.execute(
+        "select start_date, end_date from intervals where account_number = ? order by start_date",
+        (account_number,)
+    ).fetchall()
+    initial_balance = cursor.execute(
+        "select initial_balance from accounts where account_number = ?",
+        (account_number,)
+    ).fetchone()
+
+    return cursor.execute(
+        """insert into import_batches(
+            account_number, backend, start_date, end_date, fetched_at, started_at,
+            previous_intervals, previous_initial_balance
+        )
+        values(?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            account_number, backend, start_date, end_date, fetched, datetime.datetime.utcnow().isoformat(" "),
+            json.dumps([tuple(i) for i in intervals]), initial_balance["initial_balance"] if initial_balance else 0
+        )
+    ).lastrowid
+
+
+# Undoes the import `batch_id`: its transactions are deleted, the transactions they have been matched
+# with are unmatched, and the intervals and the initial balance of the account are restored. Only the
+# most recent import of an account can be undone, since later imports depend on it. Later imports that
+# have not inserted any transactions (e.g., repeated imports in serve mode) are undone together with
+# it. Returns the undone batches, starting with `batch_id`.
+def undo_import_batch(cursor, batch_id):
+    batch = cursor.execute("select * from import_batches where id = ?", (batch_id,)).fetchone()
+    if batch == None:
+        raise RuntimeError(f"Import batch {batch_id} does not exist")
+
+    account_number = batch["account_number"]
+    later = cursor.execute(
+        "select * from import_batches where account_number = ? and id > ? order by id",
+        (account_number, batch_id)
+    ).fetchall()
+    for b in later:
+        if b["num_transactions"] > 0:
+            raise RuntimeError(f"Import batch {batch_id} cannot be undone because it is followed by batch {b['id']}")
+    batch_ids = [(batch_id,)] + [(b["id"],) for b in later]
+
+    rows = cursor.execute(
+        "select id, entry_date, matching_txn, series_key from transaction_records where batch_id = ?",
+        (batch_id,)
+    ).fetchall()
+    archived_until = db.archived_until(cursor)
+    if archived_until != None and batch["start_date"] <= archived_until:
+        raise RuntimeError(f"Import batch {batch_id} cannot be undone because it contains archived transactions")
+
+    # Unmatch the partners that have not been inserted by this batch
+    ids = {r["id"] for r in rows}
+    partners = [r["matching_txn"] for r in rows if r["matching_txn"] != None and r["matching_txn"] not in ids]
+    touched_months = {}
+    for partner in partners:
+        p = cursor.execute("select local_account, entry_date from transaction_records where id = ?", (partner,)).fetchone()
+        touched_months.setdefault(p["local_account"], set()).add(month_of(p["entry_date"]))
+    delete_abstract_transactions(cursor, ids | set(partners))
+    cursor.executemany("update transaction_records set matching_txn = null where id = ?", [(p,) for p in partners])
+
+    cursor.execute(
+        "delete from transaction_tags where transaction_id in (select id from transaction_records where batch_id = ?)",
+        (batch_id,)
+    )
+    cursor.execute("delete from transaction_records where batch_id = ?", (batch_id,))
+
+    cursor.execute("delete from intervals where account_number = ?", (account_number,))
+    cursor.executemany(
+        "insert into intervals(account_number, start_date, end_date) values(?, ?, ?)",
+        [(account_number, start_date, end_date) for start_date, end_date in json.loads(batch["previous_intervals"])]
+    )
+    initial_balance = cursor.execute(
+        "select initial_balance from accounts where account_number = ?", (account_number,)
+    ).fetchone()["initial_balance"]
+    cursor.execute(
+        "update accounts set initial_balance = ? where account_number = ?",
+        (batch["previous_initial_balance"], account_number)
+    )
+    cursor.executemany("delete from balance_checkpoints where batch_id = ?", batch_ids)
+    cursor.executemany("delete from import_batches where id = ?", batch_ids)
+
+    # Update the derived tables
+    if initial_balance != batch["previous_initial_balance"]:
+        update_daily_balances(cursor, account_number)
+    elif rows:
+        update_daily_balances(cursor, account_number, min(r["entry_date"] for r in rows))
+    update_abstract_transactions(cursor, partners)
+    touched_months.setdefault(account_number, set()).update(month_of(r["entry_date"]) for r in rows)
+    for acc, months in touched_months.items():
+        update_monthly_rollups(cursor, acc, months)
+    recurring.update_series(cursor, account_number, {r["series_key"] for r in rows if r["series_key"] != None})
+
+    return [batch] + later
+
+
+# The fingerprint of a transaction is a hash over LENIENT_VALIDATION_FIELDS (with the purpose
+# normalized as in compare_rows()) and the number of transactions with the same values that precede it
+# on the same day. The latter makes sure that identical transactions on the same day (e.g., two
+# identical card payments) get different fingerprints, while importing the same transactions again
+# results in the same fingerprints. `transactions` must contain all transactions of each day.
+def assign_fingerprints(transactions):
+    counters = {}
+    for tx in transactions:
+        fields = fingerprint_fields(tx)
+        counter = counters.get(fields, 0)
+        counters[fields] = counter + 1
+        tx["fingerprint"] = hashlib.sha1("\x1f".join(fields + (str(counter),)).encode()).hexdigest()
+
+
+def fingerprint_fields(tx):
+    fields = []
+    for key in LENIENT_VALIDATION_FIELDS:
+        value = tx[key]
+        if key == "purpose":
+            value = normalize_purpose(value or "")
+        fields.append("" if value == None else str(value))
+
+    return tuple(fields)
+
+
+def transaction_exists(cursor, fingerprint):
+    return cursor.execute(
+        "select 1 from transactions where fingerprint = ?", (fingerprint,)
+    ).fetchone() != None
+
+
+# Computes the fingerprints of all transactions (e.g., because the database has been created before
+# the fingerprint column existed)
+def update_fingerprints(cursor):
+    rows = [Transaction.from_row(tx) for tx in cursor.execute(
+        "select * from transactions order by local_account, entry_date, total_order"
+    ).fetchall()]
+    assign_fingerprints(rows)
+    cursor.executemany(
+        "update transaction_records set fingerprint = :fingerprint where id = :id",
+        [{"id": tx["id"], "fingerprint": tx["fingerprint"]} for tx in rows]
+    )
+
+
 def update_known_intervals(cursor, account, new_start_date, new_end_date):
     res = cursor.execute(
         """select
@@ -296,24 +572,37 @@ def match_transactions(cursor):
             remote_account in (select account_number from accounts)"""
     ).fetchall()
 
+    # Matched transactions no longer count as income or expense, so the rollups of their months need
+    # to be updated. Maps account numbers to sets of months.
+    touched_months = {}
+    matched_ids = []
     for tx in unmatched:
         match = find_matching_transaction(cursor, tx)
         if not match:
             # TODO Emit warning if...
             continue
 
+        matched_ids += [tx["id"], match["id"]]
+
+        for t in (tx, match):
+            touched_months.setdefault(t["local_account"], set()).add(month_of(t["entry_date"]))
+
         cursor.execute(
-            "update transactions set matching_txn = :match_id where id = :id",
+            "update transaction_records set matching_txn = :match_id where id = :id",
             {"id": tx["id"], "match_id": match["id"]}
         )
         cursor.execute(
-            "update transactions set matching_txn = :match_id where id = :id",
+            "update transaction_records set matching_txn = :match_id where id = :id",
             {"id": match["id"], "match_id": tx["id"]}
         )
 
+    for account_number, months in touched_months.items():
+        update_monthly_rollups(cursor, account_number, months)
+    update_abstract_transactions(cursor, matched_ids)
+
 
 def find_matching_transaction(cursor, tx):
-    time_delta = datetime.timedelta(days=20) # Is that enough?
+    time_delta = datetime.timedelta(days=MATCHING_DAYS) # Is that enough?
     entry_date = datetime.date.fromisoformat(tx["entry_date"])
     matches = cursor.execute(
         """select * from transactions
@@ -348,6 +637,350 @@ def entry_date_diff(tx1, tx2):
     return abs((entry_date1 - entry_date2).days)
 
 
+# Abstract transactions
+#===================================================================================================
+# Updates the rows of abstract_transactions that are derived from the transactions `tx_ids` (which may
+# have been inserted, matched, or deleted) or from their partners. Only these rows are recomputed.
+def update_abstract_transactions(cursor, tx_ids):
+    if not tx_ids:
+        return
+
+    ids = set(tx_ids)
+    ids.update(r[0] for r in cursor.execute(
+        """select matching_txn from transaction_records
+        where id in (select value from json_each(:ids)) and matching_txn is not null
+        union
+        select id from transaction_records where matching_txn in (select value from json_each(:ids))""",
+        {"ids": json.dumps(list(ids))}
+    ))
+
+    delete_abstract_transactions(cursor, ids)
+    cursor.execute(
+        """insert into abstract_transactions(
+            from_account, to_account, amount, from_entry_date, to_entry_date, origin_tx_id, inserted_at, inserted_by
+        )
+        select *, :now, :inserted_by from ({})""".format(
+            ABSTRACT_TRANSACTIONS_QUERY.format("t.id in (select value from json_each(:ids))")
+        ),
+        {
+            "ids": json.dumps(list(ids)),
+            "now": datetime.datetime.utcnow().isoformat(" "),
+            "inserted_by": ABSTRACT_TRANSACTIONS_INSERTED_BY,
+        }
+    )
+
+
+# Deletes the rows of abstract_transactions that have been derived from the transactions `tx_ids`.
+# Must be called before these transactions are deleted.
+def delete_abstract_transactions(cursor, tx_ids):
+    cursor.execute(
+        "delete from abstract_transactions where origin_tx_id in (select value from json_each(?))",
+        (json.dumps(list(tx_ids)),)
+    )
+
+
+# Derives abstract_transactions from all transactions if there are none yet (e.g., because the
+# database has been created before abstract_transactions was filled)
+def init_abstract_transactions(cursor):
+    if cursor.execute("select exists (select * from abstract_transactions where origin_tx_id is not null)").fetchone()[0]:
+        return
+
+    cursor.execute(
+        """insert into abstract_transactions(
+            from_account, to_account, amount, from_entry_date, to_entry_date, origin_tx_id, inserted_at, inserted_by
+        )
+        select *, :now, :inserted_by from ({})""".format(ABSTRACT_TRANSACTIONS_QUERY.format("true")),
+        {"now": datetime.datetime.utcnow().isoformat(" "), "inserted_by": ABSTRACT_TRANSACTIONS_INSERTED_BY}
+    )
+
+
+# Display columns
+#===================================================================================================
+# Returns the precomputed display_* columns of a transaction
+def display_columns(tx):
+    return {
+        "display_remote_name": build_remote_name(tx),
+        "display_account": tx["local_account"].split(":")[-1],
+        "display_value": money.fmt_money(tx["value"]),
+    }
+
+
+def update_display_columns(cursor):
+    rows = cursor.execute("select * from transactions").fetchall()
+    cursor.executemany(
+        """update transaction_records
+        set display_remote_name = :display_remote_name, display_account = :display_account, display_value = :display_value
+        where id = :id""",
+        [{"id": tx["id"], **display_columns(tx)} for tx in rows]
+    )
+
+
+def build_remote_name(tx):
+    remote_name_parts = []
+    if tx["ultimate_debtor"]:
+        remote_name_parts.append(tx["ultimate_debtor"])
+    elif tx["remote_name"]:
+        remote_name_parts.append(tx["remote_name"])
+
+    if tx["remote_account"]:
+        remote_name_parts.append(tx["remote_account"].split(":")[-1])
+
+    if not remote_name_parts:
+        # Credit card transactions don't have a remote account. Thus, we use the first line of
+        # the puspose field, which usually contains the information we want
+        remote_name_parts.append(tx["purpose"].split("\n")[0])
+
+    return "\n".join(remote_name_parts)
+
+
+# Daily balances
+#===================================================================================================
+# Recomputes the entries in daily_balances for all days >= from_date. If from_date is None, all
+# entries of the account are recomputed.
+def update_daily_balances(cursor, account_number, from_date = None):
+    base_balance = None
+    if from_date != None:
+        prev = cursor.execute(
+            """select balance from daily_balances
+            where account_number = :account and date < :date
+            order by date desc limit 1""",
+            {"account": account_number, "date": from_date}
+        ).fetchone()
+        if prev:
+            base_balance = prev["balance"]
+
+    if base_balance == None:
+        base_balance = cursor.execute(
+            "select initial_balance from accounts where account_number = ?",
+            (account_number,)
+        ).fetchone()["initial_balance"]
+
+    cursor.execute(
+        """delete from daily_balances
+        where account_number = :account and (:date is null or date >= :date)""",
+        {"account": account_number, "date": from_date}
+    )
+    cursor.execute(
+        """insert into daily_balances(account_number, date, balance)
+        select
+            local_account,
+            entry_date,
+            :base_balance + sum(sum(value)) over (order by entry_date)
+        from transactions
+        where local_account = :account and (:date is null or entry_date >= :date)
+        group by entry_date""",
+        {"account": account_number, "date": from_date, "base_balance": base_balance}
+    )
+
+
+# Computes daily_balances for all accounts that have transactions but no daily balances (e.g.,
+# because the database has been created before daily_balances existed)
+def init_daily_balances(cursor):
+    accounts = cursor.execute(
+        """select account_number from accounts a
+        where
+            not exists (select * from daily_balances b where b.account_number = a.account_number) and
+            exists (select * from transactions t where t.local_account = a.account_number)"""
+    ).fetchall()
+
+    for acc in accounts:
+        update_daily_balances(cursor, acc["account_number"])
+
+
+# Returns the balance of the account at the end of `date`
+def balance_at(cursor, account_number, date):
+    row = cursor.execute(
+        """select balance from daily_balances
+        where account_number = :account and date <= :date
+        order by date desc limit 1""",
+        {"account": account_number, "date": date}
+    ).fetchone()
+    if row:
+        return row["balance"]
+
+    return cursor.execute(
+        "select initial_balance from accounts where account_number = ?",
+        (account_number,)
+    ).fetchone()["initial_balance"]
+
+
+# Balance checkpoints
+#===================================================================================================
+# Stores the balances reported by the bank (a list of {date, balance}) as checkpoints of import
+# `batch_id`. `transactions` are the transactions that have been fetched together with the balances.
+# Since the transactions of end_date may be incomplete (see `intervals`), balances of end_date or later
+# are moved to the day before by subtracting the fetched transactions of the following days.
+def insert_balance_checkpoints(cursor, account_number, balances, transactions, end_date, batch_id):
+    last_complete_date = str(datetime.date.fromisoformat(end_date) - datetime.timedelta(days=1))
+    checkpoints = {}
+    for b in balances:
+        date = b["date"]
+        balance = int(b["balance"])
+        if date > last_complete_date:
+            balance -= sum(int(t["value"]) for t in transactions if last_complete_date < t["entry_date"] <= date)
+            date = last_complete_date
+        checkpoints[date] = balance
+
+    cursor.executemany(
+        """insert into balance_checkpoints(account_number, date, balance, batch_id) values(?, ?, ?, ?)
+        on conflict(account_number, date) do nothing""",
+        [(account_number, date, balance, batch_id) for date, balance in checkpoints.items()]
+    )
+
+
+# Returns the checkpoints whose balance differs from the balance computed from the transactions (i.e.,
+# the initial balance plus the prefix sums in daily_balances)
+def checkpoint_differences(cursor, account_number = None):
+    return cursor.execute(
+        """select * from (
+            select
+                c.account_number,
+                c.date,
+                c.balance as reported_balance,
+                coalesce(
+                    (
+                        select b.balance from daily_balances b
+                        where b.account_number = c.account_number and b.date <= c.date
+                        order by b.date desc limit 1
+                    ),
+                    a.initial_balance
+                ) as computed_balance
+            from balance_checkpoints c join accounts a on a.account_number = c.account_number
+            where :account is null or c.account_number = :account
+        )
+        where reported_balance != computed_balance
+        order by account_number, date""",
+        {"account": account_number}
+    ).fetchall()
+
+
+# Counterparties
+#===================================================================================================
+# Returns the id of the counterparty of `tx`, which is created if it does not exist yet. `cache` maps
+# the values of db.DB_COUNTERPARTY_COLUMNS to ids, so that each counterparty is only looked up once
+# per import.
+def get_counterparty_id(cursor, tx, cache):
+    key = tuple(tx[c] for c in db.DB_COUNTERPARTY_COLUMNS)
+    if key not in cache:
+        cursor.execute(
+            "insert or ignore into counterparties(remote_account, remote_name, creditor_scheme_id) values(?, ?, ?)",
+            key
+        )
+        cache[key] = cursor.execute(
+            "select id from counterparties where remote_account = ? and remote_name = ? and creditor_scheme_id = ?",
+            key
+        ).fetchone()[0]
+
+    return cache[key]
+
+
+# Monthly rollups
+#===================================================================================================
+def month_of(date):
+    return date[0:7]
+
+
+# Recomputes the entries in monthly_rollups for the given months (in the format YYYY-MM). If `months`
+# is None, all entries of the account are recomputed, except for those of archived years whose
+# transactions are not available (see partitions.py).
+def update_monthly_rollups(cursor, account_number, months = None):
+    if months == None:
+        params = {"account": account_number, "until": db.detached_until(cursor)}
+        cursor.execute(
+            "delete from monthly_rollups where account_number = :account and (:until is null or month > substr(:until, 1, 7))",
+            params
+        )
+        cursor.execute(
+            "insert into monthly_rollups " + MONTHLY_ROLLUPS_QUERY.format(
+                "local_account = :account and (:until is null or entry_date > :until)"
+            ),
+            params
+        )
+        return
+
+    for month in sorted(months):
+        params = {"account": account_number, "month": month}
+        cursor.execute("delete from monthly_rollups where account_number = :account and month = :month", params)
+        # Comparing with "-31" works for all months since dates are stored as YYYY-MM-DD
+        cursor.execute(
+            "insert into monthly_rollups " + MONTHLY_ROLLUPS_QUERY.format(
+                "local_account = :account and entry_date between :month || '-01' and :month || '-31'"
+            ),
+            params
+        )
+
+
+# Computes monthly_rollups for all accounts that have transactions but no rollups (e.g., because the
+# database has been created before monthly_rollups existed)
+def init_monthly_rollups(cursor):
+    accounts = cursor.execute(
+        """select account_number from accounts a
+        where
+            not exists (select * from monthly_rollups r where r.account_number = a.account_number) and
+            exists (select * from transactions t where t.local_account = a.account_number)"""
+    ).fetchall()
+
+    for acc in accounts:
+        update_monthly_rollups(cursor, acc["account_number"])
+
+
+# Recomputes the tags of all transactions and the rollups that depend on them. Needs to be called
+# whenever tag_rules has been changed. The archives must be attached so that the tags and rollups of
+# the archived years are updated as well (see partitions.py).
+def retag_transactions(cursor):
+    if db.detached_until(cursor) != None:
+        raise RuntimeError("The archives must be attached to retag the transactions")
+
+    tags.tag_all_transactions(cursor)
+    for acc in cursor.execute("select account_number from accounts").fetchall():
+        update_monthly_rollups(cursor, acc["account_number"])
+
+
+# Foreign currencies
+#===================================================================================================
+# Returns the transactions in foreign currencies summed up per currency. Each row contains the total
+# in the original currency and in the booked currency, the effective exchange rate of these totals,
+# and the total converted at the most recent exchange rate. The sums are computed by SQLite and each
+# total is converted once, so this only does integer arithmetic on a few values per currency.
+def foreign_currency_totals(cursor, account_number = None, start_date = None, end_date = None):
+    conditions = ["original_value is not null", "original_currency is not null", "original_currency != currency"]
+    params = {}
+    if account_number != None:
+        conditions.append("local_account = :account")
+        params["account"] = account_number
+    if start_date != None:
+        conditions.append("entry_date >= :start_date")
+        params["start_date"] = start_date
+    if end_date != None:
+        conditions.append("entry_date <= :end_date")
+        params["end_date"] = end_date
+
+    # SQLite takes exchange_rate from the row with max(entry_date)
+    rows = cursor.execute(
+        """select
+            original_currency,
+            count(*) as num_transactions,
+            sum(original_value) as original_total,
+            sum(value) as booked_total,
+            max(entry_date) as latest_date,
+            exchange_rate as latest_rate
+        from transactions
+        where {}
+        group by original_currency
+        order by original_currency""".format(" and ".join(conditions)),
+        params
+    ).fetchall()
+
+    totals = []
+    for r in rows:
+        t = dict(r)
+        t["effective_rate"] = money.effective_rate(t["original_total"], t["booked_total"])
+        t["converted_total"] = None if not t["latest_rate"] else money.convert(t["original_total"], t["latest_rate"])
+        totals.append(t)
+
+    return totals
+
+
 # Checking database for consistency
 #===================================================================================================
 class InconsistentTransactionsError(RuntimeError):
@@ -360,10 +993,33 @@ class InconsistentIntervalsError(RuntimeError):
         super().__init__(msg)
         self.inconsistent_intervals = inconsistent_intervals
 
+class InconsistentBalancesError(RuntimeError):
+    def __init__(self, msg, inconsistent_balances):
+        super().__init__(msg)
+        self.inconsistent_balances = inconsistent_balances
+
+class InconsistentRollupsError(RuntimeError):
+    def __init__(self, msg, inconsistent_rollups):
+        super().__init__(msg)
+        self.inconsistent_rollups = inconsistent_rollups
+
+class InconsistentAbstractTransactionsError(RuntimeError):
+    def __init__(self, msg, inconsistent_abstract_transactions):
+        super().__init__(msg)
+        self.inconsistent_abstract_transactions = inconsistent_abstract_transactions
+
+class InconsistentCheckpointsError(RuntimeError):
+    def __init__(self, msg, inconsistent_checkpoints):
+        super().__init__(msg)
+        self.inconsistent_checkpoints = inconsistent_checkpoints
+
 
 def check_consistency(cursor):
     check_transaction_consistency(cursor)
     check_interval_consistency(cursor)
+    check_balance_consistency(cursor)
+    check_rollup_consistency(cursor)
+    check_abstract_transaction_consistency(cursor)
 
 
 def check_transaction_consistency(cursor):
@@ -446,3 +1102,113 @@ def check_interval_consistency(cursor):
             "The following intervals are redundant",
             [dict(i) for i in result]
         )
+
+
+def check_balance_consistency(cursor):
+    # Compare daily_balances with the balances computed from scratch. If the archives are not attached,
+    # only the balances after the archived years can be checked, starting from the last balance of
+    # the archived years.
+    result = cursor.execute(
+        """with expected as (
+            select
+                t.local_account as account_number,
+                t.entry_date as date,
+                coalesce(
+                    (
+                        select b0.balance from daily_balances b0
+                        where b0.account_number = t.local_account and b0.date <= :until
+                        order by b0.date desc limit 1
+                    ),
+                    a.initial_balance
+                ) + sum(sum(t.value)) over (partition by t.local_account order by t.entry_date) as balance
+            from transactions t join accounts a on a.account_number = t.local_account
+            where :until is null or t.entry_date > :until
+            group by t.local_account, t.entry_date
+        )
+        select e.account_number, e.date, e.balance as expected_balance, b.balance as actual_balance
+        from expected e left join daily_balances b on b.account_number = e.account_number and b.date = e.date
+        where b.balance is null or b.balance != e.balance
+
+        union all
+
+        select b.account_number, b.date, null as expected_balance, b.balance as actual_balance
+        from daily_balances b
+        where
+            (:until is null or b.date > :until) and
+            not exists (
+                select * from expected e where e.account_number = b.account_number and e.date = b.date
+            )""",
+        {"until": db.detached_until(cursor)}
+    ).fetchall()
+    if result:
+        raise InconsistentBalancesError(
+            "The following daily balances are inconsistent with the transactions",
+            [dict(b) for b in result]
+        )
+
+
+def check_rollup_consistency(cursor):
+    # Compare monthly_rollups with the rollups computed from scratch (excluding archived years if the
+    # archives are not attached)
+    columns = ["income", "expense", "net", "transfers", "num_transactions"]
+    result = cursor.execute(
+        """with expected as ({})
+        select e.account_number, e.month, e.category, 'expected' as source
+        from expected e
+        where not exists (
+            select * from monthly_rollups r
+            where
+                r.account_number = e.account_number and r.month = e.month and r.category = e.category and
+                ({}) = ({})
+        )
+
+        union all
+
+        select r.account_number, r.month, r.category, 'actual' as source
+        from monthly_rollups r
+        where
+            (:until is null or r.month > substr(:until, 1, 7)) and
+            not exists (
+                select * from expected e
+                where e.account_number = r.account_number and e.month = r.month and e.category = r.category
+            )""".format(
+            MONTHLY_ROLLUPS_QUERY.format("(:until is null or entry_date > :until)"),
+            ", ".join("r." + c for c in columns),
+            ", ".join("e." + c for c in columns)
+        ),
+        {"until": db.detached_until(cursor)}
+    ).fetchall()
+    if result:
+        raise InconsistentRollupsError(
+            "The following monthly rollups are inconsistent with the transactions",
+            [dict(r) for r in result]
+        )
+
+
+# Compares the derived rows of abstract_transactions with matching_txn and the transfers between own
+# accounts
+def check_abstract_transaction_consistency(cursor):
+    columns = "from_account, to_account, amount, from_entry_date, to_entry_date, origin_tx_id"
+    expected = ABSTRACT_TRANSACTIONS_QUERY.format("true")
+    actual = f"select {columns} from abstract_transactions where origin_tx_id is not null"
+    result = cursor.execute(
+        f"""select *, 'expected' as source from ({expected} except {actual})
+        union all
+        select *, 'actual' as source from ({actual} except {expected})"""
+    ).fetchall()
+    if result:
+        raise InconsistentAbstractTransactionsError(
+            "The following abstract transactions are inconsistent with the transactions",
+            [dict(r) for r in result]
+        )
+
+# Compares the balances reported by the bank with the balances computed from the transactions. This is
+# not part of check_consistency() since a difference means that transactions are missing or duplicated,
+# which usually needs to be fixed by importing again, so it must not prevent imports.
+def check_checkpoint_consistency(cursor, account_number = None):
+    result = checkpoint_differences(cursor, account_number)
+    if result:
+        raise InconsistentCheckpointsError(
+            "The balances reported by the bank differ from the balances computed from the transactions",
+            [dict(c) for c in result]
+        )
@@ -0,0 +1,101 @@
+import re
+
+
+# Money amounts and exchange rates
+#===================================================================================================
+# Amounts are stored as integer cents, and exchange rates as integers scaled by RATE_SCALE (i.e.,
+# with RATE_DIGITS decimal places). Everything in this module works on ints and strings, so amounts
+# are never rounded by binary floating point and no Decimal objects are created when importing or
+# aggregating many transactions.
+#
+# Exchange rates are stored as provided by the bank: the number of units of the original currency per
+# unit of the booked currency, i.e., value ~ original_value / exchange_rate.
+
+
+# Globals
+#===================================================================================================
+CENT_DIGITS = 2
+CENTS_PER_UNIT = 10**CENT_DIGITS
+
+RATE_DIGITS = 6
+RATE_SCALE = 10**RATE_DIGITS
+
+AMOUNT_RE = re.compile(r"([+-]?)(\d*)(?:\.(\d*))?")
+
+
+# Parsing
+#===================================================================================================
+# Parses a decimal number like "-1.234,56" and returns it as an int scaled by 10**digits. Additional
+# decimal places are truncated (which is what the backends have always done).
+def parse_fixed(text, digits, decimal_separator = ".", thousands_separator = None):
+    s = text.strip()
+    if thousands_separator:
+        s = s.replace(thousands_separator, "")
+    if decimal_separator and decimal_separator != ".":
+        s = s.replace(decimal_separator, ".")
+
+    m = AMOUNT_RE.fullmatch(s)
+    if not m or not (m.group(2) or m.group(3)):
+        raise RuntimeError(f"Invalid amount: {text!r}")
+
+    sign, whole, frac = m.groups()
+    value = int(whole or "0") * 10**digits + int((frac or "").ljust(digits, "0")[:digits] or "0")
+    return -value if sign == "-" else value
+
+
+def parse_cents(text, decimal_separator = ".", thousands_separator = None):
+    return parse_fixed(text, CENT_DIGITS, decimal_separator, thousands_separator)
+
+
+def parse_rate(text, decimal_separator = "."):
+    return parse_fixed(text, RATE_DIGITS, decimal_separator)
+
+
+# Parses a fraction like "-12345/100" (as used by aqbanking) and returns it in cents
+def parse_fraction_cents(text):
+    numerator, denominator = (int(x) for x in text.split("/"))
+    if (numerator * CENTS_PER_UNIT) % denominator != 0:
+        raise RuntimeError(f"Amount is not a whole number of cents: {text!r}")
+
+    return numerator * CENTS_PER_UNIT // denominator
+
+
+# Formatting
+#===================================================================================================
+def fmt_fixed(value, digits):
+    sign = "-" if value < 0 else ""
+    whole, frac = divmod(abs(value), 10**digits)
+    return f"{sign}{whole}.{frac:0{digits}d}"
+
+
+def fmt_money(cents, symbol = "€"):
+    return fmt_fixed(cents, CENT_DIGITS) + symbol
+
+
+def fmt_rate(rate):
+    return fmt_fixed(rate, RATE_DIGITS)
+
+
+# Arithmetic
+#===================================================================================================
+# Integer division that rounds half away from zero
+def div_round(a, b):
+    q, r = divmod(abs(a), abs(b))
+    if 2 * r >= abs(b):
+        q += 1
+
+    return q if (a < 0) == (b < 0) else -q
+
+
+# Converts an amount in the original currency to the booked currency
+def convert(original_cents, rate):
+    return div_round(original_cents * RATE_SCALE, rate)
+
+
+# Returns the exchange rate (scaled by RATE_SCALE) at which `original_cents` became `booked_cents`, or
+# None if it is undefined
+def effective_rate(original_cents, booked_cents):
+    if booked_cents == 0:
+        return None
+
+    return div_round(original_cents * RATE_SCALE, booked_cents)
@@ -0,0 +1,322 @@
+import os
+import datetime
+import sqlite3
+
+from . import db, logic
+
+
+# Archiving closed years
+#===================================================================================================
+# Almost all queries only touch the last few months, so the transactions of closed years can be moved
+# out of the main database into one file per year (<db_file without extension>.<year>.db), which
+# keeps the main database small. The archived years are registered in `archives` (see
+# db.DB_ARCHIVES_TABLE). Their daily balances and monthly rollups stay in the main database, so
+# balances and reports do not need the archives.
+#
+# Archives are only attached when all transactions are needed (e.g., for exporting or for checking the
+# consistency of the whole database). attach_archives() then creates a TEMP view `transactions` that
+# combines the main database and all archives with UNION ALL. Since the temp schema is searched first,
+# all queries that use `transactions` see every partition without any changes. The same is done for
+# transaction_tags. While the archives are attached, transactions must not be inserted or changed
+# through the connection. Tags are the exception: retagging rewrites the transaction_tags table of each
+# partition and the rollups of all months, so it requires the archives to be attached (see
+# logic.retag_transactions()). Recurring series that reach back into archived years are redetected
+# by reading the archives directly (see recurring.archived_transactions()).
+#
+# Archived transactions may only be matched with other archived transactions (possibly in another
+# archive), so matching_txn in the main database never refers to an archived transaction. This is
+# why transactions that are matched with a transaction after the archived year stay in the main
+# database until that year is archived as well. check_partition_consistency() checks these rules
+# across all partitions.
+
+
+# Globals
+#===================================================================================================
+SCHEMA_PREFIX = "archive_"
+
+TAG_COLUMNS = ["transaction_id", "tag", "rule_id"]
+
+
+class InconsistentPartitionsError(RuntimeError):
+    def __init__(self, msg, inconsistent_transactions):
+        super().__init__(msg)
+        self.inconsistent_transactions = inconsistent_transactions
+
+
+# Utils
+#===================================================================================================
+def main_db_file(conn):
+    db_file = conn.execute("select file from pragma_database_list where name = 'main'").fetchone()[0]
+    if not db_file:
+        raise RuntimeError("Archives can only be used with a database file")
+
+    return db_file
+
+
+def archive_filename(db_file, year):
+    base, ext = os.path.splitext(os.path.basename(db_file))
+    return f"{base}.{year}{ext or '.db'}"
+
+
+def schema_name(year):
+    return f"{SCHEMA_PREFIX}{year}"
+
+
+def attach(conn, db_file, year, filename):
+    conn.execute("attach database ? as " + schema_name(year), (os.path.join(os.path.dirname(db_file), filename),))
+
+
+# Creates the tables of an archive, or adds the columns that have been added to the main database since
+# the archive has been created
+def create_archive_schema(cursor, schema):
+    columns = ", ".join(db.DB_TRANSACTION_RECORD_COLUMNS)
+    cursor.execute(
+        f"create table if not exists {schema}.transaction_records as select {columns} from main.transaction_records where false"
+    )
+    cursor.execute(f"create unique index if not exists {schema}.UK_transaction_records__id on transaction_records(id)")
+    cursor.execute(
+        f"create index if not exists {schema}.IX_transaction_records__local_account_entry_date on transaction_records(local_account, entry_date)"
+    )
+    cursor.execute(
+        f"create table if not exists {schema}.transaction_tags as select {', '.join(TAG_COLUMNS)} from main.transaction_tags where false"
+    )
+    cursor.execute(f"create unique index if not exists {schema}.UK_transaction_tags__transaction_id on transaction_tags(transaction_id)")
+
+    existing = [r[0] for r in cursor.execute("select name from pragma_table_info('transaction_records', ?)", (schema,))]
+    for name, definition in cursor.execute("select name, type from pragma_table_info('transaction_records', 'main')").fetchall():
+        if name in db.DB_TRANSACTION_RECORD_COLUMNS and name not in existing:
+            cursor.execute(f"alter table {schema}.transaction_records add column {name} {definition}")
+
+
+# Archiving
+#===================================================================================================
+# Moves the transactions of all years up to (and including) `until_year` that are not archived yet
+# into archives. Returns the archived years. Must not be called within a transaction.
+def archive_years(conn, until_year, today = None):
+    if today == None:
+        today = datetime.date.today()
+    if until_year >= today.year:
+        raise RuntimeError(f"Cannot archive {until_year}: only past years can be archived")
+    if conn.in_transaction:
+        raise RuntimeError("Cannot archive within a transaction")
+
+    db_file = main_db_file(conn)
+    cursor = conn.cursor()
+    archived_until = db.archived_until(cursor)
+    if archived_until != None:
+        first_year = int(archived_until[0:4]) + 1
+    else:
+        first_date = cursor.execute("select min(entry_date) from main.transaction_records").fetchone()[0]
+        if first_date == None:
+            return []
+        first_year = int(first_date[0:4])
+
+    years = list(range(first_year, until_year + 1))
+    for year in years:
+        archive_year(conn, db_file, year)
+
+    if years:
+        # Release the space of the moved transactions
+        conn.execute("vacuum")
+
+    return years
+
+
+def archive_year(conn, db_file, year):
+    cursor = conn.cursor()
+    end_date = f"{year}-12-31"
+
+    # All transfers of the year must have been matched before it can be archived, so all its accounts
+    # must have been imported for long enough after the end of the year
+    required_end_date = str(datetime.date(year, 12, 31) + datetime.timedelta(days=logic.MATCHING_DAYS))
+    incomplete = cursor.execute(
+        """select distinct local_account from main.transaction_records t
+        where
+            t.entry_date between :start_date and :end_date and
+            not exists (
+                select * from intervals i
+                where i.account_number = t.local_account and i.end_date >= :required_end_date
+            )""",
+        {"start_date": f"{year}-01-01", "end_date": end_date, "required_end_date": required_end_date}
+    ).fetchall()
+    if incomplete:
+        raise RuntimeError(
+            f"Cannot archive {year}: the following accounts have not been imported until {required_end_date}: " +
+            ", ".join(r[0] for r in incomplete)
+        )
+
+    # Transactions that are matched with a transaction after the year stay in the main database. They
+    # are archived together with their partner (into the archive of their own year).
+    rows = cursor.execute(
+        """select t.id, substr(t.entry_date, 1, 4) as year
+        from main.transaction_records t left join main.transaction_records m on m.id = t.matching_txn
+        where t.entry_date <= :end_date and (m.id is null or m.entry_date <= :end_date)""",
+        {"end_date": end_date}
+    ).fetchall()
+    counts = {year: 0}
+    for r in rows:
+        counts[int(r["year"])] = counts.get(int(r["year"]), 0) + 1
+
+    filenames = dict(cursor.execute("select year, filename from main.archives").fetchall())
+    filenames.setdefault(year, archive_filename(db_file, year))
+    for y in counts:
+        attach(conn, db_file, y, filenames[y])
+
+    try:
+        cursor.execute("begin")
+        cursor.execute("create temp table archived_ids(id integer primary key, year integer not null)")
+        cursor.executemany("insert into temp.archived_ids(id, year) values(?, ?)", [(r["id"], int(r["year"])) for r in rows])
+
+        record_columns = ", ".join(db.DB_TRANSACTION_RECORD_COLUMNS)
+        tag_columns = ", ".join(TAG_COLUMNS)
+        for y in sorted(counts):
+            schema = schema_name(y)
+            create_archive_schema(cursor, schema)
+            cursor.execute(
+                f"""insert into {schema}.transaction_records({record_columns})
+                select {record_columns} from main.transaction_records
+                where id in (select id from temp.archived_ids where year = ?)""",
+                (y,)
+            )
+            cursor.execute(
+                f"""insert into {schema}.transaction_tags({tag_columns})
+                select {tag_columns} from main.transaction_tags
+                where transaction_id in (select id from temp.archived_ids where year = ?)""",
+                (y,)
+            )
+            cursor.execute(
+                """insert into main.archives(year, filename, num_transactions, archived_at) values(?, ?, ?, datetime('now'))
+                on conflict(year) do update set num_transactions = num_transactions + excluded.num_transactions""",
+                (y, filenames[y], counts[y])
+            )
+
+        # Abstract transactions can only be derived from transactions in the main database
+        cursor.execute("delete from main.abstract_transactions where origin_tx_id in (select id from temp.archived_ids)")
+        cursor.execute("delete from main.transaction_tags where transaction_id in (select id from temp.archived_ids)")
+        cursor.execute("delete from main.transaction_records where id in (select id from temp.archived_ids)")
+        cursor.execute("drop table temp.archived_ids")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        for y in counts:
+            conn.execute("detach database " + schema_name(y))
+
+
+# Attaching archives
+#===================================================================================================
+# Attaches all archives and makes their transactions visible through `transactions` (see above). Must
+# not be called within a transaction.
+def attach_archives(conn):
+    if conn.in_transaction:
+        raise RuntimeError("Cannot attach archives within a transaction")
+
+    cursor = conn.cursor()
+    archives = cursor.execute("select year, filename from main.archives order by year").fetchall()
+    if not archives:
+        return
+
+    if len(archives) > conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED):
+        raise RuntimeError(f"Cannot attach {len(archives)} archives, SQLite only supports {conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)}")
+
+    db_file = main_db_file(conn)
+    for year, filename in archives:
+        if not os.path.exists(os.path.join(os.path.dirname(db_file), filename)):
+            raise RuntimeError(f"Archive of {year} not found: {filename}")
+        attach(conn, db_file, year, filename)
+        create_archive_schema(cursor, schema_name(year))
+
+    columns = [r[0] for r in cursor.execute("select name from pragma_table_info('transactions', 'main')")]
+    archive_columns = ", ".join(("c." if c in db.DB_COUNTERPARTY_COLUMNS else "t.") + c for c in columns)
+    cursor.execute(
+        "create temp view transactions as select * from main.transactions" + "".join(
+            f"""
+            union all
+            select {archive_columns}
+            from {schema_name(year)}.transaction_records t left join main.counterparties c on c.id = t.counterparty_id"""
+            for year, _ in archives
+        )
+    )
+    cursor.execute(
+        f"create temp view transaction_tags as select {', '.join(TAG_COLUMNS)} from main.transaction_tags" + "".join(
+            f" union all select {', '.join(TAG_COLUMNS)} from {schema_name(year)}.transaction_tags"
+            for year, _ in archives
+        )
+    )
+
+
+def detach_archives(conn):
+    conn.execute("drop view if exists temp.transactions")
+    conn.execute("drop view if exists temp.transaction_tags")
+    for (name,) in conn.execute("select name from pragma_database_list").fetchall():
+        if name.startswith(SCHEMA_PREFIX):
+            conn.execute("detach database " + name)
+
+
+# Checking partitions for consistency
+#===================================================================================================
+# Checks the rules described above. The archives must be attached. The other rules (e.g., that all
+# transactions are part of an interval) are checked by logic.check_consistency(), which covers all
+# partitions while the archives are attached.
+def check_partition_consistency(cursor):
+    archived_until = db.archived_until(cursor)
+    if archived_until == None:
+        return
+    if db.detached_until(cursor) != None:
+        raise RuntimeError("The archives must be attached to check them")
+
+    for (year,) in cursor.execute("select year from main.archives order by year").fetchall():
+        result = cursor.execute(
+            f"""select * from {schema_name(year)}.transaction_records
+            where entry_date not between :start_date and :end_date""",
+            {"start_date": f"{year}-01-01", "end_date": f"{year}-12-31"}
+        ).fetchall()
+        if result:
+            raise InconsistentPartitionsError(
+                f"The following transactions are stored in the archive of {year} but belong to another year",
+                [dict(tx) for tx in result]
+            )
+
+
+    result = cursor.execute(
+        """select t.* from main.transactions t left join transactions m on m.id = t.matching_txn
+        where t.entry_date <= :until and (m.id is null or m.entry_date <= :until)""",
+        {"until": archived_until}
+    ).fetchall()
+    if result:
+        raise InconsistentPartitionsError(
+            "The following transactions belong to an archived year but are stored in the main database",
+            [dict(tx) for tx in result]
+        )
+
+
+    result = cursor.execute("select id, count(*) as count from transactions group by id having count(*) > 1").fetchall()
+    if result:
+        raise InconsistentPartitionsError(
+            "The following transactions are stored in more than one partition",
+            [dict(tx) for tx in result]
+        )
+
+
+    # Deleting a tag rule removes its tags from all partitions
+    result = cursor.execute(
+        "select * from transaction_tags t where not exists (select * from main.tag_rules r where r.id = t.rule_id)"
+    ).fetchall()
+    if result:
+        raise InconsistentPartitionsError(
+            "The following tags refer to tag rules that do not exist",
+            [dict(tag) for tag in result]
+        )
+
+
+    # matching_txn must refer to an existing transaction (in any partition) that refers back
+    result = cursor.execute(
+        """select t.id, t.entry_date, t.matching_txn from transactions t left join transactions m on m.id = t.matching_txn
+        where t.matching_txn is not null and (m.id is null or m.matching_txn is not t.id)"""
+    ).fetchall()
+    if result:
+        raise InconsistentPartitionsError(
+            "The following transactions have an invalid matching_txn",
+            [dict(tx) for tx in result]
+        )
@@ -0,0 +1,133 @@
+import datetime
+
+
+# Planning imports
+#===================================================================================================
+# The intervals of an account (see db.DB_INTERVALS_TABLE) may have holes, e.g., if an import has been
+# skipped for longer than the bank keeps transactions. The planner computes which date ranges need to
+# be fetched so that the intervals of an account reach until today without any holes, using as few
+# requests to the bank as possible:
+#
+# - Every request starts OVERLAP_DAYS before the end of the interval it continues and ends
+#   OVERLAP_DAYS after the start of the interval it leads into. The overlap allows us to detect
+#   transactions that have been inserted after the fact, and banks that silently return fewer
+#   transactions than requested (see logic.validate_new_transactions()).
+# - Requests that are less than MERGE_DAYS apart are merged into a single request. This fetches some
+#   known transactions again, which is cheaper than an additional request (each of which may require
+#   a TAN).
+# - Many banks only return transactions of the last few months (see BANK_HISTORY_DAYS). Requests are
+#   clipped to that limit, and holes that cannot be filled anymore are reported as unreachable. A
+#   clipped request creates a new, disjoint interval.
+#
+# Optionally, a plan can also backfill the time before the first interval.
+
+
+# Globals
+#===================================================================================================
+OVERLAP_DAYS = 4
+
+MERGE_DAYS = 30
+
+# Number of days that banks return transactions for, by bank code. Can be overridden for each account
+# by setting "history_days" in the config of its backend (see accounts.backend_config).
+POSTBANK_HISTORY_DAYS = 90
+BANK_HISTORY_DAYS = {
+    bank_code: POSTBANK_HISTORY_DAYS
+    for bank_code in [
+        "10010010", # Postbank Berlin
+        "20010020", # Postbank Hamburg
+        "25010030", # Postbank Hannover
+        "36010043", # Postbank Essen
+        "37010050", # Postbank Köln
+        "44010046", # Postbank Dortmund
+        "50010060", # Postbank Frankfurt
+        "60010070", # Postbank Stuttgart
+        "66010075", # Postbank Karlsruhe
+        "70010080", # Postbank München
+        "76010085", # Postbank Nürnberg
+    ]
+}
+
+
+# Returns the number of days the bank of `account` returns transactions for when using `backend`, or
+# None if it is not known to be limited
+def history_days(account, backend):
+    config = account["backend_config"].get(backend, {})
+    if "history_days" in config:
+        return config["history_days"]
+
+    return BANK_HISTORY_DAYS.get(account["bank_code"])
+
+
+# Planning
+#===================================================================================================
+# Returns the plan for `account_number`, which is a dict with
+# - requests: list of {start_date, end_date, gaps}, ordered by date. gaps are the (start_date,
+#   end_date) pairs of the holes the request fills. start_date is None if the account does not have
+#   any intervals yet, meaning that all transactions the bank provides are fetched.
+# - unreachable: list of (start_date, end_date) pairs of the holes (or parts thereof) that are
+#   older than the history of the bank
+def plan_account(cursor, account_number, today, history_days = None, backfill_from = None):
+    intervals = cursor.execute(
+        "select start_date, end_date from intervals where account_number = ? order by start_date",
+        (account_number,)
+    ).fetchall()
+    requests, unreachable = plan_requests(
+        [(i["start_date"], i["end_date"]) for i in intervals], today, history_days, backfill_from
+    )
+
+    return {"account_number": account_number, "requests": requests, "unreachable": unreachable}
+
+
+# See plan_account(). All dates are strings.
+def plan_requests(intervals, today, history_days = None, backfill_from = None, merge_days = MERGE_DAYS):
+    earliest = None
+    if history_days != None:
+        earliest = str(datetime.date.fromisoformat(today) - datetime.timedelta(days=history_days))
+
+    # Holes as (start_date, end_date, fetch_start_date, fetch_end_date)
+    holes = []
+    if not intervals:
+        if backfill_from != None:
+            start_date = backfill_from
+        else:
+            # Let the bank decide (or use the limit if it is known)
+            start_date = earliest
+        holes.append((start_date, today, start_date, today))
+    else:
+        if backfill_from != None and backfill_from < intervals[0][0]:
+            holes.append((backfill_from, intervals[0][0], backfill_from, add_days(intervals[0][0], OVERLAP_DAYS)))
+        for (_, prev_end), (next_start, _) in zip(intervals, intervals[1:]):
+            if prev_end < next_start:
+                holes.append((prev_end, next_start, add_days(prev_end, -OVERLAP_DAYS), add_days(next_start, OVERLAP_DAYS)))
+        # The time since the last import
+        last_end = intervals[-1][1]
+        holes.append((last_end, today, add_days(last_end, -OVERLAP_DAYS), today))
+
+    requests = []
+    unreachable = []
+    for start_date, end_date, fetch_start_date, fetch_end_date in holes:
+        if earliest != None and start_date != None and start_date < earliest:
+            unreachable.append((start_date, min(end_date, earliest)))
+            if end_date <= earliest:
+                continue
+            fetch_start_date = earliest
+        elif earliest != None and fetch_start_date != None and fetch_start_date < earliest:
+            # The hole itself can be fetched, but not the whole overlap
+            fetch_start_date = earliest
+
+        fetch_end_date = min(fetch_end_date, today)
+        gap = (start_date, end_date)
+        if requests and requests[-1]["end_date"] >= add_days(fetch_start_date, -merge_days):
+            requests[-1]["end_date"] = max(requests[-1]["end_date"], fetch_end_date)
+            requests[-1]["gaps"].append(gap)
+        else:
+            requests.append({"start_date": fetch_start_date, "end_date": fetch_end_date, "gaps": [gap]})
+
+    return requests, unreachable
+
+
+# Utils
+#===================================================================================================
+def add_days(date, days):
+    return str(datetime.date.fromisoformat(date) + datetime.timedelta(days=days))
@@ -0,0 +1,275 @@
+import os
+import gzip
+import json
+import hashlib
+import sqlite3
+import contextlib
+
+
+# The raw import archive stores the original data we got from the bank for each import. Because
+# consecutive imports overlap (see OVERLAP_DAYS in planner.py) they often contain identical files, so
+# files are stored content-addressed and compressed:
+#
+#   <archive_dir>/objects/<xx>/<sha256>.gz   File contents, keyed by the SHA-256 of the
+#                                            uncompressed data (<xx> are the first two hex digits)
+#   <archive_dir>/manifests/<account>__<imported>.json
+#                                            One manifest per import (this replaces info.ini)
+#   <archive_dir>/index.sqlite               Index over all manifests. It only contains data that is
+#                                            also stored in the manifests and can be recreated with
+#                                            rebuild_index()
+#
+# Older versions stored each import as a plain directory <archive_dir>/<account>__<imported>
+# containing an info.ini file. These can be converted with add_legacy_import().
+
+
+# Globals
+#===================================================================================================
+OBJECTS_DIR = "objects"
+MANIFESTS_DIR = "manifests"
+INDEX_FILENAME = "index.sqlite"
+LEGACY_INFO_FILENAME = "info.ini"
+
+# Stored next to the files of the backend if the bank has reported balances (a JSON list of {date,
+# balance}, see logic.insert_balance_checkpoints())
+BALANCES_FILENAME = "balances.json"
+
+INDEX_IMPORTS_TABLE = """
+create table if not exists imports(
+    manifest text not null,
+    account_number text not null,
+    backend text not null,
+    imported datetime not null,
+    -- The date range requested from the bank. As for `intervals`, end_date is assumed to be
+    -- incomplete
+    start_date date not null,
+    end_date date not null,
+
+    constraint PK_imports__manifest primary key(manifest)
+)"""
+
+INDEX_IMPORTS_INDEX = """
+create index if not exists IX_imports__account_number on imports(account_number, start_date, end_date)
+"""
+
+INDEX_FILES_TABLE = """
+create table if not exists import_files(
+    manifest text not null,
+    name text not null,
+    hash text not null,
+    size integer not null,
+
+    constraint PK_import_files primary key(manifest, name),
+    constraint FK_import_files__manifest foreign key(manifest) references imports(manifest)
+)"""
+
+
+# Writing to the archive
+#===================================================================================================
+# Stores all files in `src_dir` in the archive and records them in a new manifest. Returns the
+# manifest.
+def archive_import(archive_dir, src_dir, account_number, backend, imported, start_date, end_date):
+    paths = [os.path.join(src_dir, name) for name in sorted(os.listdir(src_dir))]
+    return archive_files(
+        archive_dir, [p for p in paths if os.path.isfile(p)],
+        account_number, backend, imported, start_date, end_date
+    )
+
+
+def archive_files(archive_dir, paths, account_number, backend, imported, start_date, end_date):
+    files = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+
+        files[os.path.basename(path)] = {"hash": store_object(archive_dir, data), "size": len(data)}
+
+    manifest = {
+        "name": manifest_name(account_number, imported),
+        "account_number": account_number,
+        "backend": backend,
+        "imported": imported,
+        "start_date": start_date,
+        "end_date": end_date,
+        "files": files,
+    }
+
+    manifests_dir = os.path.join(archive_dir, MANIFESTS_DIR)
+    os.makedirs(manifests_dir, exist_ok=True)
+    write_atomically(
+        os.path.join(manifests_dir, manifest["name"] + ".json"),
+        json.dumps(manifest, indent=4).encode()
+    )
+
+    with open_index(archive_dir) as index:
+        add_to_index(index, manifest)
+
+    return manifest
+
+
+# Stores `data` in the archive unless it already exists. Returns the hash of `data`.
+def store_object(archive_dir, data):
+    h = hashlib.sha256(data).hexdigest()
+    path = object_path(archive_dir, h)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomically(path, gzip.compress(data))
+
+    return h
+
+
+# Converts a directory created by older versions (which simply copied the temp dir of each import)
+# into a manifest. The legacy directory itself is left untouched.
+def add_legacy_import(archive_dir, legacy_dir):
+    info = read_legacy_info(os.path.join(legacy_dir, LEGACY_INFO_FILENAME))
+    account_number = os.path.basename(os.path.normpath(legacy_dir)).split("__")[0]
+
+    paths = [
+        os.path.join(legacy_dir, name) for name in sorted(os.listdir(legacy_dir))
+        if name != LEGACY_INFO_FILENAME
+    ]
+
+    return archive_files(
+        archive_dir, paths, account_number,
+        info["backend"], info["imported"], info["start_date"], info["end_date"]
+    )
+
+
+def read_legacy_info(filename):
+    info = {}
+    with open(filename) as f:
+        for line in f:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                info[key.strip()] = value.strip()
+
+    return info
+
+
+# Reading from the archive
+#===================================================================================================
+# Returns the manifests of all imports of `account_number` whose requested date range intersects
+# [start_date, end_date], ordered by the time of the import. Both dates are optional.
+def find_imports(archive_dir, account_number, start_date = None, end_date = None):
+    with open_index(archive_dir) as index:
+        rows = index.execute(
+            """select manifest from imports
+            where
+                account_number = :account and
+                (:end_date is null or start_date <= :end_date) and
+                (:start_date is null or end_date >= :start_date)
+            order by imported""",
+            {"account": account_number, "start_date": start_date, "end_date": end_date}
+        ).fetchall()
+
+    return [read_manifest(archive_dir, r["manifest"]) for r in rows]
+
+
+# Returns the manifests of all imports, ordered by account and the time of the import
+def all_imports(archive_dir):
+    with open_index(archive_dir) as index:
+        rows = index.execute("select manifest from imports order by account_number, imported").fetchall()
+
+    return [read_manifest(archive_dir, r["manifest"]) for r in rows]
+
+
+def read_manifest(archive_dir, name):
+    with open(os.path.join(archive_dir, MANIFESTS_DIR, name + ".json")) as f:
+        return json.load(f)
+
+
+def read_object(archive_dir, h):
+    with open(object_path(archive_dir, h), "rb") as f:
+        return gzip.decompress(f.read())
+
+
+# Writes all files of an import to `dest_dir`
+def extract_import(archive_dir, manifest, dest_dir):
+    for name, info in manifest["files"].items():
+        with open(os.path.join(dest_dir, name), "wb") as f:
+            f.write(read_object(archive_dir, info["hash"]))
+
+
+# Removing imports
+#===================================================================================================
+# Removes the manifest of an import (e.g., after the import has been undone). The stored files are
+# kept since other imports may refer to the same objects. Returns whether the import existed.
+def remove_import(archive_dir, account_number, imported):
+    name = manifest_name(account_number, imported)
+    filename = os.path.join(archive_dir, MANIFESTS_DIR, name + ".json")
+    if not os.path.exists(filename):
+        return False
+
+    with open_index(archive_dir) as index:
+        index.execute("delete from import_files where manifest = ?", (name,))
+        index.execute("delete from imports where manifest = ?", (name,))
+    os.remove(filename)
+
+    return True
+
+
+# Index
+#===================================================================================================
+# Opens the index and commits all changes when the `with` block is left without an exception
+@contextlib.contextmanager
+def open_index(archive_dir):
+    os.makedirs(archive_dir, exist_ok=True)
+    index = sqlite3.connect(os.path.join(archive_dir, INDEX_FILENAME))
+    index.row_factory = sqlite3.Row
+    index.execute("PRAGMA foreign_keys = ON")
+    try:
+        with index:
+            index.execute(INDEX_IMPORTS_TABLE)
+            index.execute(INDEX_IMPORTS_INDEX)
+            index.execute(INDEX_FILES_TABLE)
+            yield index
+    finally:
+        index.close()
+
+
+def add_to_index(index, manifest):
+    index.execute("delete from import_files where manifest = ?", (manifest["name"],))
+    index.execute("delete from imports where manifest = ?", (manifest["name"],))
+    index.execute(
+        """insert into imports(manifest, account_number, backend, imported, start_date, end_date)
+        values(:name, :account_number, :backend, :imported, :start_date, :end_date)""",
+        manifest
+    )
+    index.executemany(
+        "insert into import_files(manifest, name, hash, size) values(?, ?, ?, ?)",
+        [(manifest["name"], name, f["hash"], f["size"]) for name, f in manifest["files"].items()]
+    )
+
+
+# Recreates the index from the manifests. Legacy import directories are converted on the way.
+def rebuild_index(archive_dir):
+    manifests_dir = os.path.join(archive_dir, MANIFESTS_DIR)
+    os.makedirs(manifests_dir, exist_ok=True)
+
+    known = {name[:-len(".json")] for name in os.listdir(manifests_dir) if name.endswith(".json")}
+    for name in sorted(os.listdir(archive_dir)):
+        legacy_dir = os.path.join(archive_dir, name)
+        if name not in known and os.path.isfile(os.path.join(legacy_dir, LEGACY_INFO_FILENAME)):
+            known.add(add_legacy_import(archive_dir, legacy_dir)["name"])
+
+    with open_index(archive_dir) as index:
+        index.execute("delete from import_files")
+        index.execute("delete from imports")
+        for name in sorted(known):
+            add_to_index(index, read_manifest(archive_dir, name))
+
+
+# Utils
+#===================================================================================================
+def manifest_name(account_number, imported):
+    return account_number + "__" + imported
+
+
+def object_path(archive_dir, h):
+    return os.path.join(archive_dir, OBJECTS_DIR, h[0:2], h + ".gz")
+
+
+def write_atomically(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
@@ -0,0 +1,154 @@
+import os
+import json
+import tempfile
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from . import db, logic, raw_archive
+from .backend_aqbanking import aqbanking_parse_csv
+from .backend_fints import fints_parse_json
+from .backend_csv import csv_parse_file
+
+
+# Rebuilding the database from the raw import archive
+#===================================================================================================
+# Creates a fresh database at `dest_filename` by replaying all imports stored in the raw import
+# archive. Accounts are taken from `src_conn` since they are not part of the archive.
+#
+# Parsing the archived files is the expensive part, so it is done in parallel. The transactions are
+# then inserted per account in the order in which they have been imported originally, all in a single
+# DB transaction. Matching and the consistency checks are only done once at the end.
+#
+# Apart from that, every import goes through logic.insert_transactions() like a regular import: it is
+# validated against the transactions inserted by the imports before it, and the derived tables (tags,
+# abstract transactions, daily balances, monthly rollups, series and balance checkpoints) are updated
+# separately for each import. This is cheap compared to parsing, and it makes sure that the rebuilt
+# database is the same as one that has been built by importing.
+def rebuild_database(src_conn, dest_filename, archive_dir, lenient = False, processes = None):
+    if os.path.exists(dest_filename):
+        raise RuntimeError(f"{dest_filename} already exists")
+
+    raw_archive.rebuild_index(archive_dir)
+
+    accounts = {}
+    for row in src_conn.execute("select * from accounts").fetchall():
+        acc = dict(row)
+        acc["backend_config"] = json.loads(acc["backend_config"])
+        accounts[acc["account_number"]] = acc
+
+    imports = [m for m in raw_archive.all_imports(archive_dir) if m["account_number"] in accounts]
+    with ProcessPoolExecutor(processes) as pool:
+        parsed = list(pool.map(
+            parse_import,
+            [archive_dir] * len(imports),
+            imports,
+            [accounts[m["account_number"]] for m in imports]
+        ))
+
+    temp_filename = dest_filename + ".tmp"
+    if os.path.exists(temp_filename):
+        os.remove(temp_filename)
+
+    dest_conn = sqlite3.connect(temp_filename)
+    dest_conn.row_factory = sqlite3.Row
+    dest_conn.execute("PRAGMA foreign_keys = ON")
+    # If something goes wrong we simply delete the file, so there is no need for a rollback journal
+    dest_conn.execute("PRAGMA journal_mode = OFF")
+    dest_conn.execute("PRAGMA synchronous = OFF")
+    try:
+        cursor = dest_conn.cursor()
+        db.create_schema(cursor)
+
+        load_accounts(cursor, accounts.values())
+        num_transactions = 0
+        for manifest, (transactions, balances) in zip(imports, parsed):
+            num_transactions += logic.insert_transactions(
+                cursor, accounts[manifest["account_number"]],
+                transactions, manifest["start_date"], manifest["end_date"],
+                manifest["backend"], manifest["imported"],
+                lenient, match = False, balances = balances
+            )
+
+        logic.match_transactions(cursor)
+        restore_balances(src_conn, cursor)
+        logic.check_consistency(cursor)
+
+        cursor.close()
+        dest_conn.commit()
+    except:
+        dest_conn.close()
+        os.remove(temp_filename)
+        raise
+
+    dest_conn.close()
+    os.replace(temp_filename, dest_filename)
+
+    return len(imports), num_transactions
+
+
+# Runs in a worker process. Returns the transactions and the balances reported by the bank.
+def parse_import(archive_dir, manifest, account):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        raw_archive.extract_import(archive_dir, manifest, temp_dir)
+
+        balances = []
+        if raw_archive.BALANCES_FILENAME in manifest["files"]:
+            with open(os.path.join(temp_dir, raw_archive.BALANCES_FILENAME)) as f:
+                balances = json.load(f)
+
+        backend = manifest["backend"]
+        if backend == "aqbanking":
+            return aqbanking_parse_csv(os.path.join(temp_dir, "transactions.csv"), account), balances
+        elif backend == "fints":
+            return fints_parse_json(os.path.join(temp_dir, "transactions.json"), account), balances
+        elif backend == "csv":
+            [filename] = [name for name in manifest["files"] if name != raw_archive.BALANCES_FILENAME]
+            return csv_parse_file(
+                os.path.join(temp_dir, filename), account,
+                manifest["start_date"], manifest["end_date"], account["backend_config"]["csv"]
+            ), balances
+        else:
+            raise RuntimeError(f"{manifest['name']}: unsupported backend: {backend}")
+
+
+def load_accounts(cursor, accounts):
+    for acc in accounts:
+        acc = dict(acc)
+        acc["backend_config"] = json.dumps(acc["backend_config"])
+        cursor.execute(
+            "insert into accounts({}) values({})".format(
+                ', '.join(acc.keys()),
+                ', '.join(":" + c for c in acc.keys())
+            ),
+            acc
+        )
+
+
+# initial_balance has been adjusted by every import that added transactions before the first known
+# interval, so we cannot simply replay these adjustments. Instead, we make sure that the current
+# balance of each account is the same as in the source database. The current balance is taken from
+# daily_balances, which (unlike transactions) also covers the archived years without attaching the
+# archives (see partitions.py).
+def restore_balances(src_conn, cursor):
+    src_balances = src_conn.execute(
+        """select
+            a.account_number,
+            coalesce(
+                (
+                    select b.balance from daily_balances b
+                    where b.account_number = a.account_number
+                    order by b.date desc limit 1
+                ),
+                a.initial_balance
+            ) as balance
+        from accounts a"""
+    ).fetchall()
+
+    for row in src_balances:
+        cursor.execute(
+            """update accounts
+            set initial_balance = :balance - (select coalesce(sum(value), 0) from transactions where local_account = :account)
+            where account_number = :account""",
+            {"account": row["account_number"], "balance": row["balance"]}
+        )
+        logic.update_daily_balances(cursor, row["account_number"])
@@ -0,0 +1,273 @@
+import os
+import re
+import datetime
+import itertools
+import pathlib
+import sqlite3
+import statistics
+
+try:
+    import numpy
+except ImportError:
+    # Only needed to detect all series at once (see detect_all_series())
+    numpy = None
+
+from . import db
+
+
+# Detecting recurring payments
+#===================================================================================================
+# Transactions are grouped by account and series key (see series_key()), which is stored in the
+# transactions table so that the transactions of a series can be read in one pass over
+# IX_transactions__series_key, already sorted by date. For each group, the intervals between
+# consecutive transactions are computed, and the group is considered a recurring series if most of
+# them are close to one of the PERIODS.
+#
+# When all series are redetected, the interval and amount statistics of all groups are computed at once
+# with grouped NumPy operations (see detect_all_series()). Imports only redetect the few series they
+# have added transactions to, which is done per series in Python.
+
+
+# Globals
+#===================================================================================================
+# (name, nominal number of days, tolerance in days)
+PERIODS = [
+    ("weekly", 7, 1),
+    ("biweekly", 14, 2),
+    ("monthly", 30, 4),
+    ("quarterly", 91, 8),
+    ("half-yearly", 182, 12),
+    ("yearly", 365, 20),
+]
+
+# A series must consist of at least that many transactions
+MIN_OCCURRENCES = 3
+
+# Fraction of intervals of a series that must be within the tolerance of its period
+MIN_REGULAR_FRACTION = 0.75
+
+SERIES_COLUMNS = ["local_account", "series_key", "entry_date", "total_order", "value", "remote_name"]
+
+
+# Series keys
+#===================================================================================================
+# Returns the key of the series that `tx` may belong to, or None if it cannot be assigned to one.
+# SEPA direct debits are identified by their mandate, everything else by the other party. Incoming
+# and outgoing payments are never part of the same series.
+def series_key(tx):
+    direction = "+" if int(tx["value"]) >= 0 else "-"
+    if tx["mandate_id"]:
+        return f"{direction}mandate:{tx['creditor_scheme_id']}/{tx['mandate_id']}"
+
+    remote_account = (tx["remote_account"] or "").strip()
+    remote_name = normalize_name(tx["remote_name"])
+    if not remote_account and not remote_name:
+        return None
+
+    return f"{direction}party:{remote_account}/{remote_name}"
+
+
+# Removes everything from a name that tends to change between payments to the same party (e.g.,
+# reference numbers)
+def normalize_name(name):
+    return " ".join(re.sub(r"[\W\d_]+", " ", (name or "").casefold()).split())
+
+
+def update_series_keys(cursor):
+    rows = cursor.execute("select * from transactions").fetchall()
+    cursor.executemany(
+        "update transaction_records set series_key = :series_key where id = :id",
+        [{"id": tx["id"], "series_key": series_key(tx)} for tx in rows]
+    )
+
+
+# Detection
+#===================================================================================================
+# Returns the recurring_series row for the given transactions of a series (sorted by date), or None
+# if they are not regular enough
+def detect_series(transactions):
+    if len(transactions) < MIN_OCCURRENCES:
+        return None
+
+    dates = [datetime.date.fromisoformat(tx["entry_date"]) for tx in transactions]
+    intervals = [(b - a).days for a, b in zip(dates, dates[1:])]
+    median_interval = statistics.median(intervals)
+
+    for period in PERIODS:
+        _, days, tolerance = period
+        if abs(median_interval - days) <= tolerance:
+            break
+    else:
+        return None
+
+    num_regular = sum(1 for i in intervals if abs(i - days) <= tolerance)
+    if num_regular < MIN_REGULAR_FRACTION * len(intervals):
+        return None
+
+    return series_row(transactions, period, median_interval, statistics.median(int(tx["value"]) for tx in transactions))
+
+
+# Like detect_series(), but for all series at once. `rows` must be sorted by local_account, series_key
+# and entry_date. Returns the rows of the detected series.
+def detect_all_series(rows):
+    if numpy == None or not rows:
+        groups = itertools.groupby(rows, key=lambda tx: (tx["local_account"], tx["series_key"]))
+        return [series for series in (detect_series(list(txs)) for _, txs in groups) if series]
+
+    keys = [(tx["local_account"], tx["series_key"]) for tx in rows]
+    starts = numpy.flatnonzero([i == 0 or keys[i] != keys[i - 1] for i in range(len(keys))])
+    sizes = numpy.diff(numpy.r_[starts, len(rows)])
+    group = numpy.repeat(numpy.arange(len(starts)), sizes)
+    dates = numpy.array([tx["entry_date"] for tx in rows], dtype="datetime64[D]")
+    values = numpy.array([int(tx["value"]) for tx in rows], dtype=numpy.int64)
+
+    # Intervals between consecutive transactions of the same series
+    same_group = group[1:] == group[:-1]
+    intervals = (dates[1:] - dates[:-1]).astype(numpy.int64)[same_group]
+    interval_group = group[1:][same_group]
+    median_intervals = grouped_medians(interval_group, intervals, len(starts))
+    median_values = grouped_medians(group, values, len(starts))
+
+    # The first period whose tolerance contains the median interval, as in detect_series()
+    days = numpy.array([d for _, d, _ in PERIODS])
+    tolerances = numpy.array([t for _, _, t in PERIODS])
+    fits = numpy.abs(median_intervals[:, None] - days[None, :]) <= tolerances[None, :]
+    period = numpy.argmax(fits, axis=1)
+
+    interval_period = period[interval_group]
+    is_regular = numpy.abs(intervals - days[interval_period]) <= tolerances[interval_period]
+    num_regular = numpy.bincount(interval_group, weights=is_regular, minlength=len(starts))
+
+    detected = (sizes >= MIN_OCCURRENCES) & fits.any(axis=1) & (num_regular >= MIN_REGULAR_FRACTION * (sizes - 1))
+    return [
+        series_row(
+            rows[starts[g]:starts[g] + sizes[g]], PERIODS[period[g]],
+            float(median_intervals[g]), float(median_values[g])
+        )
+        for g in numpy.flatnonzero(detected)
+    ]
+
+
+# Returns the median of `values` for each group in range(num_groups), or NaN for empty groups. `groups`
+# must be sorted.
+def grouped_medians(groups, values, num_groups):
+    counts = numpy.bincount(groups, minlength=num_groups)
+    if len(values) == 0:
+        return numpy.full(num_groups, numpy.nan)
+
+    sorted_values = values[numpy.lexsort((values, groups))]
+    offsets = numpy.cumsum(counts) - counts
+    lower = numpy.minimum(offsets + (counts - 1) // 2, len(values) - 1)
+    upper = numpy.minimum(offsets + counts // 2, len(values) - 1)
+
+    return numpy.where(counts > 0, (sorted_values[lower] + sorted_values[upper]) / 2, numpy.nan)
+
+
+def series_row(transactions, period, median_interval, median_value):
+    name, days, tolerance = period
+    last = transactions[-1]
+    next_expected = datetime.date.fromisoformat(last["entry_date"]) + datetime.timedelta(days=days)
+    return {
+        "account_number": last["local_account"],
+        "series_key": last["series_key"],
+        "remote_name": last["remote_name"],
+        "period": name,
+        "interval_days": round(median_interval),
+        "typical_value": round(median_value),
+        "num_transactions": len(transactions),
+        "first_date": transactions[0]["entry_date"],
+        "last_date": last["entry_date"],
+        "next_expected_date": str(next_expected),
+        "overdue_date": str(next_expected + datetime.timedelta(days=tolerance)),
+    }
+
+
+def insert_series(cursor, detected):
+    if detected:
+        columns = detected[0].keys()
+        cursor.executemany(
+            "insert into recurring_series({}) values({})".format(
+                ", ".join(columns),
+                ", ".join(":" + c for c in columns)
+            ),
+            detected
+        )
+
+
+# Redetects all series, in a single pass over all transactions
+def rebuild_series(cursor):
+    cursor.execute("delete from recurring_series")
+    rows = cursor.execute(
+        """select {} from transactions
+        where series_key is not null
+        order by local_account, series_key, entry_date, total_order""".format(", ".join(SERIES_COLUMNS))
+    ).fetchall()
+
+    insert_series(cursor, detect_all_series(rows))
+
+
+# Redetects the series with the given keys after new transactions have been inserted
+def update_series(cursor, account_number, keys):
+    archived = archived_transactions(cursor, account_number, keys)
+    for key in sorted(keys):
+        cursor.execute(
+            "delete from recurring_series where account_number = ? and series_key = ?",
+            (account_number, key)
+        )
+        rows = cursor.execute(
+            """select {} from transactions
+            where local_account = ? and series_key = ?
+            order by entry_date, total_order""".format(", ".join(SERIES_COLUMNS)),
+            (account_number, key)
+        ).fetchall()
+        if archived.get(key):
+            rows = sorted(archived[key] + rows, key=lambda tx: (tx["entry_date"], tx["total_order"]))
+
+        series = detect_series(rows)
+        insert_series(cursor, [series] if series else [])
+
+
+# Returns the archived transactions of the series with the given keys (as a dict by key) if the archives
+# are not attached (see partitions.py). Since archives cannot be attached within a transaction, each
+# archive is read through a separate read-only connection.
+def archived_transactions(cursor, account_number, keys):
+    if not keys or db.detached_until(cursor) == None:
+        return {}
+
+    db_dir = os.path.dirname(cursor.execute("select file from pragma_database_list where name = 'main'").fetchone()[0])
+    columns = ", ".join("counterparty_id" if c == "remote_name" else c for c in SERIES_COLUMNS)
+    rows = []
+    for year, filename in cursor.execute("select year, filename from main.archives order by year").fetchall():
+        archive_file = os.path.join(db_dir, filename)
+        if not os.path.exists(archive_file):
+            raise RuntimeError(f"Archive of {year} not found: {filename}")
+
+        conn = sqlite3.connect(pathlib.Path(archive_file).resolve().as_uri() + "?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            for key in keys:
+                rows += [dict(r) for r in conn.execute(
+                    f"select {columns} from transaction_records where local_account = ? and series_key = ?",
+                    (account_number, key)
+                )]
+        finally:
+            conn.close()
+
+    # The counterparties are stored in the main database
+    result = {}
+    for tx in rows:
+        counterparty = cursor.execute(
+            "select remote_name from counterparties where id = ?", (tx.pop("counterparty_id"),)
+        ).fetchone()
+        tx["remote_name"] = counterparty[0] if counterparty else None
+        result.setdefault(tx["series_key"], []).append(tx)
+
+    return result
+
+
+# Returns all series whose next payment should have arrived before `date`
+def missing_payments(cursor, date):
+    return cursor.execute(
+        "select * from recurring_series where overdue_date < ? order by overdue_date",
+        (date,)
+    ).fetchall()
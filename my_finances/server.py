@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import datetime
+import json
+import socket
+import socketserver
+
+
+# Serve mode
+#===================================================================================================
+# In serve mode the process keeps running so that the DB connection (including its statement
+# cache) and the backend clients (e.g., FinTS sessions) are only set up once. Imports are run for
+# each account according to a schedule, and can also be triggered via a UNIX socket (see
+# send_server_command()). Requests and responses are single lines of JSON.
+#
+# Note that everything runs on a single thread, so a request that arrives during an import is only
+# handled after the import has finished.
+#
+# The import itself is done by `import_transactions(conn, account, options)` (see
+# cli.import_transactions()), which returns the number of new transactions.
+class ServerState:
+    def __init__(self, conn, accounts, options, import_transactions):
+        self.conn = conn
+        self.import_transactions = import_transactions
+        self.accounts = {acc["account_number"]: acc for acc in accounts}
+        self.options = options
+        self.started = time.time()
+        self.stopped = False
+
+        # Time (as returned by time.time()) of the next scheduled import for each account. Accounts
+        # with an interval of 0 are only imported on request.
+        self.next_run = {}
+        for acc in self.accounts:
+            if self.interval(acc) > 0:
+                self.next_run[acc] = self.started
+
+        # Information about the last import of each account
+        self.last_runs = {}
+
+    def interval(self, account_number):
+        hours = self.options["schedule"].get(account_number, self.options["interval_hours"])
+        return hours * 3600
+
+    def seconds_until_next_run(self):
+        if not self.next_run:
+            return None
+
+        return max(0, min(self.next_run.values()) - time.time())
+
+    def run_due_imports(self):
+        now = time.time()
+        for acc, t in list(self.next_run.items()):
+            if t <= now:
+                self.run_import(acc)
+
+    def run_import(self, account_number):
+        start = time.time()
+        run = {"started": datetime.datetime.fromtimestamp(start).isoformat(" ", "seconds")}
+        try:
+            run["num_new_transactions"] = self.import_transactions(self.conn, self.accounts[account_number], self.options)
+            run["status"] = "ok"
+        except Exception as e:
+            self.conn.rollback()
+            run["status"] = "error"
+            run["error"] = str(e)
+            print(f"Import of {account_number} failed: {e}", file=sys.stderr)
+
+        run["duration"] = time.time() - start
+        self.last_runs[account_number] = run
+        if account_number in self.next_run:
+            self.next_run[account_number] = start + self.interval(account_number)
+
+        return run
+
+    def handle(self, request):
+        command = request.get("command")
+        if command == "import":
+            accounts = [request["account"]] if request.get("account") else list(self.accounts)
+            for acc in accounts:
+                if acc not in self.accounts:
+                    return {"status": "error", "error": "Unknown account: " + acc}
+
+            return {"status": "ok", "runs": {acc: self.run_import(acc) for acc in accounts}}
+        elif command == "status":
+            return {
+                "status": "ok",
+                "uptime": time.time() - self.started,
+                "accounts": {
+                    acc: {
+                        "next_run": datetime.datetime.fromtimestamp(self.next_run[acc]).isoformat(" ", "seconds")
+                                    if acc in self.next_run else None,
+                        "last_status": self.last_runs.get(acc, {}).get("status"),
+                    }
+                    for acc in self.accounts
+                },
+            }
+        elif command == "timings":
+            return {"status": "ok", "runs": self.last_runs}
+        elif command == "stop":
+            self.stopped = True
+            return {"status": "ok"}
+        else:
+            return {"status": "error", "error": f"Invalid command: {command}"}
+
+
+class ServerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            response = self.server.state.handle(json.loads(self.rfile.readline()))
+        except Exception as e:
+            response = {"status": "error", "error": str(e)}
+
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def serve(conn, accounts, options, import_transactions):
+    socket_path = options["socket"]
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    with socketserver.UnixStreamServer(socket_path, ServerRequestHandler) as server:
+        os.chmod(socket_path, 0o600)
+        server.state = ServerState(conn, accounts, options, import_transactions)
+        print(f"Listening on {socket_path}")
+
+        try:
+            while not server.state.stopped:
+                server.timeout = server.state.seconds_until_next_run()
+                server.handle_request()
+                server.state.run_due_imports()
+        finally:
+            os.remove(socket_path)
+
+
+def send_server_command(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
@@ -0,0 +1,254 @@
+import os
+import json
+
+import numpy
+
+from . import db, partitions
+
+
+# Columnar snapshots
+#===================================================================================================
+# A snapshot contains all transactions as NumPy column arrays, sorted by (entry_date, local_account,
+# total_order). Within each account this is the order of total_order, so running balances can be
+# computed directly, and date ranges can be selected by binary search.
+#
+# Snapshots are cached next to the database in <db_file>.snapshot/ as one .npy file per column, which
+# are memory-mapped when loading. The cache is valid as long as the watermark stored in meta.json
+# matches the database. The watermark consists of the largest transaction id and the last seq of the
+# transaction_changes journal, which is incremented by every insert, update and delete (see
+# db.DB_TRANSACTION_CHANGES_TABLE).
+#
+# Snapshots contain the transactions of all partitions, so the archives are attached while building a
+# snapshot (see partitions.py). Archiving moves transactions between partitions, which is why the
+# watermark also contains the number of archived transactions.
+
+
+# Globals
+#===================================================================================================
+META_FILENAME = "meta.json"
+
+# Columns that are stored as .npy files, in addition to the labels of the categorical columns
+COLUMNS = [
+    "id",
+    "account", # Index into Snapshot.accounts
+    "counterparty", # Index into Snapshot.counterparties
+    "entry_date",
+    "valuta_date",
+    "value",
+    "is_transfer", # Whether the transaction has a matching transaction
+    "total_order",
+]
+
+LABEL_COLUMNS = [
+    "accounts",
+    "counterparties",
+    "initial_balances", # Indexed by account
+]
+
+CHUNK_SIZE = 10000
+
+
+class Snapshot:
+    def __init__(self, arrays):
+        for name in COLUMNS + LABEL_COLUMNS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.id)
+
+    # Returns a snapshot containing only the rows selected by `key`, which may be a slice, a boolean
+    # mask or an index array. The labels are shared.
+    def __getitem__(self, key):
+        arrays = {name: getattr(self, name)[key] for name in COLUMNS}
+        arrays.update({name: getattr(self, name) for name in LABEL_COLUMNS})
+        return Snapshot(arrays)
+
+    # Returns the slice of all transactions with start_date <= entry_date <= end_date. Both dates are
+    # optional.
+    def date_slice(self, start_date = None, end_date = None):
+        start = 0
+        end = len(self)
+        if start_date != None:
+            start = numpy.searchsorted(self.entry_date, numpy.datetime64(start_date, "D"), side="left")
+        if end_date != None:
+            end = numpy.searchsorted(self.entry_date, numpy.datetime64(end_date, "D"), side="right")
+
+        return slice(start, end)
+
+    def account_code(self, account_number):
+        return self.accounts.tolist().index(account_number)
+
+    def months(self):
+        return self.entry_date.astype("datetime64[M]")
+
+
+# Loading and caching
+#===================================================================================================
+# Returns the snapshot of the database. If `cache_dir` is None, <db_file>.snapshot is used (or no
+# cache at all for in-memory databases). If there are archives, this must not be called within a
+# transaction unless the archives are already attached.
+def load_snapshot(conn, cache_dir = None):
+    if cache_dir == None:
+        cache_dir = default_cache_dir(conn)
+
+    watermark = compute_watermark(conn)
+    if cache_dir != None:
+        cached = read_cache(cache_dir, watermark)
+        if cached != None:
+            return cached
+
+    detached = db.detached_until(conn) != None
+    if detached:
+        partitions.attach_archives(conn)
+    try:
+        snapshot = build_snapshot(conn)
+    finally:
+        if detached:
+            partitions.detach_archives(conn)
+
+    if cache_dir != None:
+        write_cache(cache_dir, snapshot, watermark)
+        # Return the memory-mapped arrays so that the snapshot does not need to stay in memory
+        return read_cache(cache_dir, watermark)
+
+    return snapshot
+
+
+def default_cache_dir(conn):
+    db_file = conn.execute("select file from pragma_database_list where name = 'main'").fetchone()[0]
+    if not db_file:
+        return None
+
+    return db_file + ".snapshot"
+
+
+def compute_watermark(conn):
+    row = conn.execute(
+        """select
+            (select coalesce(max(id), 0) from main.transaction_records),
+            (select coalesce(max(seq), 0) from sqlite_sequence where name = 'transaction_changes'),
+            (select coalesce(sum(num_transactions), 0) from main.archives)"""
+    ).fetchone()
+    return {"max_id": row[0], "max_change_seq": row[1], "num_archived": row[2]}
+
+
+def build_snapshot(conn):
+    columns = {name: [] for name in ["id", "local_account", "counterparty", "entry_date", "valuta_date", "value", "matching_txn", "total_order"]}
+    cursor = conn.execute(
+        """select
+            id,
+            local_account,
+            case when remote_account != '' then remote_account else remote_name end as counterparty,
+            entry_date,
+            valuta_date,
+            value,
+            matching_txn,
+            total_order
+        from transactions
+        order by entry_date, local_account, total_order"""
+    )
+    names = [d[0] for d in cursor.description]
+    while rows := cursor.fetchmany(CHUNK_SIZE):
+        for name, values in zip(names, zip(*rows)):
+            columns[name].extend(values)
+    cursor.close()
+
+    accounts = conn.execute("select account_number, initial_balance from accounts order by account_number").fetchall()
+    account_labels = numpy.array([a[0] for a in accounts], dtype=str)
+    counterparty_labels, counterparty_codes = numpy.unique(
+        numpy.array([c or "" for c in columns["counterparty"]], dtype=str),
+        return_inverse=True
+    )
+
+    return Snapshot({
+        "id": numpy.array(columns["id"], dtype=numpy.int64),
+        "account": numpy.searchsorted(account_labels, numpy.array(columns["local_account"], dtype=str)).astype(numpy.int32),
+        "counterparty": counterparty_codes.astype(numpy.int32),
+        "entry_date": numpy.array(columns["entry_date"], dtype="datetime64[D]"),
+        "valuta_date": numpy.array(columns["valuta_date"], dtype="datetime64[D]"),
+        "value": numpy.array(columns["value"], dtype=numpy.int64),
+        "is_transfer": numpy.array([m != None for m in columns["matching_txn"]], dtype=bool),
+        "total_order": numpy.array(columns["total_order"], dtype=numpy.int64),
+        "accounts": account_labels,
+        "counterparties": counterparty_labels,
+        "initial_balances": numpy.array([a[1] for a in accounts], dtype=numpy.int64),
+    })
+
+
+def read_cache(cache_dir, watermark):
+    try:
+        with open(os.path.join(cache_dir, META_FILENAME)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if meta["watermark"] != watermark:
+        return None
+
+    # Empty files cannot be memory-mapped
+    mmap_mode = "r" if meta["num_transactions"] > 0 else None
+    return Snapshot({
+        name: numpy.load(os.path.join(cache_dir, name + ".npy"), mmap_mode=mmap_mode if name in COLUMNS else None)
+        for name in COLUMNS + LABEL_COLUMNS
+    })
+
+
+def write_cache(cache_dir, snapshot, watermark):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Invalidate the cache first so that an interrupted write does not leave an inconsistent cache
+    meta_filename = os.path.join(cache_dir, META_FILENAME)
+    if os.path.exists(meta_filename):
+        os.remove(meta_filename)
+
+    for name in COLUMNS + LABEL_COLUMNS:
+        filename = os.path.join(cache_dir, name + ".npy")
+        with open(filename + ".tmp", "wb") as f:
+            numpy.save(f, getattr(snapshot, name), allow_pickle=False)
+        os.replace(filename + ".tmp", filename)
+
+    with open(meta_filename + ".tmp", "w") as f:
+        json.dump({"watermark": watermark, "num_transactions": len(snapshot)}, f)
+    os.replace(meta_filename + ".tmp", meta_filename)
+
+
+# Analysis
+#===================================================================================================
+# Sums up `values` for each distinct key. Returns the sorted distinct keys and the sums.
+def grouped_sums(keys, values):
+    unique_keys, codes = numpy.unique(keys, return_inverse=True)
+    sums = numpy.zeros(len(unique_keys), dtype=values.dtype)
+    numpy.add.at(sums, codes, values)
+
+    return unique_keys, sums
+
+
+# Returns the balance of the account after each transaction
+def running_balances(snapshot):
+    if len(snapshot) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    # Group by account while keeping the order within each account
+    order = numpy.argsort(snapshot.account, kind="stable")
+    accounts = snapshot.account[order]
+    values = snapshot.value[order]
+
+    totals = numpy.cumsum(values)
+    group_starts = numpy.flatnonzero(numpy.r_[True, accounts[1:] != accounts[:-1]])
+    group_sizes = numpy.diff(numpy.r_[group_starts, len(values)])
+    # Sum of all transactions of the preceding accounts
+    offsets = numpy.repeat(totals[group_starts] - values[group_starts], group_sizes)
+
+    balances = numpy.empty_like(totals)
+    balances[order] = totals - offsets + snapshot.initial_balances[accounts]
+    return balances
+
+
+# Returns the income and expenses per month, excluding transfers between own accounts
+def monthly_income_and_expenses(snapshot):
+    s = snapshot[~snapshot.is_transfer]
+    months = s.months()
+    income_months, income = grouped_sums(months[s.value > 0], s.value[s.value > 0])
+    expense_months, expenses = grouped_sums(months[s.value < 0], s.value[s.value < 0])
+
+    return (income_months, income), (expense_months, expenses)
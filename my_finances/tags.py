@@ -0,0 +1,220 @@
+import re
+import sys
+
+from . import db
+
+
+# Tagging transactions
+#===================================================================================================
+# Transactions are tagged according to the rules in tag_rules (see db.DB_TAG_RULES_TABLE). Instead
+# of trying every rule for every transaction, all rules are compiled into a TagMatcher:
+#
+# - Exact rules are stored in one dict per field, so they are a single hash lookup no matter how many
+#   rules there are.
+# - All regex rules of a field are combined into a single regular expression of the form
+#   (?P<r0>.*?(?:pattern0))|(?P<r1>.*?(?:pattern1))|..., ordered by priority. Since the expression is
+#   anchored at the start, the regex engine tries the alternatives in order and the first one that
+#   matches is the rule with the highest priority. Its index is the name of the outermost matching
+#   group (Match.lastgroup).
+#
+# Because the rules are combined, regex patterns must be valid on their own and must not contain
+# backreferences, named groups or global flags like (?i) (all patterns are case-insensitive anyway).
+# add_rule() rejects such patterns (see check_regex()), and rules that have been added before are
+# skipped with a warning.
+
+
+# Globals
+#===================================================================================================
+TAG_FIELDS = [
+    "purpose",
+    "remote_name",
+    "remote_account",
+    "creditor_scheme_id",
+    "mandate_id",
+]
+
+RULE_KINDS = [
+    "exact",
+    "regex",
+]
+
+# Number of transactions that are read from the database at once when retagging all transactions
+CHUNK_SIZE = 5000
+
+
+# Matching
+#===================================================================================================
+class TagMatcher:
+    def __init__(self, rules):
+        # The position of a rule in this list is its rank. Lower ranks win.
+        self._rules = sorted((dict(r) for r in rules), key=lambda r: (r["priority"], r["id"]))
+
+        # Maps normalized values to ranks, for each field
+        self._exact = {}
+        regex_alternatives = {}
+        for rank, rule in enumerate(self._rules):
+            if rule["kind"] == "exact":
+                self._exact.setdefault(rule["field"], {}).setdefault(normalize_exact_value(rule["pattern"]), rank)
+            else:
+                try:
+                    check_regex(rule["pattern"])
+                except RuntimeError as e:
+                    print(f"Warning: ignoring tag rule {rule['id']}: {e}", file=sys.stderr)
+                    continue
+                regex_alternatives.setdefault(rule["field"], []).append(wrap_regex(rule["pattern"], rank))
+
+        self._regexes = {
+            field: re.compile("|".join(alternatives), re.IGNORECASE | re.DOTALL)
+            for field, alternatives in regex_alternatives.items()
+        }
+
+    def is_empty(self):
+        return not self._rules
+
+    # Returns the rule that matches `tx`, or None
+    def match(self, tx):
+        best_rank = None
+        for field, values in self._exact.items():
+            rank = values.get(normalize_exact_value(tx[field]))
+            if rank != None and (best_rank == None or rank < best_rank):
+                best_rank = rank
+
+        for field, regex in self._regexes.items():
+            m = regex.match(tx[field] or "")
+            if m and m.lastgroup != None:
+                rank = int(m.lastgroup[1:])
+                if best_rank == None or rank < best_rank:
+                    best_rank = rank
+
+        return None if best_rank == None else self._rules[best_rank]
+
+
+def wrap_regex(pattern, rank):
+    return f"(?P<r{rank}>.*?(?:{pattern}))"
+
+
+# Raises a RuntimeError if `pattern` cannot be combined with other patterns (see above)
+def check_regex(pattern):
+    try:
+        # Patterns that are only valid within the wrapper (e.g., "a))|((b") would change the meaning
+        # of the combined expression, so the pattern is compiled on its own first
+        own = re.compile(pattern, re.IGNORECASE | re.DOTALL)
+        compiled = re.compile(wrap_regex(pattern, 0), re.IGNORECASE | re.DOTALL)
+    except re.error as e:
+        raise RuntimeError(f"Invalid regular expression {pattern!r}: {e}")
+
+    # The wrapper must only add its own group
+    if compiled.groups != own.groups + 1:
+        raise RuntimeError(f"Invalid regular expression {pattern!r}: unbalanced parentheses")
+    if len(compiled.groupindex) > 1:
+        raise RuntimeError(f"Invalid regular expression {pattern!r}: named groups are not allowed")
+    if has_backreference(pattern):
+        raise RuntimeError(f"Invalid regular expression {pattern!r}: backreferences are not allowed")
+
+
+def has_backreference(pattern):
+    if "(?P=" in pattern or "(?(" in pattern:
+        return True
+
+    idx = 0
+    while idx < len(pattern):
+        if pattern[idx] == "\\" and idx + 1 < len(pattern):
+            if pattern[idx + 1] in "123456789":
+                return True
+            idx += 2
+        else:
+            idx += 1
+
+    return False
+
+
+def normalize_exact_value(value):
+    return (value or "").strip().casefold()
+
+
+def load_matcher(cursor):
+    return TagMatcher(cursor.execute("select * from tag_rules").fetchall())
+
+
+# Tags the given transactions (dicts or rows that contain "id" and all TAG_FIELDS), which must be
+# stored in `schema` (see partitions.py). Transactions that already have a tag are retagged.
+def tag_transactions(cursor, transactions, matcher = None, schema = "main"):
+    if matcher == None:
+        matcher = load_matcher(cursor)
+    if matcher.is_empty():
+        return
+
+    tagged = []
+    for tx in transactions:
+        rule = matcher.match(tx)
+        if rule:
+            tagged.append((tx["id"], rule["tag"], rule["id"]))
+
+    cursor.executemany(
+        f"insert or replace into {schema}.transaction_tags(transaction_id, tag, rule_id) values(?, ?, ?)",
+        tagged
+    )
+
+
+# Recomputes the tags of all transactions (e.g., after the rules have been changed), including the
+# archived ones if the archives are attached. Note that the monthly rollups need to be updated
+# afterwards (see logic.retag_transactions()).
+def tag_all_transactions(cursor):
+    matcher = load_matcher(cursor)
+    fields = ", ".join(("c." if f in db.DB_COUNTERPARTY_COLUMNS else "r.") + f for f in TAG_FIELDS)
+    for schema in db.transaction_schemas(cursor):
+        cursor.execute(f"delete from {schema}.transaction_tags")
+        if matcher.is_empty():
+            continue
+
+        last_id = -1
+        while True:
+            chunk = cursor.execute(
+                f"""select r.id, {fields}
+                from {schema}.transaction_records r left join main.counterparties c on c.id = r.counterparty_id
+                where r.id > ?
+                order by r.id
+                limit ?""",
+                (last_id, CHUNK_SIZE)
+            ).fetchall()
+            if not chunk:
+                break
+
+            tag_transactions(cursor, chunk, matcher, schema)
+            last_id = chunk[-1]["id"]
+
+
+# Managing rules
+#===================================================================================================
+def add_rule(cursor, tag, field, kind, pattern, priority = 0):
+    if field not in TAG_FIELDS:
+        raise RuntimeError("Invalid field for tag rule: " + field)
+    if kind not in RULE_KINDS:
+        raise RuntimeError("Invalid kind of tag rule: " + kind)
+    if kind == "regex":
+        check_regex(pattern)
+
+    return cursor.execute(
+        "insert into tag_rules(tag, field, kind, pattern, priority) values(?, ?, ?, ?, ?)",
+        (tag, field, kind, pattern, priority)
+    ).lastrowid
+
+
+# The archives must be attached, since the archived transactions may have been tagged by the rule
+def delete_rule(cursor, rule_id):
+    if db.detached_until(cursor) != None:
+        raise RuntimeError("The archives must be attached to delete tag rules")
+
+    for schema in db.transaction_schemas(cursor):
+        cursor.execute(f"delete from {schema}.transaction_tags where rule_id = ?", (rule_id,))
+    cursor.execute("delete from tag_rules where id = ?", (rule_id,))
+
+
+# Returns all rules together with the number of transactions they have tagged
+def rule_stats(cursor):
+    return cursor.execute(
+        """select r.*, count(t.transaction_id) as hits
+        from tag_rules r left join transaction_tags t on t.rule_id = r.id
+        group by r.id
+        order by r.priority, r.id"""
+    ).fetchall()
@@ -0,0 +1,114 @@
+from . import db
+
+
+# Transactions
+#===================================================================================================
+# A transaction as created by the backends and inserted by logic.insert_transactions(). Using
+# __slots__ instead of a dict per transaction considerably reduces memory usage when parsing large
+# imports or rebuilding the database (see tests/benchmark_memory.py).
+#
+# Fields can also be accessed as tx["name"], so code can handle Transactions and sqlite3.Row objects
+# alike. Fields that have not been set are None.
+class Transaction:
+    # Columns that are computed from the data columns by logic.insert_transactions()
+    DERIVED_COLUMNS = [
+        "display_remote_name",
+        "display_account",
+        "display_value",
+        "purpose_norm",
+        "purpose_hash",
+        "series_key",
+        "fingerprint",
+    ]
+
+    INSERT_COLUMNS = db.DB_TRANSACTION_DATA_COLUMNS + DERIVED_COLUMNS + [
+        "total_order",
+        "inserted_at",
+        "inserted_by",
+        "batch_id",
+    ]
+
+    # The counterparty columns are stored in the counterparties table, which is referenced by
+    # counterparty_id (see db.DB_TRANSACTIONS_TABLE)
+    RECORD_COLUMNS = [c for c in INSERT_COLUMNS if c not in db.DB_COUNTERPARTY_COLUMNS] + ["counterparty_id"]
+
+    INSERT_SQL = "insert into transaction_records({}) values({})".format(
+        ", ".join(RECORD_COLUMNS),
+        ", ".join("?" for _ in RECORD_COLUMNS)
+    )
+
+    __slots__ = ["id", "matching_txn", "counterparty_id"] + INSERT_COLUMNS
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        tx = cls.__new__(cls)
+        for name, value in zip(row.keys(), row):
+            if name in SLOTS:
+                setattr(tx, name, value)
+
+        return tx
+
+    # Returns the values for Transaction.INSERT_SQL
+    def to_insert_tuple(self):
+        return tuple(getattr(self, name) for name in self.RECORD_COLUMNS)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr_set(self, name)}
+
+    # Only called for slots that have not been set yet (and for unknown attributes)
+    def __getattr__(self, name):
+        if name in SLOTS:
+            return None
+
+        raise AttributeError(name)
+
+    def __getitem__(self, name):
+        if name not in SLOTS:
+            raise KeyError(name)
+
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in SLOTS:
+            raise KeyError(name)
+
+        setattr(self, name, value)
+
+    def get(self, name, default = None):
+        if name not in SLOTS:
+            return default
+
+        return getattr(self, name)
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def update(self, fields):
+        for name, value in fields.items():
+            self[name] = value
+
+    # Transactions are sent between processes when rebuilding the database
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.update(state)
+
+    def __repr__(self):
+        return f"Transaction({self.to_dict()!r})"
+
+
+SLOTS = frozenset(Transaction.__slots__)
+
+
+# Whether the slot `name` has been set (hasattr() is always True because of __getattr__)
+def hasattr_set(tx, name):
+    try:
+        object.__getattribute__(tx, name)
+        return True
+    except AttributeError:
+        return False
@@ -0,0 +1,36 @@
+import tracemalloc
+
+from my_finances import db
+from my_finances.transaction import Transaction
+
+
+# Compares the memory used by transactions stored as dicts (as the backends used to create them) and
+# as Transaction objects. Only the containers are measured since the field values are the same in
+# both cases. Run with: python -m tests.benchmark_memory
+NUM_TRANSACTIONS = 100_000
+
+
+def make_fields(n):
+    fields = {c: f"{c}-{n}" for c in db.DB_TRANSACTION_DATA_COLUMNS}
+    fields["value"] = n
+    return fields
+
+
+def measure(create):
+    all_fields = [make_fields(n) for n in range(NUM_TRANSACTIONS)]
+
+    tracemalloc.start()
+    transactions = [create(fields) for fields in all_fields]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return size
+
+
+dict_size = measure(dict)
+transaction_size = measure(lambda fields: Transaction(**fields))
+
+print(f"{NUM_TRANSACTIONS} transactions")
+print(f"dict:        {dict_size / 2**20:7.2f} MiB ({dict_size / NUM_TRANSACTIONS:.0f} bytes per transaction)")
+print(f"Transaction: {transaction_size / 2**20:7.2f} MiB ({transaction_size / NUM_TRANSACTIONS:.0f} bytes per transaction)")
+print(f"Reduction:   {(1 - transaction_size / dict_size) * 100:.0f}%")
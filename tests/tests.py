@@ -1,8 +1,34 @@
+import io
+import os
+import json
+import random
+import datetime
+import itertools
 import sqlite3
+import tempfile
 import unittest
 from pprint import pprint
 
-from my_finances import db, logic
+from my_finances import db, logic, raw_archive, export, tags, recurring, money, partitions, backups, planner, server
+from my_finances.transaction import Transaction
+
+try:
+    import numpy
+    from my_finances import snapshot
+except ImportError:
+    numpy = None
+
+try:
+    from my_finances import rebuild, backend_csv, backend_fints
+except ImportError:
+    # The backends need fints and schwifty
+    rebuild = None
+
+try:
+    from PyQt6.QtWidgets import QApplication
+    from my_finances import gui
+except ImportError:
+    gui = None
 
 
 class Test(unittest.TestCase):
@@ -13,9 +39,7 @@ class Test(unittest.TestCase):
         self.conn.row_factory = sqlite3.Row
         self.conn.execute("PRAGMA foreign_keys = ON")
 
-        self.conn.execute(db.DB_TRANSACTIONS_TABLE)
-        self.conn.execute(db.DB_ACCOUNTS_TABLE)
-        self.conn.execute(db.DB_INTERVALS_TABLE)
+        db.create_schema(self.conn)
 
 
     def tearDown(self):
@@ -79,8 +103,618 @@ class Test(unittest.TestCase):
 
 
 
+    # Tests: Daily balances
+    #---------------------------------------------------------------------------
+    def test_daily_balances(self):
+        self.insert_account("A")
+        self.conn.execute("update accounts set initial_balance = 1000 where account_number = 'A'")
+        account = {"account_number": "A"}
+
+        logic.insert_transactions(self.conn, account, [
+            make_transaction("A", "", "2023-09-02", -100),
+            make_transaction("A", "", "2023-09-02", -50),
+            make_transaction("A", "", "2023-09-05", 300),
+        ], "2023-09-01", "2023-09-06", "test", "2023-09-06 12:00:00")
+        logic.check_consistency(self.conn)
+
+        self.assertEqual(logic.balance_at(self.conn, "A", "2023-09-01"), 1000)
+        self.assertEqual(logic.balance_at(self.conn, "A", "2023-09-02"), 850)
+        self.assertEqual(logic.balance_at(self.conn, "A", "2023-09-04"), 850)
+        self.assertEqual(logic.balance_at(self.conn, "A", "2023-09-30"), 1150)
+
+        # Transactions before the first interval change the initial balance but not the balances
+        # of later days. (Only check the balances since total_order is not yet handled correctly
+        # when inserting before existing transactions.)
+        logic.insert_transactions(self.conn, account, [
+            make_transaction("A", "", "2023-08-20", 200),
+            make_transaction("A", "", "2023-09-02", -100),
+            make_transaction("A", "", "2023-09-02", -50),
+        ], "2023-08-15", "2023-09-03", "test", "2023-09-07 12:00:00")
+        logic.check_balance_consistency(self.conn)
+
+        self.assertEqual(logic.balance_at(self.conn, "A", "2023-08-19"), 800)
+        self.assertEqual(logic.balance_at(self.conn, "A", "2023-08-20"), 1000)
+        self.assertEqual(logic.balance_at(self.conn, "A", "2023-09-30"), 1150)
+
+        self.conn.execute("update daily_balances set balance = 0 where date = '2023-09-05'")
+        with self.assertRaises(logic.InconsistentBalancesError):
+            logic.check_balance_consistency(self.conn)
+
+
+    # Tests: Fingerprints
+    #---------------------------------------------------------------------------
+    def test_reimport_outside_of_intervals_is_idempotent(self):
+        self.insert_account("A")
+        account = {"account_number": "A"}
+
+        def transactions():
+            return [
+                make_transaction("A", "", "2023-09-02", -100, purpose="Karte 1"),
+                make_transaction("A", "", "2023-09-02", -100, purpose="Karte  1"),
+                make_transaction("A", "", "2023-09-03", 50),
+            ]
+
+        self.assertEqual(logic.insert_transactions(self.conn, account, transactions(), "2023-09-01", "2023-09-04", "test", "2023-09-04 12:00:00"), 3)
+
+        # Without a known interval the new transactions are not validated against the existing ones
+        self.conn.execute("delete from intervals")
+        self.assertEqual(logic.insert_transactions(self.conn, account, transactions(), "2023-09-01", "2023-09-04", "test", "2023-09-05 12:00:00"), 0)
+        self.assertEqual(self.conn.execute("select count(*) from transactions").fetchone()[0], 3)
+
+        # The database itself rejects duplicates
+        fingerprint = self.conn.execute("select fingerprint from transactions where value = 50").fetchone()[0]
+        with self.assertRaises(sqlite3.IntegrityError):
+            insert_transaction(self.conn, "A", "", "2023-09-03", 50, 10, fingerprint=fingerprint)
+
+
+    def test_lenient_purpose_comparison(self):
+        self.insert_account("A")
+        account = {"account_number": "A"}
+        logic.insert_transactions(self.conn, account, [
+            make_transaction("A", "", "2023-09-02", -100, purpose="Miete September\nWohnung 3"),
+        ], "2023-09-01", "2023-09-04", "test", "2023-09-04 12:00:00")
+        row = self.conn.execute("select * from transactions").fetchone()
+        self.assertEqual(row["purpose_norm"], "MieteSeptemberWohnung3")
+
+        def compare(purpose, lenient):
+            tx = make_transaction("A", "", "2023-09-02", -100, purpose=purpose)
+            tx.update(logic.purpose_columns(tx["purpose"]))
+            return logic.compare_rows(row, tx, lenient)
+
+        self.assertTrue(compare("Miete September Wohnung 3", False))
+        self.assertFalse(compare("Miete September", False))
+        self.assertTrue(compare("Miete September", True))
+        self.assertFalse(compare("Miete Oktober", True))
+
+
+    # Tests: Monthly rollups
+    #---------------------------------------------------------------------------
+    def test_monthly_rollups(self):
+        self.insert_account("A")
+        self.insert_account("B")
+
+        logic.insert_transactions(self.conn, {"account_number": "A"}, [
+            make_transaction("A", "", "2023-08-31", 1000),
+            make_transaction("A", "B", "2023-09-01", -300),
+            make_transaction("A", "", "2023-09-02", -50),
+            make_transaction("A", "", "2023-09-30", 20),
+        ], "2023-08-30", "2023-10-01", "test", "2023-10-01 12:00:00")
+        self.assertEqual(self.rollup("A", "2023-08"), (1000, 0, 1000, 0, 1))
+        self.assertEqual(self.rollup("A", "2023-09"), (20, -350, -330, 0, 3))
+
+        # Once the counterpart arrives the transfer is no longer counted as expense
+        logic.insert_transactions(self.conn, {"account_number": "B"}, [
+            make_transaction("B", "A", "2023-09-02", 300),
+        ], "2023-09-01", "2023-09-03", "test", "2023-10-01 12:00:00")
+        self.assertEqual(self.rollup("A", "2023-09"), (20, -50, -30, -300, 3))
+        self.assertEqual(self.rollup("B", "2023-09"), (0, 0, 0, 300, 1))
+        logic.check_rollup_consistency(self.conn)
+
+        self.conn.execute("update monthly_rollups set income = 0 where month = '2023-08'")
+        with self.assertRaises(logic.InconsistentRollupsError):
+            logic.check_rollup_consistency(self.conn)
+
+
+    # Tests: Tags
+    #---------------------------------------------------------------------------
+    def test_tag_rules_priority(self):
+        matcher = tags.TagMatcher([
+            {"id": 1, "tag": "Lebensmittel", "field": "purpose", "kind": "regex", "pattern": "rewe|edeka", "priority": 0},
+            {"id": 2, "tag": "Strom", "field": "purpose", "kind": "regex", "pattern": r"abschlag\s+strom", "priority": 0},
+            {"id": 3, "tag": "Sonstiges", "field": "purpose", "kind": "regex", "pattern": ".", "priority": 10},
+            {"id": 4, "tag": "Versicherung", "field": "creditor_scheme_id", "kind": "exact", "pattern": "DE98ZZZ09999999999", "priority": 0},
+        ])
+
+        def tag_of(**kwargs):
+            tx = {f: "" for f in tags.TAG_FIELDS}
+            tx.update(kwargs)
+            rule = matcher.match(tx)
+            return rule and rule["tag"]
+
+        self.assertEqual(tag_of(purpose="Abschlag  STROM, danach REWE"), "Lebensmittel")
+        self.assertEqual(tag_of(purpose="Abschlag Strom 09/23"), "Strom")
+        self.assertEqual(tag_of(purpose="Kino"), "Sonstiges")
+        self.assertEqual(tag_of(purpose="Kino", creditor_scheme_id="de98zzz09999999999 "), "Versicherung")
+        self.assertEqual(tag_of(), None)
+
+
+    def test_tags_are_used_for_rollups(self):
+        self.insert_account("A")
+        tags.add_rule(self.conn, "Miete", "purpose", "regex", "miete")
+
+        logic.insert_transactions(self.conn, {"account_number": "A"}, [
+            make_transaction("A", "", "2023-09-01", -800, purpose="Miete September"),
+            make_transaction("A", "", "2023-09-02", -50, remote_name="REWE"),
+        ], "2023-08-31", "2023-09-03", "test", "2023-09-03 12:00:00")
+        self.assertEqual(self.categories("A", "2023-09"), {"": -50, "Miete": -800})
+
+        rule_id = tags.add_rule(self.conn, "Lebensmittel", "remote_name", "exact", "rewe")
+        logic.retag_transactions(self.conn)
+        self.assertEqual(self.categories("A", "2023-09"), {"Lebensmittel": -50, "Miete": -800})
+        self.assertEqual({r["tag"]: r["hits"] for r in tags.rule_stats(self.conn)}, {"Miete": 1, "Lebensmittel": 1})
+
+        tags.delete_rule(self.conn, rule_id)
+        logic.retag_transactions(self.conn)
+        self.assertEqual(self.categories("A", "2023-09"), {"": -50, "Miete": -800})
+        logic.check_rollup_consistency(self.conn)
+
+
+    def test_uncombinable_tag_rules_are_rejected(self):
+        for pattern in ["(?i)netflix", r"(a)\1", "(?P<r1>a)", "(?P<x>a)(?P=x)", "(unclosed", "a))|((b"]:
+            with self.assertRaises(RuntimeError):
+                tags.add_rule(self.conn, "X", "purpose", "regex", pattern)
+        tags.add_rule(self.conn, "Netflix", "purpose", "regex", r"net\\flix|(?:a)\d")
+
+        # Rules that have been added before are ignored
+        for pattern in ["(?i)netflix", "a))|((b"]:
+            self.conn.execute(
+                "insert into tag_rules(tag, field, kind, pattern, priority) values('X', 'purpose', 'regex', ?, 0)",
+                (pattern,)
+            )
+        self.insert_account("A")
+        logic.insert_transactions(self.conn, {"account_number": "A"}, [
+            make_transaction("A", "", "2023-09-01", -10, purpose="a1"),
+        ], "2023-08-31", "2023-09-03", "test", "2023-09-03 12:00:00")
+        self.assertEqual(self.categories("A", "2023-09"), {"Netflix": -10})
+
+
+    # Tests: Recurring payments
+    #---------------------------------------------------------------------------
+    def test_recurring_payments(self):
+        self.insert_account("A")
+        account = {"account_number": "A"}
+
+        logic.insert_transactions(self.conn, account, [
+            make_transaction("A", "iban:X", "2023-06-01", -999, remote_name="Streaming GmbH 4711"),
+            make_transaction("A", "iban:Y", "2023-06-15", -5000, remote_name="Einmalig"),
+            make_transaction("A", "", "2023-06-28", -2000, remote_name="Versicherung", creditor_scheme_id="DE01ZZZ", mandate_id="M1"),
+            make_transaction("A", "iban:X", "2023-07-03", -999, remote_name="Streaming GmbH 4712"),
+            make_transaction("A", "", "2023-07-28", -2000, remote_name="Versicherung", creditor_scheme_id="DE01ZZZ", mandate_id="M1"),
+            make_transaction("A", "iban:X", "2023-08-01", -999, remote_name="Streaming GmbH 4713"),
+        ], "2023-05-31", "2023-08-02", "test", "2023-08-02 12:00:00")
+        self.assertEqual(self.recurring_series(), {"Streaming GmbH 4713": ("monthly", -999, 3, "2023-08-31")})
+
+        # The third payment of the insurance arrives with the next import
+        logic.insert_transactions(self.conn, account, [
+            make_transaction("A", "", "2023-08-28", -2100, remote_name="Versicherung", creditor_scheme_id="DE01ZZZ", mandate_id="M1"),
+        ], "2023-08-02", "2023-08-30", "test", "2023-08-30 12:00:00")
+        self.assertEqual(self.recurring_series(), {
+            "Streaming GmbH 4713": ("monthly", -999, 3, "2023-08-31"),
+            "Versicherung": ("monthly", -2000, 3, "2023-09-27"),
+        })
+
+        self.assertEqual([r["remote_name"] for r in recurring.missing_payments(self.conn, "2023-09-04")], [])
+        self.assertEqual([r["remote_name"] for r in recurring.missing_payments(self.conn, "2023-09-05")], ["Streaming GmbH 4713"])
+
+        expected = self.recurring_series()
+        recurring.rebuild_series(self.conn)
+        self.assertEqual(self.recurring_series(), expected)
+
+
+    @unittest.skipIf(numpy == None, "numpy is not installed")
+    def test_vectorized_series_detection(self):
+        rng = random.Random(1)
+        rows = []
+        for acc in ["A", "B"]:
+            for key in range(30):
+                period = rng.choice([7, 14, 30, 91, 365, 50])
+                date = datetime.date(2020, 1, 1)
+                for _ in range(rng.randint(1, 8)):
+                    date += datetime.timedelta(days=period + rng.randint(-6, 6))
+                    rows.append({
+                        "local_account": acc, "series_key": f"k{key:02d}", "entry_date": str(date),
+                        "value": rng.choice([-999, -1000, -1001, 500]), "remote_name": f"R{key}",
+                    })
+
+        expected = [
+            series for series in (
+                recurring.detect_series(list(txs))
+                for _, txs in itertools.groupby(rows, key=lambda tx: (tx["local_account"], tx["series_key"]))
+            )
+            if series
+        ]
+        self.assertGreater(len(expected), 5)
+        self.assertEqual(recurring.detect_all_series(rows), expected)
+
+    # Tests: Display columns
+    #---------------------------------------------------------------------------
+    def test_display_columns(self):
+        self.insert_account("iban:A")
+        logic.insert_transactions(self.conn, {"account_number": "iban:A"}, [
+            make_transaction("iban:A", "iban:DE02120300000000202051", "2023-09-02", -5, remote_name="Stadtwerke"),
+            make_transaction("iban:A", "", "2023-09-03", 123456, purpose="Visa\nFoo"),
+        ], "2023-09-01", "2023-09-04", "test", "2023-09-04 12:00:00")
+
+        rows = self.conn.execute(
+            "select display_remote_name, display_account, display_value from transactions order by total_order"
+        ).fetchall()
+        self.assertEqual(tuple(rows[0]), ("Stadtwerke\nDE02120300000000202051", "A", "-0.05€"))
+        self.assertEqual(tuple(rows[1]), ("Visa", "A", "1234.56€"))
+
+
+    def test_existing_databases_are_migrated(self):
+        conn = sqlite3.connect(":memory:")
+        conn.row_factory = sqlite3.Row
+        conn.execute(db.DB_ACCOUNTS_TABLE)
+        # The transactions table before the counterparties and the derived columns were added
+        conn.execute(
+            """create table transactions(
+                id integer,
+                local_account text not null,
+                remote_account text not null,
+                remote_name text not null,
+                entry_date date not null,
+                valuta_date date not null,
+                value integer not null,
+                currency text not null,
+                purpose text not null,
+                ultimate_debtor text not null,
+                ultimate_creditor text not null,
+                primanota text not null,
+                original_value integer,
+                original_currency text,
+                exchange_rate text,
+                transaction_key text not null,
+                transaction_code text not null,
+                transaction_text text not null,
+                creditor_scheme_id text not null,
+                mandate_id text not null,
+                end_to_end_ref text not null,
+                cc_entry_ref text,
+                cc_billing_ref text,
+                matching_txn integer,
+                total_order integer not null,
+                inserted_at datetime not null,
+                inserted_by text not null,
+
+                constraint PK_transactions__id primary key(id),
+                constraint UK_transactions__total_order unique(local_account, total_order),
+                constraint FK_transactions__matching_txn foreign key(matching_txn) references transactions(id),
+                constraint FK_transactions__local_account foreign key(local_account) references accounts(account_number)
+            )"""
+        )
+        conn.execute("create index IX_transactions__remote_name on transactions(remote_name)")
+        conn.execute("insert into accounts(account_number, bank_code) values('iban:A', '12345678')")
+        for i, remote_name in enumerate(["X", "X", "Y"]):
+            t = make_transaction("iban:A", "", "2023-09-03", 100, remote_name=remote_name).to_dict()
+            t.update({"total_order": i, "inserted_at": "2023-09-10 00:00:00", "inserted_by": "test"})
+            if remote_name == "Y":
+                t.update({"original_value": 108, "original_currency": "USD", "exchange_rate": "1.08564219"})
+            elif i == 1:
+                # Stored like this by the CSV backend
+                t.update({"original_value": 108, "original_currency": "USD", "exchange_rate": "1.234,5"})
+            conn.execute(
+                "insert into transactions({}) values({})".format(", ".join(t.keys()), ", ".join(":" + c for c in t.keys())),
+                t
+            )
+
+        self.assertTrue(db.schema_outdated(conn))
+        logic.init_database(conn)
+        self.assertFalse(db.schema_outdated(conn))
+        self.assertFalse(db.schema_outdated(self.conn))
+        self.assertEqual(db.object_type(conn, "transactions"), "view")
+        rows = conn.execute("select remote_name, display_remote_name, display_value from transactions order by id").fetchall()
+        self.assertEqual([tuple(r) for r in rows], [("X", "X", "1.00€"), ("X", "X", "1.00€"), ("Y", "Y", "1.00€")])
+        self.assertEqual(conn.execute("select count(*) from counterparties").fetchone()[0], 2)
+        self.assertEqual([r[0] for r in conn.execute("select exchange_rate from transactions order by id")], [None, 1234500000, 1085642])
+        self.assertEqual([r[0] for r in conn.execute("select rowid from transactions_fts where transactions_fts match 'Y'")], [3])
+        conn.close()
+
+
+    # Tests: Money
+    #---------------------------------------------------------------------------
+    def test_money_parsing_and_formatting(self):
+        self.assertEqual(money.parse_cents("-1.234,56", ",", "."), -123456)
+        self.assertEqual(money.parse_cents("12.3"), 1230)
+        self.assertEqual(money.parse_cents("-0.999"), -99)
+        self.assertEqual(money.parse_cents("+5"), 500)
+        self.assertEqual(money.parse_fraction_cents("-12345/100"), -12345)
+        self.assertEqual(money.parse_fraction_cents("5/10"), 50)
+        self.assertEqual(money.parse_rate("1,0856", ","), 1085600)
+        with self.assertRaises(RuntimeError):
+            money.parse_cents("1.2.3")
+        with self.assertRaises(RuntimeError):
+            money.parse_cents("-")
+
+        self.assertEqual(money.fmt_money(-5), "-0.05€")
+        self.assertEqual(money.fmt_money(123456), "1234.56€")
+        self.assertEqual(money.fmt_rate(1085600), "1.085600")
+        self.assertEqual(money.convert(-1085, 1085600), -999)
+        self.assertEqual(money.effective_rate(-2170, -2000), 1085000)
+
+
+    def test_foreign_currency_totals(self):
+        self.insert_account("A")
+        insert_transaction(self.conn, "A", "", "2023-09-02", -1000, 0, original_value=-1080, original_currency="USD", exchange_rate=1080000)
+        insert_transaction(self.conn, "A", "", "2023-09-05", -2000, 1, original_value=-2180, original_currency="USD", exchange_rate=1090000)
+        insert_transaction(self.conn, "A", "", "2023-09-06", -500, 2, original_value=-500, original_currency="EUR")
+        insert_transaction(self.conn, "A", "", "2023-09-07", -700, 3)
+
+        totals = logic.foreign_currency_totals(self.conn.cursor())
+        self.assertEqual(len(totals), 1)
+        t = totals[0]
+        self.assertEqual(
+            (t["original_currency"], t["num_transactions"], t["original_total"], t["booked_total"]),
+            ("USD", 2, -3260, -3000)
+        )
+        self.assertEqual(t["latest_rate"], 1090000)
+        self.assertEqual(t["effective_rate"], 1086667)
+        self.assertEqual(t["converted_total"], -2991)
+
+        self.assertEqual(logic.foreign_currency_totals(self.conn.cursor(), start_date="2023-09-03")[0]["booked_total"], -2000)
+
+
+    # Tests: Counterparties
+    #---------------------------------------------------------------------------
+    def test_counterparties_are_shared(self):
+        self.insert_account("A")
+        acc = {"account_number": "A"}
+        transactions = [
+            make_transaction("A", "iban:B", "2023-09-02", -100, remote_name="Stadtwerke"),
+            make_transaction("A", "iban:B", "2023-10-02", -100, remote_name="Stadtwerke"),
+            make_transaction("A", "", "2023-10-03", -200, remote_name="REWE"),
+        ]
+        logic.insert_transactions(self.conn.cursor(), acc, transactions, "2023-09-01", "2023-10-31", "test", "2023-10-31 00:00:00")
+
+        self.assertEqual(self.conn.execute("select count(*) from counterparties").fetchone()[0], 2)
+        rows = self.conn.execute("select remote_account, remote_name from transactions order by entry_date").fetchall()
+        self.assertEqual([tuple(r) for r in rows], [("iban:B", "Stadtwerke"), ("iban:B", "Stadtwerke"), ("", "REWE")])
+
+        # Updates through the view move the transaction to another counterparty
+        self.conn.execute("update transactions set remote_name = 'REWE', remote_account = '' where entry_date = '2023-09-02'")
+        self.assertEqual(self.conn.execute("select count(distinct counterparty_id) from transactions").fetchone()[0], 2)
+        self.assertEqual(self.conn.execute("select count(*) from counterparties").fetchone()[0], 2)
+
+
+    # Tests: Full-text search
+    #---------------------------------------------------------------------------
+    def test_fts_index_is_kept_in_sync(self):
+        self.insert_account("A")
+        insert_transaction(self.conn, "A", "iban:DE02120300000000202051", "2023-09-02", -100, 0,
+                           remote_name="Stadtwerke", purpose="Abschlag Strom")
+        insert_transaction(self.conn, "A", "", "2023-09-03", -100, 1, purpose="Miete")
+
+        self.assertEqual(self.search('"strom"'), ["Abschlag Strom"])
+        self.assertEqual(self.search('"stadt"*'), ["Abschlag Strom"])
+        self.assertEqual(self.search('"DE02120300000000202051"'), ["Abschlag Strom"])
+
+        self.conn.execute("update transactions set purpose = 'Abschlag Gas' where total_order = 0")
+        self.assertEqual(self.search('"strom"'), [])
+        self.assertEqual(self.search('"gas"'), ["Abschlag Gas"])
+
+        self.conn.execute("delete from transactions where total_order = 0")
+        self.assertEqual(self.search('"gas"'), [])
+        self.assertEqual(self.search('"miete"'), ["Miete"])
+
+
+    # Tests: Change journal
+    #---------------------------------------------------------------------------
+    def test_changes_are_journaled(self):
+        self.insert_account("A")
+        insert_transaction(self.conn, "A", "", "2023-09-02", -100, 0)
+        insert_transaction(self.conn, "A", "", "2023-09-03", -200, 1)
+        [id1, id2] = [r["id"] for r in self.conn.execute("select id from transactions order by total_order")]
+
+        self.conn.execute("update transactions set purpose = 'Miete' where id = ?", (id2,))
+        self.conn.execute("delete from transactions where id = ?", (id1,))
+
+        changes = self.conn.execute("select seq, transaction_id, kind from transaction_changes order by seq").fetchall()
+        self.assertEqual([r["seq"] for r in changes], [1, 2, 3, 4])
+        self.assertEqual(
+            [(r["transaction_id"], r["kind"]) for r in changes],
+            [(id1, "insert"), (id2, "insert"), (id2, "update"), (id1, "delete")]
+        )
+
+        self.conn.execute("update transaction_changes set changed_at = datetime('now', '-31 days') where seq <= 2")
+        logic.prune_transaction_changes(self.conn)
+        self.assertEqual([r["seq"] for r in self.conn.execute("select seq from transaction_changes")], [3, 4])
+
+
+    # Tests: Import batches
+    #---------------------------------------------------------------------------
+    def test_undo_import_batch(self):
+        self.insert_account("A")
+        self.insert_account("B")
+        self.conn.execute("update accounts set initial_balance = 1000 where account_number = 'A'")
+
+        logic.insert_transactions(self.conn, {"account_number": "B"}, [
+            make_transaction("B", "A", "2023-09-03", 100),
+        ], "2023-09-01", "2023-09-06", "test", "2023-09-06 12:00:00")
+        logic.insert_transactions(self.conn, {"account_number": "A"}, [
+            make_transaction("A", "", "2023-09-02", -50),
+        ], "2023-09-01", "2023-09-06", "test", "2023-09-06 12:00:00")
+        logic.insert_transactions(self.conn, {"account_number": "A"}, [
+            make_transaction("A", "", "2023-08-20", 200),
+            make_transaction("A", "", "2023-09-02", -50),
+            make_transaction("A", "B", "2023-09-03", -100),
+        ], "2023-08-15", "2023-09-05", "test", "2023-09-07 12:00:00")
+        self.assertEqual(self.conn.execute("select count(*) from transactions where matching_txn is not null").fetchone()[0], 2)
+
+        batches = self.conn.execute("select id, num_transactions from import_batches order by id").fetchall()
+        self.assertEqual([b["num_transactions"] for b in batches], [1, 1, 2])
+
+        # Only the most recent import of an account can be undone
+        with self.assertRaises(RuntimeError):
+            logic.undo_import_batch(self.conn, batches[1]["id"])
+
+        logic.undo_import_batch(self.conn, batches[2]["id"])
+        logic.check_consistency(self.conn)
+        self.assertEqual(
+            [(r["local_account"], r["value"], r["matching_txn"]) for r in self.conn.execute("select * from transactions order by id")],
+            [("B", 100, None), ("A", -50, None)]
+        )
+        self.assertEqual(
+            [tuple(r) for r in self.conn.execute("select start_date, end_date from intervals where account_number = 'A'")],
+            [("2023-09-01", "2023-09-06")]
+        )
+        self.assertEqual(self.conn.execute("select initial_balance from accounts where account_number = 'A'").fetchone()[0], 1000)
+        self.assertEqual(logic.balance_at(self.conn, "A", "2023-09-30"), 950)
+        self.assertEqual(self.rollup("B", "2023-09")[0], 100)
+
+        # Now the previous import is the most recent one
+        logic.undo_import_batch(self.conn, batches[1]["id"])
+        logic.check_consistency(self.conn)
+        self.assertEqual(self.conn.execute("select count(*) from intervals where account_number = 'A'").fetchone()[0], 0)
+
+
+    def test_undo_import_batch_after_import_without_new_transactions(self):
+        self.insert_account("A")
+        self.conn.execute("update accounts set initial_balance = 1000 where account_number = 'A'")
+
+        transactions = [make_transaction("A", "", "2023-09-02", -50)]
+        logic.insert_transactions(self.conn, {"account_number": "A"}, transactions, "2023-09-01", "2023-09-06", "test", "2023-09-06 12:00:00")
+        logic.insert_transactions(
+            self.conn, {"account_number": "A"}, [make_transaction("A", "", "2023-09-02", -50)],
+            "2023-09-02", "2023-09-08", "test", "2023-09-08 12:00:00",
+            balances=[{"date": "2023-09-08", "balance": 950}]
+        )
+        batches = self.conn.execute("select id, num_transactions from import_batches order by id").fetchall()
+        self.assertEqual([b["num_transactions"] for b in batches], [1, 0])
+
+        # The empty import is undone together with the one before it
+        undone = logic.undo_import_batch(self.conn, batches[0]["id"])
+        self.assertEqual([b["id"] for b in undone], [b["id"] for b in batches])
+        logic.check_consistency(self.conn)
+        self.assertEqual(self.conn.execute("select count(*) from transactions").fetchone()[0], 0)
+        self.assertEqual(self.conn.execute("select count(*) from intervals").fetchone()[0], 0)
+        self.assertEqual(self.conn.execute("select count(*) from balance_checkpoints").fetchone()[0], 0)
+        self.assertEqual(self.conn.execute("select count(*) from import_batches").fetchone()[0], 0)
+
+    # Tests: Balance checkpoints
+    #---------------------------------------------------------------------------
+    def test_balance_checkpoints(self):
+        self.insert_account("A")
+        self.conn.execute("update accounts set initial_balance = 1000 where account_number = 'A'")
+
+        logic.insert_transactions(self.conn, {"account_number": "A"}, [
+            make_transaction("A", "", "2023-09-02", -150),
+            make_transaction("A", "", "2023-09-05", 300),
+            make_transaction("A", "", "2023-09-06", 20),
+        ], "2023-09-01", "2023-09-06", "test", "2023-09-06 12:00:00", balances=[
+            {"date": "2023-09-03", "balance": 850},
+            # Moved to the last complete day
+            {"date": "2023-09-06", "balance": 1170},
+        ])
+        self.assertEqual(
+            [tuple(r) for r in self.conn.execute("select date, balance from balance_checkpoints order by date")],
+            [("2023-09-03", 850), ("2023-09-05", 1150)]
+        )
+        logic.check_checkpoint_consistency(self.conn)
+
+        # A missing transaction
+        self.conn.execute("delete from transaction_records where value = -150")
+        logic.update_daily_balances(self.conn, "A")
+        with self.assertRaises(logic.InconsistentCheckpointsError) as cm:
+            logic.check_checkpoint_consistency(self.conn)
+        self.assertEqual(
+            [(c["date"], c["reported_balance"], c["computed_balance"]) for c in cm.exception.inconsistent_checkpoints],
+            [("2023-09-03", 850, 1000), ("2023-09-05", 1150, 1300)]
+        )
+
+
+    # Tests: Abstract transactions
+    #---------------------------------------------------------------------------
+    def test_abstract_transactions(self):
+        self.insert_account("A")
+        self.insert_account("B")
+        # Purely abstract transactions are never touched
+        self.conn.execute(
+            """insert into abstract_transactions(from_account, to_account, amount, inserted_at, inserted_by)
+            values('B', 'A', 500, '2023-09-01 00:00:00', 'test')"""
+        )
+
+        logic.insert_transactions(self.conn, {"account_number": "A"}, [
+            make_transaction("A", "B", "2023-09-03", -100),
+            make_transaction("A", "", "2023-09-04", -20),
+        ], "2023-09-01", "2023-09-06", "test", "2023-09-06 12:00:00")
+        self.assertEqual(self.abstract_transactions(), [
+            ("A", "B", 100, "2023-09-03", None),
+            ("B", "A", 500, None, None),
+        ])
+
+        # The counterpart arrives
+        logic.insert_transactions(self.conn, {"account_number": "B"}, [
+            make_transaction("B", "A", "2023-09-05", 100),
+        ], "2023-09-01", "2023-09-06", "test", "2023-09-07 12:00:00")
+        self.assertEqual(self.abstract_transactions(), [
+            ("A", "B", 100, "2023-09-03", "2023-09-05"),
+            ("B", "A", 500, None, None),
+        ])
+        logic.check_consistency(self.conn)
+
+        self.conn.execute("update abstract_transactions set to_entry_date = null where from_account = 'A'")
+        with self.assertRaises(logic.InconsistentAbstractTransactionsError):
+            logic.check_abstract_transaction_consistency(self.conn)
+        self.conn.execute("update abstract_transactions set to_entry_date = '2023-09-05' where from_account = 'A'")
+
+        batch_id = self.conn.execute("select max(id) from import_batches").fetchone()[0]
+        logic.undo_import_batch(self.conn, batch_id)
+        logic.check_consistency(self.conn)
+        self.assertEqual(self.abstract_transactions(), [
+            ("A", "B", 100, "2023-09-03", None),
+            ("B", "A", 500, None, None),
+        ])
+
+
     # Utils
     #---------------------------------------------------------------------------
+    def rollup(self, acc, month):
+        return tuple(self.conn.execute(
+            """select income, expense, net, transfers, num_transactions from monthly_rollups
+            where account_number = ? and month = ?""",
+            (acc, month)
+        ).fetchone())
+
+
+    def categories(self, acc, month):
+        return {r["category"]: r["expense"] for r in self.conn.execute(
+            "select category, expense from monthly_rollups where account_number = ? and month = ?",
+            (acc, month)
+        )}
+
+
+    def recurring_series(self):
+        return {
+            r["remote_name"]: (r["period"], r["typical_value"], r["num_transactions"], r["next_expected_date"])
+            for r in self.conn.execute("select * from recurring_series")
+        }
+
+
+    def abstract_transactions(self):
+        return [tuple(r) for r in self.conn.execute(
+            """select from_account, to_account, amount, from_entry_date, to_entry_date from abstract_transactions
+            order by from_account"""
+        )]
+
+
+    def search(self, query):
+        return [r["purpose"] for r in self.conn.execute(
+            """select purpose from transactions
+            where id in (select rowid from transactions_fts where transactions_fts match ?)""",
+            (query,)
+        )]
+
+
     def assert_invalid_interval(self, acc, start_date, end_date):
         self.insert_interval(acc, start_date, end_date)
         with self.assertRaises(logic.InconsistentIntervalsError):
@@ -100,3 +734,778 @@ class Test(unittest.TestCase):
             "insert into intervals(account_number, start_date, end_date) values(?, ?, ?)",
             (acc, start_date, end_date)
         )
+
+
+class TestExport(unittest.TestCase):
+    # Initialization and shutdown
+    #---------------------------------------------------------------------------
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+
+        db.create_schema(self.conn)
+
+        for acc in ["A", "B"]:
+            self.conn.execute("insert into accounts(account_number, bank_code) values(?, ?)", (acc, "12345678"))
+
+        self.insert_transaction("A", "B", "2023-09-01", -100, 0)
+        self.insert_transaction("B", "A", "2023-09-02", 100, 0)
+        self.insert_transaction("A", "C", "2023-09-05", -250, 1)
+        logic.match_transactions(self.conn)
+
+
+    def tearDown(self):
+        self.conn.close()
+
+
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_csv(self):
+        out = io.StringIO()
+        count = export.export_transactions(self.conn, out, "csv", accounts={"A"})
+        self.assertEqual(count, 2)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("id,local_account,"))
+
+
+    def test_jsonl_with_filters_and_matches(self):
+        out = io.StringIO()
+        export.export_transactions(
+            self.conn, out, "jsonl",
+            start_date="2023-09-01", end_date="2023-09-04", with_matches=True
+        )
+
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([r["local_account"] for r in rows], ["A", "B"])
+        self.assertEqual(rows[0]["matching_account"], "B")
+        self.assertEqual(rows[0]["matching_value"], 100)
+
+
+    def test_chunking(self):
+        export.CHUNK_SIZE, old_chunk_size = 1, export.CHUNK_SIZE
+        try:
+            out = io.StringIO()
+            self.assertEqual(export.export_transactions(self.conn, out, "jsonl"), 3)
+        finally:
+            export.CHUNK_SIZE = old_chunk_size
+
+
+    # Utils
+    #---------------------------------------------------------------------------
+    def insert_transaction(self, acc, remote, entry_date, value, total_order):
+        insert_transaction(self.conn, acc, remote, entry_date, value, total_order)
+
+
+@unittest.skipIf(numpy == None, "numpy is not installed")
+class TestSnapshot(unittest.TestCase):
+    # Initialization and shutdown
+    #---------------------------------------------------------------------------
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.conn = sqlite3.connect(os.path.join(self.temp_dir.name, "db.sqlite"))
+        self.conn.row_factory = sqlite3.Row
+        logic.init_database(self.conn)
+
+        for acc, initial_balance in [("A", 1000), ("B", 0)]:
+            self.conn.execute(
+                "insert into accounts(account_number, bank_code, initial_balance) values(?, '12345678', ?)",
+                (acc, initial_balance)
+            )
+        logic.insert_transactions(self.conn, {"account_number": "A"}, [
+            make_transaction("A", "B", "2023-08-30", -300),
+            make_transaction("A", "", "2023-09-02", 200, remote_name="Gehalt"),
+            make_transaction("A", "", "2023-09-02", -50, remote_name="REWE"),
+        ], "2023-08-29", "2023-09-03", "test", "2023-09-03 12:00:00")
+        logic.insert_transactions(self.conn, {"account_number": "B"}, [
+            make_transaction("B", "A", "2023-08-31", 300),
+        ], "2023-08-29", "2023-09-03", "test", "2023-09-03 12:00:00")
+
+
+    def tearDown(self):
+        self.conn.close()
+        self.temp_dir.cleanup()
+
+
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_columns_and_cache(self):
+        snap = snapshot.load_snapshot(self.conn)
+        self.assertEqual(snap.value.tolist(), [-300, 300, 200, -50])
+        self.assertEqual(snap.accounts[snap.account].tolist(), ["A", "B", "A", "A"])
+        self.assertEqual(snap.counterparties[snap.counterparty].tolist(), ["B", "A", "Gehalt", "REWE"])
+        self.assertEqual(snap.is_transfer.tolist(), [True, True, False, False])
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir.name, "db.sqlite.snapshot", "value.npy")))
+
+        # The cache is used until the transactions change
+        self.assertIsInstance(snapshot.load_snapshot(self.conn).value, numpy.memmap)
+        self.conn.execute("update transactions set value = -60 where value = -50")
+        self.assertEqual(snapshot.load_snapshot(self.conn).value.tolist(), [-300, 300, 200, -60])
+
+
+    def test_analysis(self):
+        snap = snapshot.load_snapshot(self.conn)
+        self.assertEqual(snapshot.running_balances(snap).tolist(), [700, 300, 900, 850])
+
+        sliced = snap[snap.date_slice("2023-08-31", "2023-09-01")]
+        self.assertEqual(sliced.value.tolist(), [300])
+
+        accounts, sums = snapshot.grouped_sums(snap.account, snap.value)
+        self.assertEqual(dict(zip(snap.accounts[accounts].tolist(), sums.tolist())), {"A": -150, "B": 300})
+
+        (income_months, income), (expense_months, expenses) = snapshot.monthly_income_and_expenses(snap)
+        self.assertEqual(income.tolist(), [200])
+        self.assertEqual(expense_months.astype(str).tolist(), ["2023-09"])
+
+
+
+    def test_archived_years_are_included(self):
+        self.conn.execute("insert into accounts(account_number, bank_code, initial_balance) values('C', '12345678', 500)")
+        logic.insert_transactions(self.conn, {"account_number": "C"}, [
+            make_transaction("C", "", "2022-12-15", -100, remote_name="Miete"),
+            make_transaction("C", "", "2023-01-10", 40, remote_name="Zinsen"),
+        ], "2022-12-01", "2023-01-31", "test", "2023-01-31 12:00:00")
+        self.conn.commit()
+        ids = snapshot.load_snapshot(self.conn).id.tolist()
+
+        self.assertEqual(partitions.archive_years(self.conn, 2022, today=datetime.date(2023, 3, 1)), [2022])
+        snap = snapshot.load_snapshot(self.conn)
+        self.assertEqual(snap.id.tolist(), ids)
+        self.assertEqual(db.detached_until(self.conn), "2022-12-31")
+
+        c = snap[snap.account == snap.account_code("C")]
+        self.assertEqual(snapshot.running_balances(c).tolist(), [400, 440])
+        (_, _), (expense_months, expenses) = snapshot.monthly_income_and_expenses(snap)
+        self.assertEqual(expense_months.astype(str).tolist(), ["2022-12", "2023-09"])
+        self.assertEqual(expenses.tolist(), [-100, -50])
+
+class TestPartitions(unittest.TestCase):
+    # Initialization and shutdown
+    #---------------------------------------------------------------------------
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.temp_dir.name, "finances.db")
+        self.conn = sqlite3.connect(self.db_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        logic.init_database(self.conn)
+
+        for acc in ["A", "B"]:
+            self.conn.execute("insert into accounts(account_number, bank_code) values(?, '12345678')", (acc,))
+            self.conn.execute(
+                "insert into intervals(account_number, start_date, end_date) values(?, '2020-12-31', '2023-03-01')",
+                (acc,)
+            )
+        insert_transaction(self.conn, "A", "", "2021-05-01", 100, 0, purpose="Gehalt")
+        insert_transaction(self.conn, "A", "B", "2021-12-30", -50, 1)
+        insert_transaction(self.conn, "A", "", "2022-06-01", -20, 2)
+        insert_transaction(self.conn, "B", "A", "2022-01-02", 50, 0)
+        insert_transaction(self.conn, "B", "", "2023-01-05", 10, 1)
+        logic.match_transactions(self.conn.cursor())
+        for acc in ["A", "B"]:
+            logic.update_daily_balances(self.conn, acc)
+            logic.update_monthly_rollups(self.conn, acc)
+        self.conn.commit()
+
+
+    def tearDown(self):
+        self.conn.close()
+        self.temp_dir.cleanup()
+
+
+    def ids(self, query):
+        return sorted(r[0] for r in self.conn.execute(query))
+
+
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_archiving_and_attaching(self):
+        all_ids = self.ids("select id from transactions")
+        self.assertEqual(partitions.archive_years(self.conn, 2021, today=datetime.date(2023, 3, 1)), [2021])
+
+        # The transfer from 2021-12-30 stays in the main database together with its partner
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir.name, "finances.2021.db")))
+        self.assertEqual(self.conn.execute("select count(*) from transactions").fetchone()[0], 4)
+        self.assertEqual(db.detached_until(self.conn), "2021-12-31")
+        logic.check_consistency(self.conn.cursor())
+        self.assertEqual(logic.balance_at(self.conn, "A", "2021-06-01"), 100)
+
+        partitions.attach_archives(self.conn)
+        self.assertEqual(self.ids("select id from transactions"), all_ids)
+        self.assertEqual(db.detached_until(self.conn), None)
+        logic.check_consistency(self.conn.cursor())
+        partitions.check_partition_consistency(self.conn.cursor())
+        partitions.detach_archives(self.conn)
+
+        # Now the transfer is archived as well, partly into the archive of 2021
+        self.assertEqual(partitions.archive_years(self.conn, 2022, today=datetime.date(2023, 3, 1)), [2022])
+        self.assertEqual(self.conn.execute("select count(*) from transactions").fetchone()[0], 1)
+        archives = self.conn.execute("select year, num_transactions from archives order by year").fetchall()
+        self.assertEqual([tuple(a) for a in archives], [(2021, 2), (2022, 2)])
+        logic.check_consistency(self.conn.cursor())
+
+        partitions.attach_archives(self.conn)
+        self.assertEqual(self.ids("select id from transactions"), all_ids)
+        self.assertEqual(self.ids("select id from transactions where matching_txn is not null"), self.ids(
+            "select id from transactions where entry_date in ('2021-12-30', '2022-01-02')"
+        ))
+        logic.check_consistency(self.conn.cursor())
+        partitions.check_partition_consistency(self.conn.cursor())
+        partitions.detach_archives(self.conn)
+
+
+    def test_incomplete_and_archived_years_are_rejected(self):
+        self.conn.execute("update intervals set end_date = '2022-01-10' where account_number = 'B'")
+        self.conn.commit()
+        with self.assertRaises(RuntimeError):
+            partitions.archive_years(self.conn, 2023, today=datetime.date(2023, 3, 1))
+
+        # 2021 can be archived, but B has not been imported long enough after 2022
+        with self.assertRaises(RuntimeError):
+            partitions.archive_years(self.conn, 2022, today=datetime.date(2023, 3, 1))
+        self.assertEqual(db.archived_until(self.conn), "2021-12-31")
+
+        with self.assertRaises(RuntimeError):
+            logic.insert_transactions(
+                self.conn.cursor(), {"account_number": "A"},
+                [make_transaction("A", "", "2021-12-31", 1)], "2021-12-30", "2022-01-02",
+                "test", "2023-03-01 00:00:00"
+            )
+
+
+
+    def test_archived_tags_and_rollups_are_retagged(self):
+        self.assertEqual(partitions.archive_years(self.conn, 2021, today=datetime.date(2023, 3, 1)), [2021])
+        rule_id = tags.add_rule(self.conn, "Einkommen", "purpose", "exact", "Gehalt")
+
+        # The tags of the archived transactions cannot be updated without the archives
+        with self.assertRaises(RuntimeError):
+            logic.retag_transactions(self.conn.cursor())
+        self.conn.commit()
+
+        partitions.attach_archives(self.conn)
+        logic.retag_transactions(self.conn.cursor())
+        self.conn.commit()
+        self.assertEqual(self.conn.execute("select count(*) from archive_2021.transaction_tags").fetchone()[0], 1)
+        self.assertEqual(self.income("A", "2021-05"), {"Einkommen": 100})
+        partitions.check_partition_consistency(self.conn.cursor())
+
+        tags.delete_rule(self.conn.cursor(), rule_id)
+        logic.retag_transactions(self.conn.cursor())
+        self.conn.commit()
+        self.assertEqual(self.conn.execute("select count(*) from archive_2021.transaction_tags").fetchone()[0], 0)
+        self.assertEqual(self.income("A", "2021-05"), {"": 100})
+        partitions.check_partition_consistency(self.conn.cursor())
+        partitions.detach_archives(self.conn)
+
+
+    def test_recurring_series_include_archived_transactions(self):
+        self.conn.execute("insert into accounts(account_number, bank_code) values('C', '12345678')")
+        logic.insert_transactions(self.conn, {"account_number": "C"}, [
+            make_transaction("C", "", date, -999, remote_name="Streaming")
+            for date in ["2021-10-05", "2021-11-05", "2021-12-05", "2022-01-05"]
+        ], "2021-10-01", "2022-01-25", "test", "2022-01-25 12:00:00")
+        self.conn.commit()
+        self.assertEqual(partitions.archive_years(self.conn, 2021, today=datetime.date(2023, 3, 1)), [2021])
+
+        logic.insert_transactions(self.conn, {"account_number": "C"}, [
+            make_transaction("C", "", "2022-02-05", -999, remote_name="Streaming"),
+        ], "2022-01-25", "2022-02-10", "test", "2022-02-10 12:00:00")
+        [series] = self.conn.execute("select * from recurring_series where account_number = 'C'").fetchall()
+        self.assertEqual(
+            (series["num_transactions"], series["first_date"], series["remote_name"]),
+            (5, "2021-10-05", "Streaming")
+        )
+
+
+    def income(self, acc, month):
+        return {r["category"]: r["income"] for r in self.conn.execute(
+            "select category, income from monthly_rollups where account_number = ? and month = ?",
+            (acc, month)
+        )}
+
+class TestBackups(unittest.TestCase):
+    # Initialization and shutdown
+    #---------------------------------------------------------------------------
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self.temp_dir.name, "finances.db.backups")
+        self.conn = sqlite3.connect(os.path.join(self.temp_dir.name, "finances.db"))
+        self.conn.row_factory = sqlite3.Row
+        logic.init_database(self.conn)
+        self.conn.execute("insert into accounts(account_number, bank_code) values('A', '12345678')")
+        self.conn.commit()
+
+
+    def tearDown(self):
+        self.conn.close()
+        self.temp_dir.cleanup()
+
+
+    def count(self):
+        return self.conn.execute("select count(*) from transactions").fetchone()[0]
+
+
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_backups_are_only_created_after_changes(self):
+        first = backups.create_backup(self.conn)
+        self.assertNotEqual(first, None)
+        self.assertEqual(backups.create_backup(self.conn), None)
+
+        self.conn.execute("update accounts set initial_balance = 100")
+        self.conn.commit()
+        self.assertNotEqual(backups.create_backup(self.conn), None)
+
+        for i in range(3):
+            insert_transaction(self.conn, "A", "", "2023-09-02", -100, i)
+            self.conn.commit()
+            backups.create_backup(self.conn, keep=2)
+        names = [b["name"] for b in backups.list_backups(self.backup_dir)]
+        self.assertEqual(len(names), 2)
+        self.assertNotIn(first, names)
+        self.assertEqual(len(os.listdir(self.backup_dir)), 4)
+
+
+    def test_restore(self):
+        insert_transaction(self.conn, "A", "", "2023-09-02", -100, 0)
+        self.conn.commit()
+        before_import = backups.create_backup(self.conn)
+        insert_transaction(self.conn, "A", "", "2023-09-03", -100, 1)
+        self.conn.commit()
+
+        restored = backups.restore_backup(self.conn)
+        self.assertEqual(restored["name"], before_import)
+        self.assertEqual(self.count(), 1)
+
+        # The state before restoring has been backed up as well
+        backups.restore_backup(self.conn, backups.list_backups(self.backup_dir)[-1]["name"])
+        self.assertEqual(self.count(), 2)
+
+        with self.assertRaises(RuntimeError):
+            backups.restore_backup(self.conn, "missing")
+
+
+class TestRawArchive(unittest.TestCase):
+    # Initialization and shutdown
+    #---------------------------------------------------------------------------
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.archive_dir = os.path.join(self.temp_dir.name, "archive")
+
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_identical_files_are_stored_once(self):
+        self.archive("A", "2023-09-01 10:00:00", "2023-08-01", "2023-09-01", {"transactions.csv": b"x;y"})
+        self.archive("A", "2023-09-05 10:00:00", "2023-08-28", "2023-09-05", {"transactions.csv": b"x;y"})
+        self.archive("A", "2023-09-09 10:00:00", "2023-09-01", "2023-09-09", {"transactions.csv": b"x;y;z"})
+
+        objects = []
+        for _, _, files in os.walk(os.path.join(self.archive_dir, raw_archive.OBJECTS_DIR)):
+            objects += files
+        self.assertEqual(len(objects), 2)
+
+        [m] = raw_archive.find_imports(self.archive_dir, "A", "2023-09-07", "2023-09-08")
+        self.assertEqual(raw_archive.read_object(self.archive_dir, m["files"]["transactions.csv"]["hash"]), b"x;y;z")
+
+
+    def test_find_imports_by_date_range(self):
+        self.archive("A", "2023-09-01 10:00:00", "2023-08-01", "2023-09-01", {"a.csv": b"1"})
+        self.archive("A", "2023-09-05 10:00:00", "2023-08-28", "2023-09-05", {"a.csv": b"2"})
+        self.archive("B", "2023-09-05 10:00:00", "2023-08-28", "2023-09-05", {"a.csv": b"3"})
+
+        self.assertEqual(self.imported("A", "2023-08-29", "2023-08-30"), ["2023-09-01 10:00:00", "2023-09-05 10:00:00"])
+        self.assertEqual(self.imported("A", "2023-09-02", "2023-09-10"), ["2023-09-05 10:00:00"])
+        self.assertEqual(self.imported("A", None, "2023-08-15"), ["2023-09-01 10:00:00"])
+        self.assertEqual(self.imported("B", "2023-09-10", None), [])
+
+
+    def test_legacy_imports_are_converted(self):
+        legacy_dir = os.path.join(self.archive_dir, "A__2023-09-01 10:00:00")
+        os.makedirs(legacy_dir)
+        with open(os.path.join(legacy_dir, "transactions.csv"), "wb") as f:
+            f.write(b"x;y")
+        with open(os.path.join(legacy_dir, raw_archive.LEGACY_INFO_FILENAME), "w") as f:
+            f.write("imported = 2023-09-01 10:00:00\nbackend = csv\nstart_date = 2023-08-01\nend_date = 2023-09-01\n")
+
+        raw_archive.rebuild_index(self.archive_dir)
+
+        [m] = raw_archive.find_imports(self.archive_dir, "A")
+        self.assertEqual(m["backend"], "csv")
+        self.assertEqual(list(m["files"]), ["transactions.csv"])
+
+
+    # Utils
+    #---------------------------------------------------------------------------
+    def archive(self, acc, imported, start_date, end_date, files):
+        with tempfile.TemporaryDirectory() as src_dir:
+            for name, data in files.items():
+                with open(os.path.join(src_dir, name), "wb") as f:
+                    f.write(data)
+
+            raw_archive.archive_import(self.archive_dir, src_dir, acc, "csv", imported, start_date, end_date)
+
+
+    def imported(self, acc, start_date, end_date):
+        return [m["imported"] for m in raw_archive.find_imports(self.archive_dir, acc, start_date, end_date)]
+
+
+@unittest.skipIf(rebuild == None, "fints or schwifty is not installed")
+class TestRebuild(unittest.TestCase):
+    A = "iban:DE89370400440532013000"
+    B = "iban:DE02120300000000202051"
+
+    CSV_CONFIG = {
+        "has_header": True,
+        "delimiter": ";",
+        "decimal_separator": ",",
+        "thousands_separator": ".",
+        "fields": {
+            "entry_date": {"column": "Datum", "format": "%d.%m.%Y"},
+            "valuta_date": {"column": "Datum", "format": "%d.%m.%Y"},
+            "value": {"column": "Betrag"},
+            "remote_account": {"column": "IBAN"},
+            "remote_name": {"column": "Name"},
+            "purpose": {"column": "Zweck"},
+            "currency": {"column": "Waehrung"},
+            "balance": {"column": "Saldo"},
+        },
+    }
+
+
+    # Initialization and shutdown
+    #---------------------------------------------------------------------------
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.archive_dir = os.path.join(self.temp_dir.name, "archive")
+        self.conn = sqlite3.connect(os.path.join(self.temp_dir.name, "finances.db"))
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        logic.init_database(self.conn)
+
+        for acc, initial_balance in [(self.A, 1000), (self.B, 0)]:
+            self.conn.execute(
+                "insert into accounts(account_number, bank_code, backend_config, initial_balance) values(?, '12345678', ?, ?)",
+                (acc, json.dumps({"csv": self.CSV_CONFIG}), initial_balance)
+            )
+        self.conn.commit()
+
+
+    def tearDown(self):
+        self.conn.close()
+        self.temp_dir.cleanup()
+
+
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_rebuild_reproduces_database(self):
+        iban_a, iban_b = self.A[5:], self.B[5:]
+        self.import_csv(self.A, "2023-09-05 10:00:00", "2023-09-01", "2023-09-05", [
+            ("01.09.2023", "-1,00", iban_b, "B", "Umbuchung", "EUR", "9,00"),
+            ("03.09.2023", "5,00", "", "Arbeitgeber", "Gehalt", "EUR", "14,00"),
+        ])
+        self.import_csv(self.B, "2023-09-06 10:00:00", "2023-09-01", "2023-09-06", [
+            ("02.09.2023", "1,00", iban_a, "A", "Umbuchung", "EUR", "1,00"),
+        ])
+        self.import_csv(self.A, "2023-09-10 10:00:00", "2023-09-04", "2023-09-10", [
+            ("08.09.2023", "-2,50", "", "REWE", "Einkauf", "EUR", "11,50"),
+        ])
+        self.assertEqual(self.conn.execute("select count(*) from transactions where matching_txn is not null").fetchone()[0], 2)
+        self.assertEqual(self.conn.execute("select count(*) from balance_checkpoints").fetchone()[0], 4)
+
+        rebuilt_file = os.path.join(self.temp_dir.name, "rebuilt.db")
+        self.assertEqual(rebuild.rebuild_database(self.conn, rebuilt_file, self.archive_dir, processes=1), (3, 4))
+
+        rebuilt_conn = sqlite3.connect(rebuilt_file)
+        try:
+            self.assert_same_rows(rebuilt_conn, [
+                "select local_account, entry_date, value, purpose, total_order from transactions order by local_account, total_order",
+                """select t.local_account, t.entry_date, m.local_account, m.entry_date
+                from transactions t join transactions m on m.id = t.matching_txn order by t.local_account""",
+                "select account_number, start_date, end_date from intervals order by account_number, start_date",
+                "select account_number, initial_balance from accounts order by account_number",
+                "select account_number, date, balance from daily_balances order by account_number, date",
+                "select account_number, date, balance from balance_checkpoints order by account_number, date",
+            ])
+        finally:
+            rebuilt_conn.close()
+
+
+    def test_rebuild_with_archived_years(self):
+        self.import_csv(self.A, "2023-01-05 10:00:00", "2022-12-01", "2023-01-05", [
+            ("10.12.2022", "5,00", "", "Arbeitgeber", "Gehalt", "EUR", "15,00"),
+        ])
+        self.import_csv(self.A, "2023-02-15 10:00:00", "2023-01-01", "2023-02-15", [
+            ("20.01.2023", "-2,00", "", "REWE", "Einkauf", "EUR", "13,00"),
+        ])
+        self.assertEqual(partitions.archive_years(self.conn, 2022, today=datetime.date(2023, 3, 1)), [2022])
+
+        # The archived transaction is part of the balance even though the archives are not attached
+        rebuilt_file = os.path.join(self.temp_dir.name, "rebuilt.db")
+        self.assertEqual(rebuild.rebuild_database(self.conn, rebuilt_file, self.archive_dir, processes=1), (2, 2))
+
+        rebuilt_conn = sqlite3.connect(rebuilt_file)
+        try:
+            self.assert_same_rows(rebuilt_conn, [
+                "select account_number, initial_balance from accounts order by account_number",
+                "select account_number, date, balance from daily_balances order by account_number, date",
+            ])
+        finally:
+            rebuilt_conn.close()
+
+
+    # Utils
+    #---------------------------------------------------------------------------
+    # Imports `rows` the same way as the csv backend and archives the import
+    def import_csv(self, acc, imported, start_date, end_date, rows):
+        account = dict(self.conn.execute("select * from accounts where account_number = ?", (acc,)).fetchone())
+        account["backend_config"] = json.loads(account["backend_config"])
+        csv_filename = os.path.join(self.temp_dir.name, "export.csv")
+        with open(csv_filename, "w") as f:
+            f.write("Datum;Betrag;IBAN;Name;Zweck;Waehrung;Saldo\n")
+            f.writelines(";".join(row) + "\n" for row in rows)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            transactions, balances = backend_csv.csv_fetch_transactions(
+                account, start_date, end_date, temp_dir, self.CSV_CONFIG, {"csv_filename": csv_filename}
+            )
+            with open(os.path.join(temp_dir, raw_archive.BALANCES_FILENAME), "w") as f:
+                json.dump(balances, f)
+
+            logic.insert_transactions(
+                self.conn.cursor(), account, transactions, start_date, end_date, "csv", imported, balances=balances
+            )
+            self.conn.commit()
+            raw_archive.archive_import(self.archive_dir, temp_dir, acc, "csv", imported, start_date, end_date)
+
+
+    def assert_same_rows(self, rebuilt_conn, queries):
+        for query in queries:
+            self.assertEqual(
+                [tuple(r) for r in rebuilt_conn.execute(query)],
+                [tuple(r) for r in self.conn.execute(query)],
+                query
+            )
+
+
+@unittest.skipIf(gui == None, "PyQt6 is not installed")
+class TestGui(unittest.TestCase):
+    # Initialization and shutdown
+    #---------------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        cls.app = QApplication.instance() or QApplication([])
+
+
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_filter_changes_are_debounced(self):
+        bar = gui.TransactionFilterBar(self)
+        bar._on_accounts_loaded([{"account_number": "A"}])
+
+        bar._account.setCurrentIndex(1)
+        bar._account.setCurrentIndex(0)
+        bar._search.setText("x")
+        bar._start_date.setDate(bar._start_date.date().addDays(1))
+        self.assertTrue(bar._timer.isActive())
+        self.assertEqual(bar._timer.interval(), gui.TransactionFilterBar.DEBOUNCE_MS)
+
+
+    # Utils
+    #---------------------------------------------------------------------------
+    # Replaces QueryRunner.submit()
+    def submit(self, channel, query, params, callback):
+        pass
+
+
+class TestPlanner(unittest.TestCase):
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_plan_without_intervals(self):
+        self.assertEqual(
+            planner.plan_requests([], "2023-09-30"),
+            ([{"start_date": None, "end_date": "2023-09-30", "gaps": [(None, "2023-09-30")]}], [])
+        )
+        requests, _ = planner.plan_requests([], "2023-09-30", history_days=90)
+        self.assertEqual(requests[0]["start_date"], "2023-07-02")
+
+
+    def test_gaps_are_filled_and_merged(self):
+        intervals = [
+            ("2023-01-01", "2023-03-01"),
+            ("2023-03-10", "2023-06-01"),
+            ("2023-08-01", "2023-09-10"),
+            ("2023-09-15", "2023-09-20"),
+        ]
+        requests, unreachable = planner.plan_requests(intervals, "2023-09-30")
+        self.assertEqual(unreachable, [])
+        self.assertEqual([(r["start_date"], r["end_date"], r["gaps"]) for r in requests], [
+            ("2023-02-25", "2023-03-14", [("2023-03-01", "2023-03-10")]),
+            ("2023-05-28", "2023-08-05", [("2023-06-01", "2023-08-01")]),
+            # Less than MERGE_DAYS apart
+            ("2023-09-06", "2023-09-30", [("2023-09-10", "2023-09-15"), ("2023-09-20", "2023-09-30")]),
+        ])
+
+        # Backfill before the first interval
+        requests, _ = planner.plan_requests(intervals, "2023-09-30", backfill_from="2022-06-01")
+        self.assertEqual((requests[0]["start_date"], requests[0]["end_date"]), ("2022-06-01", "2023-01-05"))
+
+
+    def test_plan_respects_history_limit(self):
+        intervals = [
+            ("2023-01-01", "2023-03-01"),
+            ("2023-03-10", "2023-06-01"),
+            ("2023-08-01", "2023-09-10"),
+        ]
+        requests, unreachable = planner.plan_requests(intervals, "2023-09-30", history_days=90)
+        self.assertEqual(unreachable, [("2023-03-01", "2023-03-10"), ("2023-06-01", "2023-07-02")])
+        self.assertEqual(
+            [(r["start_date"], r["end_date"]) for r in requests],
+            [("2023-07-02", "2023-08-05"), ("2023-09-06", "2023-09-30")]
+        )
+
+
+    def test_history_days(self):
+        account = {"bank_code": "10010010", "backend_config": {"fints": {"history_days": 365}}}
+        self.assertEqual(planner.history_days(account, "aqbanking"), planner.POSTBANK_HISTORY_DAYS)
+        self.assertEqual(planner.history_days(account, "fints"), 365)
+        self.assertEqual(planner.history_days({"bank_code": "12345678", "backend_config": {}}, "fints"), None)
+
+
+class TestServer(unittest.TestCase):
+    # Initialization and shutdown
+    #---------------------------------------------------------------------------
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.imported = []
+        self.failing = set()
+        # B is only imported on request
+        options = {"interval_hours": 24, "schedule": {"B": 0}}
+        self.state = server.ServerState(
+            self.conn, [{"account_number": "A"}, {"account_number": "B"}], options, self.import_transactions
+        )
+
+
+    def tearDown(self):
+        self.conn.close()
+
+
+    # Tests
+    #---------------------------------------------------------------------------
+    def test_scheduled_imports(self):
+        self.assertEqual(self.state.seconds_until_next_run(), 0)
+        self.state.run_due_imports()
+        self.assertEqual(self.imported, ["A"])
+
+        # The next import of A is due after the interval
+        self.assertGreater(self.state.seconds_until_next_run(), 23 * 3600)
+        self.state.run_due_imports()
+        self.assertEqual(self.imported, ["A"])
+
+        self.state.next_run["A"] -= 24 * 3600
+        self.state.run_due_imports()
+        self.assertEqual(self.imported, ["A", "A"])
+
+        self.state.options["schedule"]["A"] = 0
+        self.assertEqual(server.ServerState(self.conn, [{"account_number": "A"}], self.state.options, self.import_transactions).seconds_until_next_run(), None)
+
+
+    def test_requests(self):
+        response = self.state.handle({"command": "import", "account": "A"})
+        self.assertEqual(response["status"], "ok")
+        self.assertEqual(response["runs"]["A"]["status"], "ok")
+        self.assertEqual(response["runs"]["A"]["num_new_transactions"], 3)
+
+        self.failing.add("B")
+        response = self.state.handle({"command": "import"})
+        self.assertEqual(self.imported, ["A", "A", "B"])
+        self.assertEqual(response["runs"]["B"]["status"], "error")
+        self.assertEqual(response["runs"]["B"]["error"], "Bank not reachable")
+
+        response = self.state.handle({"command": "import", "account": "C"})
+        self.assertEqual(response, {"status": "error", "error": "Unknown account: C"})
+        self.assertEqual(len(self.imported), 3)
+
+        response = self.state.handle({"command": "status"})
+        self.assertEqual(response["status"], "ok")
+        self.assertNotEqual(response["accounts"]["A"]["next_run"], None)
+        self.assertEqual(response["accounts"]["B"], {"next_run": None, "last_status": "error"})
+
+        response = self.state.handle({"command": "timings"})
+        self.assertEqual(sorted(response["runs"]), ["A", "B"])
+        self.assertGreaterEqual(response["runs"]["A"]["duration"], 0)
+
+        self.assertEqual(self.state.handle({"command": "foo"})["status"], "error")
+        self.assertFalse(self.state.stopped)
+        self.assertEqual(self.state.handle({"command": "stop"}), {"status": "ok"})
+        self.assertTrue(self.state.stopped)
+
+
+    @unittest.skipIf(rebuild == None, "fints or schwifty is not installed")
+    def test_broken_fints_clients_are_dropped(self):
+        class BrokenClient:
+            def __enter__(self):
+                raise RuntimeError("Bank not reachable")
+
+            def __exit__(self, *args):
+                pass
+
+        account = {"account_number": "iban:DE89370400440532013000", "bank_code": "12345678", "login_name": "x"}
+        options = {"fints_clients": {("12345678", "x"): BrokenClient()}}
+        with self.assertRaises(RuntimeError):
+            backend_fints.fints_fetch_transactions(account, None, None, None, {}, options)
+        self.assertEqual(options["fints_clients"], {})
+
+    # Utils
+    #---------------------------------------------------------------------------
+    # Replaces cli.import_transactions()
+    def import_transactions(self, conn, account, options):
+        self.imported.append(account["account_number"])
+        if account["account_number"] in self.failing:
+            raise RuntimeError("Bank not reachable")
+
+        return 3
+
+
+# Utils
+#===================================================================================================
+def make_transaction(acc, remote, entry_date, value, **kwargs):
+    t = {c: "" for c in db.DB_TRANSACTION_DATA_COLUMNS}
+    t.update({
+        "local_account": acc,
+        "remote_account": remote,
+        "entry_date": entry_date,
+        "valuta_date": entry_date,
+        "value": value,
+        "currency": "EUR",
+        "original_value": None,
+        "original_currency": None,
+        "exchange_rate": None,
+        "cc_entry_ref": None,
+        "cc_billing_ref": None,
+    })
+    t.update(kwargs)
+
+    return Transaction(**t)
+
+
+def insert_transaction(conn, acc, remote, entry_date, value, total_order, **kwargs):
+    t = make_transaction(acc, remote, entry_date, value, **kwargs).to_dict()
+    t["total_order"] = total_order
+    t["inserted_at"] = "2023-09-10 00:00:00"
+    t["inserted_by"] = "test"
+    conn.execute(
+        "insert into transactions({}) values({})".format(
+            ", ".join(t.keys()),
+            ", ".join(":" + c for c in t.keys())
+        ),
+        t
+    )